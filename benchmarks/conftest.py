@@ -0,0 +1,59 @@
+
+from __future__ import annotations
+
+from logging import getLogger
+from typing import Iterator, TYPE_CHECKING
+
+import pytest
+from flask import Flask
+
+from flask_ipernity import Ipernity
+from flask_ipernity.fakeserver import FakeIpernity
+
+if TYPE_CHECKING:
+    from flask.testing import FlaskClient
+
+
+log = getLogger(__name__)
+
+
+# Token as returned by auth.getToken
+token = {
+    'token':        'bench-token',
+    'user':         {'user_id': '1', 'username': 'user1', 'realname': 'User 1'},
+    'permissions':  {'doc': 'read'},
+}
+
+
+@pytest.fixture(scope = 'session')
+def fake() -> Iterator[FakeIpernity]:
+    with FakeIpernity(media_size = 256 * 1024) as server:
+        yield server
+
+
+@pytest.fixture
+def app(fake: FakeIpernity) -> Flask:
+    a = Flask(__name__)
+    a.config.update(
+        SECRET_KEY = 'bench',
+        IPERNITY_APP_KEY = 'bench',
+        IPERNITY_APP_SECRET = 'bench',
+        IPERNITY_API_URL = fake.url,
+        # Measure the cache and Ipernity, not the request memo
+        IPERNITY_MEMOIZE = False,
+    )
+    a.testing = True
+    Ipernity(a)
+    return a
+
+
+@pytest.fixture
+def cached_app(app: Flask) -> Flask:
+    app.config['IPERNITY_CACHE_REQUESTS'] = True
+    return app
+
+
+@pytest.fixture
+def client(app: Flask) -> FlaskClient:
+    return app.test_client()
+
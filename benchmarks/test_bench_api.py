@@ -0,0 +1,63 @@
+"""
+Benchmarks API object creation and cached calls
+"""
+
+from __future__ import annotations
+
+from itertools import count
+from logging import getLogger
+
+from flask import session
+
+from flask_ipernity import ipernity
+
+from conftest import token
+
+
+log = getLogger(__name__)
+
+
+def test_api_construction(benchmark, app):
+    with app.test_request_context():
+        benchmark(ipernity.make_api, token)
+
+
+def test_call_uncached(benchmark, app):
+    with app.test_request_context():
+        api = ipernity.make_api(token)
+        benchmark(api.doc.get, doc_id = 1)
+
+
+def test_cache_hit(benchmark, cached_app):
+    with cached_app.test_request_context():
+        api = ipernity.make_api(None)
+        api.doc.get(doc_id = 1)
+        benchmark(api.doc.get, doc_id = 1)
+
+
+def test_memo_hit(benchmark, app):
+    app.config['IPERNITY_MEMOIZE'] = True
+    with app.test_request_context():
+        api = ipernity.make_api(token)
+        api.doc.get(doc_id = 1)
+        benchmark(api.doc.get, doc_id = 1)
+
+
+def test_cache_miss(benchmark, cached_app):
+    doc_ids = count(1)
+    with cached_app.test_request_context():
+        api = ipernity.make_api(None)
+        benchmark(lambda: api.doc.get(doc_id = next(doc_ids)))
+
+
+def test_session_size(benchmark, cached_app):
+    serializer = cached_app.session_interface.get_signing_serializer(cached_app)
+    with cached_app.test_request_context():
+        ipernity.session_set('token', token)
+        api = ipernity.make_api(token)
+        for doc_id in range(1, 21):
+            api.doc.get(doc_id = doc_id)
+        data = benchmark(serializer.dumps, dict(session))
+    benchmark.extra_info['session_size'] = len(data)
+    log.info('Session size after 20 calls: %d bytes', len(data))
+
@@ -0,0 +1,50 @@
+"""
+Benchmarks the cold start of an application using Flask-Ipernity
+"""
+
+from __future__ import annotations
+
+import subprocess
+import sys
+from logging import getLogger
+
+import pytest
+
+
+log = getLogger(__name__)
+
+
+code = {
+    'flask': """
+from flask import Flask
+app = Flask(__name__)
+""",
+    'ipernity': """
+from flask import Flask
+from flask_ipernity import Ipernity
+app = Flask(__name__)
+Ipernity(app)
+""",
+    'ipernity-login': """
+from flask import Flask
+from flask_login import LoginManager
+from flask_ipernity import Ipernity
+app = Flask(__name__)
+app.config['IPERNITY_LOGIN'] = True
+LoginManager(app)
+Ipernity(app)
+""",
+}
+
+
+@pytest.mark.parametrize('setup', list(code))
+def test_cold_start(benchmark, setup):
+    """Time to start Python, import the modules and initialize the app."""
+    benchmark.pedantic(
+        subprocess.run,
+        args = ([sys.executable, '-c', code[setup]],),
+        kwargs = {'check': True},
+        rounds = 10,
+        warmup_rounds = 1
+    )
+
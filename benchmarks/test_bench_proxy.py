@@ -0,0 +1,26 @@
+"""
+Benchmarks the document proxy
+"""
+
+from __future__ import annotations
+
+from logging import getLogger
+
+import pytest
+
+
+log = getLogger(__name__)
+
+
+@pytest.mark.parametrize('label', ['240', '1024', 'original'])
+def test_proxy(benchmark, client, label):
+    def get():
+        res = client.get(f'/ipernity/doc/1/{label}')
+        assert res.status_code == 200
+        return len(res.data)
+    
+    size = benchmark(get)
+    benchmark.extra_info['size'] = size
+    if benchmark.stats:
+        benchmark.extra_info['throughput'] = size / benchmark.stats['mean']
+
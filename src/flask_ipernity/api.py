@@ -0,0 +1,323 @@
+"""
+This module provides the API class used by Flask-Ipernity.
+"""
+
+from __future__ import annotations
+
+from functools import partial
+from logging import getLogger
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Mapping, Sequence, Tuple, TYPE_CHECKING
+
+from ipernity import APIRequestError, IpernityAPI
+
+from .upstream import CircuitOpen
+
+if TYPE_CHECKING:
+    from .metrics import Metrics
+    from .tracing import CallTracer
+    from .upstream import CircuitBreaker, UpstreamLimiter
+
+
+log = getLogger(__name__)
+
+
+class FlaskIpernityAPI(IpernityAPI):
+    """
+    :class:`~ipernity.IpernityAPI` with hooks for Flask-Ipernity.
+    
+    An API call is split into three steps:
+    
+    1.  :meth:`lookup` checks if a result is already available,
+    2.  :meth:`fetch` gets the result from Ipernity,
+    3.  :meth:`store` saves the result.
+    
+    :meth:`lookup` and :meth:`store` may use the request context (e.g. the
+    Flask :data:`~flask.session`), while :meth:`fetch` only talks to Ipernity
+    and can be run in any thread.
+    
+    If :meth:`fetch` fails because the circuit breaker is open, :meth:`stale`
+    is used to look for an outdated result. If Ipernity returns an error,
+    :meth:`store_error` is called.
+    
+    Calls are recorded with :meth:`trace` if a ``tracer`` is given.
+    
+    With ``memoize``, the results and errors of read methods are kept in the
+    object (see :meth:`remember`), so repeating a call with the same
+    arguments doesn't ask Ipernity or the cache again. Calling a write method
+    (e.g. :ip:`doc.set`) forgets all results.
+    
+    Args:
+        limiter:    Limits the calls made by :meth:`fetch`.
+        breaker:    Circuit breaker for the calls made by :meth:`fetch`.
+        tracer:     Records the calls.
+        metrics:    Counts cache hits and calls to Ipernity.
+        service:    The token is a service token (see
+                    :data:`IPERNITY_SERVICE_TOKEN`), not a user's token.
+        memoize:    Remember the results of read methods.
+        args:       Passed to :class:`~ipernity.api.IpernityAPI`.
+        kwargs:     Passed to :class:`~ipernity.api.IpernityAPI`.
+    """
+    
+    def __init__(
+        self,
+        *args: Any,
+        limiter: UpstreamLimiter|None = None,
+        breaker: CircuitBreaker|None = None,
+        tracer: CallTracer|None = None,
+        metrics: Metrics|None = None,
+        service: bool = False,
+        memoize: bool = False,
+        **kwargs: Any
+    ):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter
+        self.breaker = breaker
+        self.tracer = tracer
+        self.metrics = metrics
+        self.service = service
+        self.memoize = memoize
+        self._remembered: Dict[str, Any] = {}
+    
+    
+    def call(self, method_name: str, **kwargs: Any) -> Dict:
+        """
+        Makes an API call.
+        
+        Runs :meth:`lookup`, :meth:`fetch` and :meth:`store`.
+        """
+        found, res = self.lookup(method_name, kwargs)
+        if found:
+            return res
+        
+        return self.collect(
+            method_name,
+            kwargs,
+            partial(self.fetch, method_name, **kwargs)
+        )
+    
+    
+    def collect(
+        self,
+        method_name: str,
+        kwargs: Mapping[str, Any],
+        fetch: Callable[[], Dict]
+    ) -> Dict:
+        """
+        Gets the result of an API call and stores it.
+        
+        This is the second part of :meth:`call`, after :meth:`lookup` found
+        nothing. It can be used to collect the result of :meth:`fetch`
+        running in another thread.
+        
+        Args:
+            method_name:    API method.
+            kwargs:         API arguments.
+            fetch:          Callable returning the result of :meth:`fetch`,
+                            e.g. the ``result`` method of a
+                            :class:`~concurrent.futures.Future`.
+        """
+        try:
+            res = fetch()
+        except CircuitOpen:
+            found, res = self.stale(method_name, kwargs)
+            if found:
+                return res
+            raise
+        except APIRequestError as e:
+            self.store_error(method_name, kwargs, e)
+            if e.status != 'httperror':
+                self._memo(method_name, kwargs, e)
+            raise
+        self.store(method_name, kwargs, res)
+        self._memo(method_name, kwargs, res)
+        return res
+    
+    
+    def lookup(self, method_name: str, kwargs: Mapping[str, Any]) -> Tuple[bool, Any]:
+        """
+        Looks for a stored result of an API call.
+        
+        The base implementation only finds results passed to
+        :meth:`remember`, including the memoized results of read methods.
+        
+        Returns:
+            Tuple ``(found, result)``.
+        Raises:
+            Exception:  The error passed to :meth:`remember`.
+        """
+        if not self._remembered:
+            return False, None
+        start = perf_counter()
+        key = method_name + repr(sorted(kwargs.items()))
+        if key not in self._remembered:
+            return False, None
+        res = self._remembered[key]
+        if isinstance(res, Exception):
+            self.trace(method_name, kwargs, 'hit', start, error = res)
+            raise res
+        self.trace(method_name, kwargs, 'hit', start, res)
+        return True, res
+    
+    
+    def lookup_many(
+        self,
+        calls: Sequence[Tuple[str, Mapping[str, Any]]]
+    ) -> List[Tuple[bool, Any]]:
+        """
+        Runs :meth:`lookup` for several calls.
+        
+        Subclasses can override this to look up all calls at once.
+        
+        Args:
+            calls:  Pairs of method name and arguments.
+        Returns:
+            List of ``(found, result)`` tuples. If :meth:`lookup` raised an
+            exception, it is returned as the result.
+        """
+        results = []
+        for method_name, kwargs in calls:
+            try:
+                results.append(self.lookup(method_name, kwargs))
+            except Exception as e:
+                results.append((True, e))
+        return results
+    
+    
+    def remember(self, method_name: str, kwargs: Mapping[str, Any], result: Any):
+        """
+        Keeps the result of a call in this object.
+        
+        :meth:`lookup` returns the result without asking the cache again.
+        This is used by :meth:`Ipernity.prefetch
+        <flask_ipernity.Ipernity.prefetch>`. As :attr:`Ipernity.api
+        <flask_ipernity.Ipernity.api>` is created for each request, the
+        results are kept until the end of the request.
+        
+        Args:
+            method_name:    API method.
+            kwargs:         API arguments.
+            result:         Result of the call, or the exception it raised.
+        """
+        self._remembered[method_name + repr(sorted(kwargs.items()))] = result
+    
+    
+    def forget(self):
+        """Forgets all results passed to :meth:`remember`."""
+        self._remembered.clear()
+    
+    
+    def _memo(self, method_name: str, kwargs: Mapping[str, Any], result: Any):
+        if not is_read_method(method_name):
+            self.forget()
+        elif self.memoize:
+            self.remember(method_name, kwargs, result)
+    
+    
+    def fetch(self, method_name: str, **kwargs: Any) -> Dict:
+        """
+        Gets the result of an API call from Ipernity.
+        
+        This method does not use the request context.
+        
+        Raises:
+            CircuitOpen:        :attr:`breaker` is open.
+            RateLimitExceeded:  :attr:`limiter` did not allow the call in time.
+        """
+        start = perf_counter()
+        try:
+            if self.breaker is None:
+                res = self._fetch(method_name, kwargs)
+            else:
+                res = self.breaker.call(self._fetch, method_name, kwargs)
+        except Exception as e:
+            self.trace(method_name, kwargs, 'error', start, error = e)
+            raise
+        self.trace(method_name, kwargs, 'miss', start, res)
+        return res
+    
+    
+    def _fetch(self, method_name: str, kwargs: Mapping[str, Any]) -> Dict:
+        if self.limiter is None:
+            return super().call(method_name, **kwargs)
+        with self.limiter:
+            return super().call(method_name, **kwargs)
+    
+    
+    def stale(self, method_name: str, kwargs: Mapping[str, Any]) -> Tuple[bool, Any]:
+        """
+        Looks for an outdated result of an API call.
+        
+        This is used when Ipernity is unavailable. The base implementation
+        never finds anything.
+        
+        Returns:
+            Tuple ``(found, result)``.
+        """
+        return False, None
+    
+    
+    def store(self, method_name: str, kwargs: Mapping[str, Any], result: Dict):
+        """
+        Stores the result of an API call.
+        
+        The base implementation does nothing.
+        """
+        pass
+    
+    
+    def store_error(
+        self,
+        method_name: str,
+        kwargs: Mapping[str, Any],
+        error: APIRequestError
+    ):
+        """
+        Handles an error returned by an API call.
+        
+        The base implementation does nothing.
+        """
+        pass
+    
+    
+    def invalidate_user(self):
+        """
+        Discards the stored results of the current user.
+        
+        Called by :meth:`Ipernity.logout <flask_ipernity.Ipernity.logout>`.
+        The base implementation does nothing.
+        """
+        pass
+    
+    
+    def trace(
+        self,
+        method_name: str,
+        kwargs: Mapping[str, Any],
+        outcome: str,
+        start: float,
+        result: Dict|None = None,
+        error: BaseException|None = None
+    ):
+        """
+        Records a call with :attr:`tracer`, if set.
+        
+        See :meth:`CallTracer.record <flask_ipernity.tracing.CallTracer.record>`.
+        """
+        if self.tracer is not None:
+            self.tracer.record(method_name, kwargs, outcome, start, result, error)
+
+
+def is_read_method(method_name: str) -> bool:
+    """
+    Checks if an API method only reads data.
+    
+    Methods that need a POST request according to
+    :attr:`IpernityAPI.__methods__ <ipernity.IpernityAPI.__methods__>` modify
+    data. Authentication and upload methods are not considered read methods
+    either, as their results change between calls.
+    """
+    if method_name.startswith(('auth.', 'upload.')):
+        return False
+    method = IpernityAPI.__methods__.get(method_name)
+    return method is not None and method['authentication']['post'] == '0'
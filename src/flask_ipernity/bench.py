@@ -0,0 +1,115 @@
+"""
+This module benchmarks API calls against a :class:`~.fakeserver.FakeIpernity`.
+"""
+
+from __future__ import annotations
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from time import perf_counter
+from typing import Any, Dict, Iterable, List, Tuple
+
+from .api import FlaskIpernityAPI
+from .cache import CachedIpernityAPI, MemoryCache
+from .fakeserver import FakeIpernity
+
+
+log = getLogger(__name__)
+
+
+# Call mix used if no recorded calls are given
+default_calls: List[Tuple[str, Dict]] = [
+    ('explore.docs.getPopular', {}),
+    ('user.get', {'user_id': '1'}),
+    ('doc.get', {'doc_id': '1'}),
+    ('doc.get', {'doc_id': '2'}),
+    ('doc.getMedias', {'doc_id': '1'}),
+    ('album.docs.getList', {'album_id': '1', 'per_page': '50'}),
+    ('doc.get', {'doc_id': '1'}),
+    ('doc.search', {'user_id': '1', 'page': '2'}),
+]
+
+
+def load_calls(filename: str) -> List[Tuple[str, Dict]]:
+    """
+    Loads a recorded call mix.
+    
+    The file contains one JSON object per line with the keys ``method`` and
+    ``kwargs``.
+    """
+    calls = []
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.strip():
+                call = json.loads(line)
+                calls.append((call['method'], call.get('kwargs', {})))
+    return calls
+
+
+def run_benchmark(
+    calls: Iterable[Tuple[str, Dict]],
+    cached: bool,
+    server: FakeIpernity,
+    repeat: int = 10,
+    threads: int = 1,
+    max_age: int = 300
+) -> Dict[str, Any]:
+    """
+    Replays ``calls`` against ``server`` and measures the latency.
+    
+    Args:
+        calls:      Pairs of method name and arguments.
+        cached:     Use :class:`~.cache.CachedIpernityAPI` with a fresh
+                    :class:`~.cache.MemoryCache`.
+        server:     The server to call.
+        repeat:     Number of times the calls are replayed.
+        threads:    Number of threads making calls.
+        max_age:    Cache lifetime.
+    Returns:
+        Dict with the number of ``calls``, ``upstream`` calls, ``duration``,
+        ``throughput`` in calls per second and the latency percentiles
+        ``p50``, ``p90`` and ``p99`` in milliseconds.
+    """
+    kwargs = {
+        'api_key':      'bench',
+        'api_secret':   'bench',
+        'auth':         'web',
+        'url':          server.url,
+    }
+    if cached:
+        api = CachedIpernityAPI(max_age, backend = MemoryCache(100000), **kwargs)
+    else:
+        api = FlaskIpernityAPI(**kwargs)
+    
+    def call(c: Tuple[str, Dict]) -> float:
+        start = perf_counter()
+        try:
+            api.call(c[0], **c[1])
+        except Exception as e:
+            log.debug('%s failed: %s', c[0], e)
+        return perf_counter() - start
+    
+    calls = list(calls) * repeat
+    upstream = server.calls
+    start = perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        latencies = sorted(executor.map(call, calls))
+    duration = perf_counter() - start
+    
+    def percentile(p: float) -> float:
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+    
+    return {
+        'calls':        len(calls),
+        'upstream':     server.calls - upstream,
+        'duration':     duration,
+        'throughput':   len(calls) / duration if duration else 0.0,
+        'p50':          percentile(0.5),
+        'p90':          percentile(0.9),
+        'p99':          percentile(0.99),
+    }
+
+
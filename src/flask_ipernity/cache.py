@@ -4,88 +4,1410 @@ This module provides cache functionality.
 
 from __future__ import annotations
 
+import atexit
+import gzip
+import json
+import os
+import re
+import struct
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from hashlib import blake2b
 from logging import getLogger
-from time import time
-from typing import Any, Dict, Mapping, TYPE_CHECKING
+from threading import Event, Lock, Thread
+from time import perf_counter, sleep, time
+from typing import (
+    Any, Callable, Dict, Iterable, Iterator, List, Mapping, Sequence, Tuple,
+    TYPE_CHECKING
+)
+from uuid import uuid4
 
-from ipernity import IpernityAPI
+from flask import session
+from ipernity import APIRequestError
 
+from .api import FlaskIpernityAPI, is_read_method
 from .ext import ipernity
+from .upstream import CircuitOpen, RateLimitExceeded
 
-# if TYPE_CHECKING:
+if TYPE_CHECKING:
+    from flask import Flask
 
 
 log = getLogger(__name__)
 
 
-class CachedIpernityAPI(IpernityAPI):
+class CacheBackend(ABC):
     """
-    Wrapper for :class:`~ipernity.IpernityAPI` that caches requests
-    in the Flask :class:`~flask.session`.
+    Base class for cache backends.
+    
+    The cache stores entries under string keys. An entry is a tuple whose
+    first two elements are the cached result and the time when it expires.
+    Backends may keep expired entries, they are still useful when Ipernity
+    is unavailable.
+    """
+    
+    #: Whether other processes see the same entries. Only these backends
+    #: can be managed with the ``flask ipernity cache`` commands.
+    process_shared = False
+    
+    @abstractmethod
+    def get(self, key: str) -> Tuple|None:
+        """Returns the entry for ``key``, or ``None`` if not found."""
+    
+    
+    def get_many(self, keys: Sequence[str]) -> List[Tuple|None]:
+        """
+        Returns the entries for several keys.
+        
+        The base implementation calls :meth:`get` for each key. Backends
+        override this to get all entries in one round-trip.
+        
+        Returns:
+            List with the entry for each key, or ``None`` if not found.
+        """
+        return [self.get(key) for key in keys]
+    
+    
+    @abstractmethod
+    def set(self, key: str, entry: Tuple):
+        """Stores ``entry`` under ``key``."""
+    
+    
+    @abstractmethod
+    def delete(self, key: str):
+        """Removes the entry for ``key``."""
+    
+    
+    @abstractmethod
+    def clear(self):
+        """Removes all entries."""
+    
+    
+    def items(self) -> Iterator[Tuple[str, Tuple]]:
+        """
+        Returns an iterator over all keys and entries.
+        
+        Used for snapshots (see :class:`CacheSnapshot`). The base
+        implementation raises :exc:`NotImplementedError`.
+        """
+        raise NotImplementedError(f'{type(self).__name__} cannot list its entries')
+    
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns statistics about the cache.
+        
+        The base implementation returns an empty dict.
+        """
+        return {}
+
+
+class SessionCache(CacheBackend):
+    """
+    Cache backend that stores the entries in the Flask :data:`~flask.session`.
+    
+    This is the default for user-specific results. As the session is stored
+    with each user, this requires a session handler with enough memory like
+    `Flask-Session`_.
+    """
+    
+    def _data(self, create: bool = False) -> Dict|None:
+        data = ipernity.session_get('cache', None)
+        if data is None and create:
+            log.debug('Initializing cache')
+            ipernity.session_set('cache', {})
+            data = ipernity.session_get('cache', None)
+        return data
+    
+    
+    def get(self, key: str) -> Tuple|None:
+        data = self._data()
+        if data is None:
+            return None
+        return data.get(key)
+    
+    
+    def get_many(self, keys: Sequence[str]) -> List[Tuple|None]:
+        data = self._data()
+        if data is None:
+            return [None] * len(keys)
+        return [data.get(key) for key in keys]
+    
+    
+    def set(self, key: str, entry: Tuple):
+        self._data(True)[key] = entry
+        session.modified = True
+    
+    
+    def delete(self, key: str):
+        data = self._data()
+        if data is not None and key in data:
+            del data[key]
+            session.modified = True
+    
+    
+    def clear(self):
+        ipernity.session_pop('cache', None)
+    
+    
+    def stats(self) -> Dict[str, Any]:
+        data = self._data()
+        return {'entries': len(data) if data is not None else 0}
+
+
+class MemoryCache(CacheBackend):
+    """
+    Cache backend that stores the entries in the memory of the process.
+    
+    The entries are shared by all threads of a worker process. If the cache
+    is full, the least recently used entries are removed.
+    
+    Args:
+        max_entries:    Maximum number of entries.
+    """
+    
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._data: OrderedDict[str, Tuple] = OrderedDict()
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+    
+    
+    def get(self, key: str) -> Tuple|None:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._data.move_to_end(key)
+            self._hits += 1
+            return entry
+    
+    
+    def get_many(self, keys: Sequence[str]) -> List[Tuple|None]:
+        entries = []
+        with self._lock:
+            for key in keys:
+                entry = self._data.get(key)
+                if entry is None:
+                    self._misses += 1
+                else:
+                    self._data.move_to_end(key)
+                    self._hits += 1
+                entries.append(entry)
+        return entries
+    
+    
+    def set(self, key: str, entry: Tuple):
+        with self._lock:
+            self._data[key] = entry
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last = False)
+    
+    
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+    
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    
+    def items(self) -> Iterator[Tuple[str, Tuple]]:
+        with self._lock:
+            return iter(list(self._data.items()))
+    
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'entries':      len(self._data),
+                'max_entries':  self.max_entries,
+                'hits':         self._hits,
+                'misses':       self._misses,
+            }
+
+
+class MmapCache(CacheBackend):
+    """
+    Cache backend in a memory-mapped file shared by all processes on a host.
+    
+    The file contains a fixed number of slots of fixed size, so its size is
+    bounded. Keys are hashed to a bucket of ``ways`` slots. If a bucket is
+    full, the expired or least recently used entry is replaced. Entries that
+    don't fit into a slot are not cached.
+    
+    Buckets are protected by lock stripes, which are ``fcntl`` record locks
+    between processes and thread locks within a process, so lookups of
+    different keys rarely wait for each other. If the file has a different
+    layout, e.g. after changing ``slots``, it is reinitialized.
+    
+    This backend is only available on POSIX systems.
+    
+    Args:
+        path:       Path of the cache file. It is created if necessary.
+        slots:      Number of slots.
+        slot_size:  Size of a slot in bytes, including a small header.
+        ways:       Number of slots per bucket.
+        stripes:    Number of locks.
+    """
+    
+    process_shared = True
+    
+    _magic = b'FIPCACH1'
+    # magic, slots, slot size, ways
+    _header = struct.Struct('<8sIII')
+    # key hash, expire time, last use, data length
+    _slot = struct.Struct('<QddI')
+    # The first page contains the header and the bytes used for locking
+    _data_offset = 4096
+    _lock_offset = 1024
+    
+    def __init__(
+        self,
+        path: str,
+        slots: int = 1024,
+        slot_size: int = 65536,
+        ways: int = 8,
+        stripes: int = 64
+    ):
+        import fcntl
+        import mmap
+        
+        self.path = path
+        self.ways = max(1, min(ways, slots))
+        self.buckets = max(1, slots // self.ways)
+        self.slots = self.buckets * self.ways
+        self.slot_size = slot_size
+        self._stripes = max(
+            1, min(stripes, self.buckets, self._data_offset - self._lock_offset)
+        )
+        self._locks = [Lock() for _ in range(self._stripes)]
+        self._stats_lock = Lock()
+        self._hits = 0
+        self._misses = 0
+        self._too_large = 0
+        
+        size = self._data_offset + self.slots * self.slot_size
+        header = self._header.pack(self._magic, self.slots, self.slot_size, self.ways)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if (
+                os.fstat(self._fd).st_size != size
+                or os.pread(self._fd, len(header), 0) != header
+            ):
+                log.debug('Initializing cache file %s', path)
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, header, 0)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._mmap = mmap.mmap(self._fd, size)
+    
+    
+    def get(self, key: str) -> Tuple|None:
+        h = self._hash(key)
+        prefix = self._prefix(key)
+        with self._locked(h % self.buckets, False):
+            offset = self._find(h, prefix)
+            if offset is not None:
+                struct.pack_into('<d', self._mmap, offset + 16, time())
+                length = self._slot.unpack_from(self._mmap, offset)[3]
+                start = offset + self._slot.size
+                data = self._mmap[start + len(prefix):start + length]
+        with self._stats_lock:
+            if offset is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+        return tuple(json.loads(data))
+    
+    
+    def set(self, key: str, entry: Tuple):
+        prefix = self._prefix(key)
+        data = prefix + json.dumps(entry).encode('utf-8')
+        if len(data) > self.slot_size - self._slot.size:
+            log.debug('Entry for %s is too large for the cache', key)
+            with self._stats_lock:
+                self._too_large += 1
+            self.delete(key)
+            return
+        
+        h = self._hash(key)
+        bucket = h % self.buckets
+        with self._locked(bucket, True):
+            offset = self._find(h, prefix)
+            if offset is None:
+                offset = self._victim(bucket)
+            start = offset + self._slot.size
+            self._mmap[start:start + len(data)] = data
+            self._slot.pack_into(self._mmap, offset, h, entry[1], time(), len(data))
+    
+    
+    def delete(self, key: str):
+        h = self._hash(key)
+        with self._locked(h % self.buckets, True):
+            offset = self._find(h, self._prefix(key))
+            if offset is not None:
+                self._slot.pack_into(self._mmap, offset, 0, 0.0, 0.0, 0)
+    
+    
+    def clear(self):
+        empty = self._slot.pack(0, 0.0, 0.0, 0)
+        for stripe in range(self._stripes):
+            with self._locked(stripe, True):
+                for bucket in range(stripe, self.buckets, self._stripes):
+                    for offset in self._bucket_slots(bucket):
+                        self._mmap[offset:offset + len(empty)] = empty
+    
+    
+    def items(self) -> Iterator[Tuple[str, Tuple]]:
+        for stripe in range(self._stripes):
+            found = []
+            with self._locked(stripe, False):
+                for bucket in range(stripe, self.buckets, self._stripes):
+                    for offset in self._bucket_slots(bucket):
+                        length = self._slot.unpack_from(self._mmap, offset)[3]
+                        if length:
+                            start = offset + self._slot.size
+                            found.append(self._mmap[start:start + length])
+            for data in found:
+                key, entry = data.split(b'\n', 1)
+                yield key.decode('utf-8'), tuple(json.loads(entry))
+    
+    
+    def stats(self) -> Dict[str, Any]:
+        now = time()
+        entries = expired = 0
+        for i in range(self.slots):
+            h, expire, used, length = self._slot.unpack_from(
+                self._mmap,
+                self._data_offset + i * self.slot_size
+            )
+            if length:
+                entries += 1
+                if expire < now:
+                    expired += 1
+        with self._stats_lock:
+            return {
+                'entries':      entries,
+                'expired':      expired,
+                'slots':        self.slots,
+                'slot_size':    self.slot_size,
+                'hits':         self._hits,
+                'misses':       self._misses,
+                'too_large':    self._too_large,
+            }
+    
+    
+    @staticmethod
+    def _hash(key: str) -> int:
+        # 0 marks empty slots
+        digest = blake2b(key.encode('utf-8'), digest_size = 8).digest()
+        h = int.from_bytes(digest, 'little')
+        return h or 1
+    
+    
+    def _bucket_slots(self, bucket: int) -> range:
+        start = self._data_offset + bucket * self.ways * self.slot_size
+        return range(start, start + self.ways * self.slot_size, self.slot_size)
+    
+    
+    @staticmethod
+    def _prefix(key: str) -> bytes:
+        # A slot's data is the key, a newline and the entry as JSON. Cache
+        # keys don't contain newlines.
+        return key.encode('utf-8') + b'\n'
+    
+    
+    def _find(self, h: int, prefix: bytes) -> int|None:
+        for offset in self._bucket_slots(h % self.buckets):
+            slot_hash, expire, used, length = self._slot.unpack_from(self._mmap, offset)
+            if slot_hash != h or length < len(prefix):
+                continue
+            start = offset + self._slot.size
+            if self._mmap[start:start + len(prefix)] == prefix:
+                return offset
+        return None
+    
+    
+    def _victim(self, bucket: int) -> int:
+        # Empty slot, else the entry that expired first, else the least
+        # recently used one
+        now = time()
+        best = None
+        best_rank = None
+        for offset in self._bucket_slots(bucket):
+            slot_hash, expire, used, length = self._slot.unpack_from(self._mmap, offset)
+            if not length:
+                return offset
+            rank = (0, expire) if expire < now else (1, used)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = offset, rank
+        return best
+    
+    
+    @contextmanager
+    def _locked(self, bucket: int, exclusive: bool) -> Iterator[None]:
+        import fcntl
+        
+        stripe = bucket % self._stripes
+        with self._locks[stripe]:
+            fcntl.lockf(
+                self._fd,
+                fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH,
+                1,
+                self._lock_offset + stripe
+            )
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self._lock_offset + stripe)
+
+
+class RedisCache(CacheBackend):
+    """
+    Cache backend that stores the entries in `Redis`_.
+    
+    The entries are shared by all processes using the same Redis database.
+    Results are stored as JSON.
+    
+    Args:
+        url:        Redis URL, e.g. ``redis://localhost:6379/0``.
+        prefix:     Prefix for the Redis keys.
+        keep:       Time in seconds that entries are kept after they expired.
+    """
+    
+    process_shared = True
+    
+    def __init__(
+        self,
+        url: str,
+        prefix: str = 'flask_ipernity:cache:',
+        keep: int = 3600
+    ):
+        import redis
+        self.prefix = prefix
+        self.keep = keep
+        self._redis = redis.Redis.from_url(url)
+        self._hits = 0
+        self._misses = 0
+    
+    
+    def get(self, key: str) -> Tuple|None:
+        data = self._redis.get(self.prefix + key)
+        if data is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        return tuple(json.loads(data))
+    
+    
+    def get_many(self, keys: Sequence[str]) -> List[Tuple|None]:
+        if not keys:
+            return []
+        entries = []
+        for data in self._redis.mget([self.prefix + key for key in keys]):
+            if data is None:
+                self._misses += 1
+                entries.append(None)
+            else:
+                self._hits += 1
+                entries.append(tuple(json.loads(data)))
+        return entries
+    
+    
+    def set(self, key: str, entry: Tuple):
+        self._redis.set(
+            self.prefix + key,
+            json.dumps(entry),
+            exat = int(entry[1] + self.keep)
+        )
+    
+    
+    def delete(self, key: str):
+        self._redis.delete(self.prefix + key)
+    
+    
+    def clear(self):
+        keys = list(self._redis.scan_iter(self.prefix + '*'))
+        if keys:
+            self._redis.delete(*keys)
+    
+    
+    def items(self) -> Iterator[Tuple[str, Tuple]]:
+        keys = []
+        for key in self._redis.scan_iter(self.prefix + '*'):
+            keys.append(key)
+            if len(keys) >= 100:
+                yield from self._items(keys)
+                keys = []
+        yield from self._items(keys)
+    
+    
+    def _items(self, keys: List[bytes]) -> Iterator[Tuple[str, Tuple]]:
+        if not keys:
+            return
+        for key, data in zip(keys, self._redis.mget(keys)):
+            if data is not None:
+                yield key.decode('utf-8')[len(self.prefix):], tuple(json.loads(data))
+    
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'entries':  sum(1 for _ in self._redis.scan_iter(self.prefix + '*')),
+            'hits':     self._hits,
+            'misses':   self._misses,
+        }
+
+
+class TieredCache(CacheBackend):
+    """
+    Two-level cache with a small in-process cache in front of a shared one.
+    
+    Entries read from or written to the shared ``l2`` backend are also kept
+    in the ``l1`` :class:`MemoryCache` for ``l1_timeout`` seconds, so
+    repeated lookups of popular keys don't need a round-trip to the shared
+    cache. Changes made by other processes are seen after ``l1_timeout``,
+    or immediately if an ``invalidation`` channel is given.
+    
+    Args:
+        l1:             The in-process cache.
+        l2:             The shared cache.
+        l1_timeout:     Time in seconds that entries are kept in ``l1``.
+        invalidation:   Broadcasts changed keys to the other processes.
+    """
+    
+    def __init__(
+        self,
+        l1: MemoryCache,
+        l2: CacheBackend,
+        l1_timeout: float = 5,
+        invalidation: RedisInvalidation|None = None
+    ):
+        self.l1 = l1
+        self.l2 = l2
+        self.l1_timeout = l1_timeout
+        self.invalidation = invalidation
+        self._lock = Lock()
+        self._l1_hits = 0
+        self._l2_hits = 0
+        self._misses = 0
+    
+    
+    @property
+    def process_shared(self) -> bool:
+        return self.l2.process_shared
+    
+    
+    def get(self, key: str) -> Tuple|None:
+        return self.get_many([key])[0]
+    
+    
+    def get_many(self, keys: Sequence[str]) -> List[Tuple|None]:
+        self._listen()
+        now = time()
+        entries = []
+        todo = []
+        for i, item in enumerate(self.l1.get_many(keys)):
+            if item is not None and now < item[1]:
+                entries.append(item[0])
+            else:
+                entries.append(None)
+                todo.append(i)
+        
+        l2_hits = 0
+        if todo:
+            for i, entry in zip(todo, self.l2.get_many([keys[i] for i in todo])):
+                if entry is not None:
+                    entries[i] = entry
+                    self.l1.set(keys[i], (entry, now + self.l1_timeout))
+                    l2_hits += 1
+        
+        with self._lock:
+            self._l1_hits += len(keys) - len(todo)
+            self._l2_hits += l2_hits
+            self._misses += len(todo) - l2_hits
+        return entries
+    
+    
+    def set(self, key: str, entry: Tuple):
+        self._listen()
+        self.l2.set(key, entry)
+        self.l1.set(key, (entry, time() + self.l1_timeout))
+        if self.invalidation is not None:
+            self.invalidation.publish(key)
+    
+    
+    def delete(self, key: str):
+        self._listen()
+        self.l2.delete(key)
+        self.l1.delete(key)
+        if self.invalidation is not None:
+            self.invalidation.publish(key)
+    
+    
+    def clear(self):
+        self.l2.clear()
+        self.l1.clear()
+        if self.invalidation is not None:
+            self.invalidation.publish(None)
+    
+    
+    def items(self) -> Iterator[Tuple[str, Tuple]]:
+        return self.l2.items()
+    
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns statistics about both levels.
+        
+        ``l1_hit_ratio`` is the share of lookups answered by ``l1``,
+        ``l2_hit_ratio`` the share of the remaining lookups answered by
+        ``l2``. The statistics of ``l2`` are prefixed with ``l2_``.
+        """
+        with self._lock:
+            lookups = self._l1_hits + self._l2_hits + self._misses
+            l2_lookups = lookups - self._l1_hits
+            l2_ratio = self._l2_hits / l2_lookups if l2_lookups else 0.0
+            res = {
+                'l1_entries':       self.l1.stats()['entries'],
+                'l1_hits':          self._l1_hits,
+                'l1_hit_ratio':     self._l1_hits / lookups if lookups else 0.0,
+                'l2_hits':          self._l2_hits,
+                'l2_hit_ratio':     l2_ratio,
+                'misses':           self._misses,
+            }
+        for key, value in self.l2.stats().items():
+            res.setdefault('l2_' + key, value)
+        return res
+    
+    
+    def _listen(self):
+        if self.invalidation is not None:
+            self.invalidation.listen(self._invalidate)
+    
+    
+    def _invalidate(self, key: str|None):
+        if key is None:
+            self.l1.clear()
+        else:
+            self.l1.delete(key)
+
+
+class RedisInvalidation():
+    """
+    Broadcasts changed cache keys between processes with Redis pub/sub.
+    
+    Used by :class:`TieredCache` to remove changed entries from the
+    in-process caches of all workers.
     
     Args:
-        timeout:    Time in seconds that cached results are considered valid.
-        args:       Passed to :class:`~ipernity.api.IpernityAPI`.
-        kwargs:     Passed to :class:`~ipernity.api.IpernityAPI`.
+        url:        Redis URL.
+        channel:    Name of the pub/sub channel.
+    """
+    
+    def __init__(self, url: str, channel: str = 'flask_ipernity:invalidate'):
+        import redis
+        self.channel = channel
+        self._redis = redis.Redis.from_url(url)
+        self._id = None
+        self._pid = None
+        self._thread = None
+    
+    
+    def publish(self, key: str|None):
+        """
+        Tells the other processes that ``key`` changed.
+        
+        ``None`` means that all keys changed.
+        """
+        message = f'{self._id} ' + ('*' if key is None else ':' + key)
+        self._redis.publish(self.channel, message)
+    
+    
+    def listen(self, callback: Callable[[str|None], None]):
+        """
+        Calls ``callback`` with the keys changed by other processes.
+        
+        Starts a background thread on the first call in each process. The
+        callback is called with ``None`` if all keys changed or messages may
+        have been lost.
+        """
+        if self._pid == os.getpid():
+            return
+        with _invalidation_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._id = f'{self._pid}-{uuid4().hex}'
+            log.debug('Starting cache invalidation listener')
+            self._thread = Thread(
+                target = self._run,
+                args = (callback,),
+                name = 'ipernity-cache-invalidation',
+                daemon = True
+            )
+            self._thread.start()
+    
+    
+    def _run(self, callback: Callable[[str|None], None]):
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages = True)
+                pubsub.subscribe(self.channel)
+                # Messages may have been lost while not subscribed
+                callback(None)
+                for message in pubsub.listen():
+                    sender, key = message['data'].decode('utf-8').split(' ', 1)
+                    if sender != self._id:
+                        callback(None if key == '*' else key[1:])
+            except Exception as e:
+                log.warning('Cache invalidation listener failed: %s', e)
+                sleep(1)
+
+
+_invalidation_lock = Lock()
+
+
+def make_backend(spec: str|CacheBackend, config: Mapping[str, Any]) -> CacheBackend:
     """
+    Creates a cache backend.
+    
+    Redis backends get an in-process :class:`TieredCache` level if
+    :data:`IPERNITY_CACHE_L1_MAX_AGE` is set.
+    
+    Args:
+        spec:   ``"session"``, ``"memory"``, ``"mmap:"`` followed by a file
+                path, a Redis URL or a :class:`CacheBackend` instance.
+        config: The Flask configuration.
+    """
+    if isinstance(spec, CacheBackend):
+        return spec
+    if spec == 'session':
+        return SessionCache()
+    if spec == 'memory':
+        return MemoryCache(config['IPERNITY_CACHE_MAX_ENTRIES'])
+    if spec.startswith('mmap:'):
+        return MmapCache(
+            spec[5:],
+            config['IPERNITY_CACHE_MMAP_SLOTS'],
+            config['IPERNITY_CACHE_MMAP_SLOT_SIZE']
+        )
+    if spec.startswith(('redis://', 'rediss://', 'unix://')):
+        backend = RedisCache(spec)
+        if not config['IPERNITY_CACHE_L1_MAX_AGE']:
+            return backend
+        return TieredCache(
+            MemoryCache(config['IPERNITY_CACHE_L1_MAX_ENTRIES']),
+            backend,
+            config['IPERNITY_CACHE_L1_MAX_AGE'],
+            RedisInvalidation(spec) if config['IPERNITY_CACHE_L1_INVALIDATE'] else None
+        )
+    raise ValueError(f'Unknown cache backend {spec}')
+
+
+class CachedIpernityAPI(FlaskIpernityAPI):
+    """
+    Wrapper for :class:`~ipernity.IpernityAPI` that caches requests.
+    
+    Results of calls with a user token are stored in
+    :attr:`Ipernity.cache_backend <flask_ipernity.Ipernity.cache_backend>`
+    (the Flask :class:`~flask.session` by default), results of anonymous
+    calls and calls with a service token in
+    :attr:`Ipernity.shared_cache <flask_ipernity.Ipernity.shared_cache>`.
+    Only results of read methods are cached (see
+    :func:`~flask_ipernity.api.is_read_method`), so authentication results
+    like the user's token from :ip:`auth.getToken` are never stored.
+    
+    Errors returned by Ipernity with one of the ``negative_codes`` (e.g.
+    "not found") are cached for ``negative_timeout`` seconds, and raised
+    again as :exc:`~ipernity.APIRequestError` on cache hits.
+    
+    With ``max_timeout``, the time that a result is valid adapts to how
+    often it changes. When a result is fetched again, it is compared with the
+    previous one by a fingerprint. If it is unchanged, its timeout is doubled
+    up to ``max_timeout``, otherwise it is halved down to ``timeout``. Cache
+    entries are then tuples ``(result, expire, timeout, fingerprint)``. The
+    previous entry is the expired one found by :meth:`lookup`, so storing a
+    result needs no further request to the cache.
+    
+    User results are stored by user ID and permissions rather than by token,
+    so they survive when a user authorizes again and gets a new token. Each
+    user's keys also contain a random generation stored in the cache, which
+    :meth:`invalidate_user` replaces to make all of the user's entries
+    unreachable at once.
+    
+    Args:
+        timeout:            Time in seconds that cached results are
+                            considered valid.
+        backend:            Use this backend for all calls instead of the
+                            application's backends.
+        negative_timeout:   Time in seconds that cached errors are considered
+                            valid, 0 disables caching of errors.
+        negative_codes:     Ipernity error codes that are cached.
+        max_timeout:        Upper limit for adaptive timeouts, ``None`` to
+                            always use ``timeout``.
+        args:               Passed to :class:`~ipernity.api.IpernityAPI`.
+        kwargs:             Passed to :class:`~ipernity.api.IpernityAPI`.
+    """
+    
+    #: Time in seconds that a user's generation is kept in the cache.
+    generation_timeout = 30 * 86400
     
     def __init__(
         self,
         timeout: int = 300,
         *args: Any,
+        backend: CacheBackend|None = None,
+        negative_timeout: int = 0,
+        negative_codes: Iterable[int] = (),
+        max_timeout: int|None = None,
         **kwargs: Any
     ):
         super().__init__(*args, **kwargs)
         self.timeout = timeout
+        self.backend = backend
+        self.negative_timeout = negative_timeout
+        self.negative_codes = frozenset(int(c) for c in negative_codes)
+        self.max_timeout = max_timeout
+        self._generations: Dict[str, str] = {}
+        self._expired: Dict[str, Tuple] = {}
     
     
     @property
-    def cache(self) -> Dict:
+    def cache(self) -> CacheBackend:
+        """
+        The cache backend used for this API object's calls.
         """
-        Dict for storing the cache.
+        if self.backend is not None:
+            return self.backend
+        if self.token is None or self.service:
+            return ipernity.shared_cache
+        return ipernity.cache_backend
+    
+    
+    def cache_key(self, method_name: str, kwargs: Mapping[str, Any]) -> str:
+        """
+        Returns the cache key for an API call.
         
-        This gives you direct access to the :class:`~flask.session` variable
-        containing the cached data. When modifying the dict, make sure to set
-        :attr:`~flask.session.modified` so that the changes will be saved.
+        All service tokens share the same keys, so results are reused
+        regardless of the token used for the call. See :meth:`identity`.
         """
-        cache = ipernity.session_get('cache', None)
-        if cache is None:
-            log.debug('Initializing cache')
-            ipernity.session_set('cache', {})
-            cache = ipernity.session_get('cache', None)
-        return cache
+        return method_name + self.identity() + repr(sorted(kwargs.items()))
+    
+    
+    def identity(self) -> str:
+        """
+        Returns the part of the cache keys that identifies the caller.
+        
+        If the token contains the user and permissions (as stored by
+        :meth:`Ipernity.set_token <flask_ipernity.Ipernity.set_token>`), this
+        is the user ID, a hash of the permissions and the user's generation.
+        Otherwise, the token itself is used.
+        """
+        if self.service:
+            return '<service>'
+        user = getattr(self, '_user', None)
+        if not user or 'user_id' not in user:
+            return repr(self.token)
+        user_id = str(user['user_id'])
+        perms = repr(sorted((getattr(self, '_perm', None) or {}).items()))
+        digest = blake2b(perms.encode('utf-8'), digest_size = 4).hexdigest()
+        return f'<user {user_id} {digest} {self._generation(user_id)}>'
+    
+    
+    def invalidate_user(self):
+        """
+        Makes all cached results of the current user unreachable.
+        
+        Only a new generation is stored, the old entries expire in the
+        backend.
+        """
+        user = getattr(self, '_user', None)
+        if self.service or not user or 'user_id' not in user:
+            return
+        self._generation(str(user['user_id']), True)
+    
+    
+    def _generation(self, user_id: str, new: bool = False) -> str:
+        if not new and user_id in self._generations:
+            return self._generations[user_id]
+        key = '<generation>' + user_id
+        entry = None if new else self.cache.get(key)
+        if entry is None:
+            # A lost generation also invalidates the user's entries
+            entry = (uuid4().hex[:8], time() + self.generation_timeout)
+            self.cache.set(key, entry)
+        self._generations[user_id] = entry[0]
+        return entry[0]
+    
+    
+    def lookup(self, method_name: str, kwargs: Mapping[str, Any]) -> Tuple[bool, Any]:
+        """
+        Returns a result from :attr:`cache` if it is still valid.
+        
+        Raises:
+            APIRequestError:    A cached error was found.
+        """
+        found, res = super().lookup(method_name, kwargs)
+        if found or not is_read_method(method_name):
+            return found, res
+        
+        start = perf_counter()
+        key = self.cache_key(method_name, kwargs)
+        return self._hit(method_name, kwargs, key, self.cache.get(key), start)
+    
+    
+    def lookup_many(
+        self,
+        calls: Sequence[Tuple[str, Mapping[str, Any]]]
+    ) -> List[Tuple[bool, Any]]:
+        """
+        Looks up several calls in one request to :attr:`cache`.
+        """
+        # Remembered results
+        results = []
+        for method_name, kwargs in calls:
+            try:
+                results.append(super().lookup(method_name, kwargs))
+            except Exception as e:
+                results.append((True, e))
+        todo = [
+            i for i, (found, res) in enumerate(results)
+            if not found and is_read_method(calls[i][0])
+        ]
+        if not todo:
+            return results
+        
+        start = perf_counter()
+        keys = [self.cache_key(calls[i][0], calls[i][1]) for i in todo]
+        entries = self.cache.get_many(keys)
+        for i, key, entry in zip(todo, keys, entries):
+            method_name, kwargs = calls[i]
+            try:
+                results[i] = self._hit(method_name, kwargs, key, entry, start)
+            except Exception as e:
+                results[i] = (True, e)
+        return results
+    
     
+    def _hit(
+        self,
+        method_name: str,
+        kwargs: Mapping[str, Any],
+        key: str,
+        entry: Tuple|None,
+        start: float
+    ) -> Tuple[bool, Any]:
+        if entry is None:
+            return False, None
+        if time() >= entry[1]:
+            self._keep_expired(key, entry)
+            return False, None
+        log.debug(
+            '%s(%s): returning result from cache',
+            method_name,
+            kwargs
+        )
+        self.trace(method_name, kwargs, 'hit', start, entry[0])
+        if self.metrics is not None:
+            self.metrics.incr('returns_from_cache')
+        return True, self._result(method_name, kwargs, entry[0])
+    
+    
+    def stale(self, method_name: str, kwargs: Mapping[str, Any]) -> Tuple[bool, Any]:
+        """
+        Returns a result from :attr:`cache` even if it has expired.
+        
+        Raises:
+            APIRequestError:    A cached error was found.
+        """
+        if not is_read_method(method_name):
+            return False, None
+        start = perf_counter()
+        entry = self.cache.get(self.cache_key(method_name, kwargs))
+        if entry is not None:
+            log.warning('%s(%s): returning stale result from cache', method_name, kwargs)
+            self.trace(method_name, kwargs, 'stale', start, entry[0])
+            return True, self._result(method_name, kwargs, entry[0])
+        return False, None
+    
+    
+    def store(self, method_name: str, kwargs: Mapping[str, Any], result: Dict):
+        """
+        Stores a result of a read method in :attr:`cache`.
+        """
+        if not is_read_method(method_name):
+            return
+        if self.metrics is not None:
+            self.metrics.incr('api_calls')
+        
+        key = self.cache_key(method_name, kwargs)
+        if not self.max_timeout or self.max_timeout <= self.timeout:
+            self.cache.set(key, (result, time() + self.timeout))
+            return
+        
+        fingerprint = blake2b(
+            json.dumps(result, sort_keys = True).encode('utf-8'),
+            digest_size = 8
+        ).hexdigest()
+        timeout = self.timeout
+        old = self._expired.pop(key, None)
+        if old is not None:
+            if old[3] == fingerprint:
+                timeout = min(old[2] * 2, self.max_timeout)
+                if self.metrics is not None:
+                    self.metrics.incr('ttl_extended')
+            else:
+                timeout = max(old[2] // 2, self.timeout)
+                if self.metrics is not None:
+                    self.metrics.incr('ttl_reduced')
+        self.cache.set(key, (result, time() + timeout, timeout, fingerprint))
+    
+    
+    def _keep_expired(self, key: str, entry: Tuple):
+        # Passed on to store, which adapts the timeout
+        if self.max_timeout and self.max_timeout > self.timeout and len(entry) >= 4:
+            self._expired[key] = entry
+    
+    
+    def store_error(
+        self,
+        method_name: str,
+        kwargs: Mapping[str, Any],
+        error: APIRequestError
+    ):
+        """
+        Stores an error in :attr:`cache` if its code is in ``negative_codes``.
+        
+        The error is stored in the format returned by Ipernity.
+        """
+        if (
+            not self.negative_timeout
+            or not is_read_method(method_name)
+            or error.status == 'httperror'
+            or error.code not in self.negative_codes
+        ):
+            return
+        
+        log.debug('%s(%s): caching error %s', method_name, kwargs, error.code)
+        key = self.cache_key(method_name, kwargs)
+        result = {'api': {
+            'status':   error.status,
+            'code':     str(error.code),
+            'message':  error.message,
+        }}
+        self.cache.set(key, (result, time() + self.negative_timeout))
+    
+    
+    def _result(self, method_name: str, kwargs: Mapping[str, Any], result: Dict) -> Dict:
+        # Raise cached errors
+        api = result.get('api', {})
+        if api.get('status', 'ok') != 'ok':
+            raise APIRequestError(
+                api['status'],
+                api['code'],
+                api['message'],
+                method_name,
+                kwargs
+            )
+        return result
+
+
+class CacheWarmer():
+    """
+    Refreshes cached results of anonymous API calls before they expire.
+    
+    The calls are made with
+    :meth:`Ipernity.make_service_api <flask_ipernity.Ipernity.make_service_api>`,
+    i.e. with a service token if configured.
+    The calls are configured in :data:`IPERNITY_CACHE_WARM`. Each call is
+    refreshed if its result is missing in
+    :attr:`Ipernity.shared_cache <flask_ipernity.Ipernity.shared_cache>` or
+    expires within two :data:`IPERNITY_CACHE_WARM_INTERVAL`. Failed calls
+    are retried with exponential backoff. The calls are subject to the rate
+    limit and circuit breaker.
+    
+    Args:
+        app:    The Flask application.
+    """
     
-    def call(self, method_name: str, **kwargs: Any) -> Dict:
+    def __init__(self, app: Flask):
+        self.app = app
+        self.calls: List[Tuple[str, Dict]] = [
+            (call['method'], dict(call.get('kwargs', {})))
+            if isinstance(call, Mapping) else
+            (call[0], dict(call[1] if len(call) > 1 else {}))
+            for call in app.config['IPERNITY_CACHE_WARM']
+        ]
+        self.interval = app.config['IPERNITY_CACHE_WARM_INTERVAL']
+        self._next_try = [0.0] * len(self.calls)
+        self._delay = [0.0] * len(self.calls)
+        self._stop = Event()
+        self._thread = None
+        self._start_lock = Lock()
+        self._pid = None
+    
+    
+    def warm(self, force: bool = False) -> List[Tuple[str, Dict, str]]:
         """
-        Makes an API call and caches the result.
+        Refreshes the results that are about to expire.
+        
+        Must be called within an application context.
         
-        The results are stored in the :attr:`cache` property.
+        Args:
+            force:  Refresh all results and ignore the backoff.
+        Returns:
+            List of ``(method, kwargs, status)`` with status ``"fresh"``,
+            ``"refreshed"``, ``"backoff"`` or an error message.
         """
-        key = method_name + repr(self.token) + repr(kwargs)
-        if key in self.cache:
-            res, expire = self.cache[key]
-            if time() < expire:
-                log.debug(
-                    '%s(%s): returning result from cache',
+        api = ipernity.make_service_api(cached = True)
+        timeout = self.app.config['IPERNITY_CACHE_MAX_AGE']
+        report = []
+        for i, (method_name, kwargs) in enumerate(self.calls):
+            now = time()
+            if not force:
+                if now < self._next_try[i]:
+                    report.append((method_name, kwargs, 'backoff'))
+                    continue
+                key = api.cache_key(method_name, kwargs)
+                entry = api.cache.get(key)
+                if entry is not None and entry[1] - now > 2 * self.interval:
+                    report.append((method_name, kwargs, 'fresh'))
+                    continue
+                if entry is not None:
+                    api._keep_expired(key, entry)
+            
+            try:
+                api.collect(
                     method_name,
-                    kwargs
+                    kwargs,
+                    partial(api.fetch, method_name, **kwargs)
                 )
-                ipernity.session_set(
-                    'returns_from_cache',
-                    ipernity.session_get('returns_from_cache', 0) + 1
+            except Exception as e:
+                log.warning('Warming %s(%s) failed: %s', method_name, kwargs, e)
+                self._delay[i] = min(
+                    max(2 * self._delay[i], self.interval),
+                    timeout
                 )
-                return res
+                self._next_try[i] = now + self._delay[i]
+                report.append((method_name, kwargs, str(e)))
+                if isinstance(e, (CircuitOpen, RateLimitExceeded)):
+                    # No use in trying the others now
+                    for j in range(i + 1, len(self.calls)):
+                        self._next_try[j] = max(self._next_try[j], self._next_try[i])
+                continue
+            
+            log.debug('Warmed %s(%s)', method_name, kwargs)
+            self._delay[i] = 0.0
+            self._next_try[i] = 0.0
+            report.append((method_name, kwargs, 'refreshed'))
         
-        res = super().call(method_name, **kwargs)
-        
-        # This will also set session.modified
-        ipernity.session_set(
-            'api_calls',
-            ipernity.session_get('api_calls', 0) + 1
-        )
+        return report
+    
+    
+    def start(self):
+        """
+        Starts a background thread that calls :meth:`warm` periodically.
         
-        self.cache[key] = (res, time() + self.timeout)
-        return res
+        Does nothing if the thread is already running in this process.
+        """
+        # start is called for each request, possibly in several threads
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            
+            log.debug('Starting cache warmer')
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = Thread(
+                target = self._run,
+                name = 'ipernity-cache-warmer',
+                daemon = True
+            )
+            self._thread.start()
+    
+    
+    def stop(self):
+        """Stops the background thread."""
+        self._stop.set()
+    
+    
+    def _run(self):
+        while not self._stop.is_set():
+            with self.app.app_context():
+                try:
+                    self.warm()
+                except Exception:
+                    log.exception('Error warming cache')
+            self._stop.wait(self.interval)
+
+
+# Cache keys of anonymous calls and calls with a service token, see
+# CachedIpernityAPI.cache_key
+_shared_key = re.compile(r'([A-Za-z.]+)(?:None|<service>)\[')
 
 
+def _is_shared_key(key: str) -> bool:
+    m = _shared_key.match(key)
+    return m is not None and is_read_method(m.group(1))
+
+
+class CacheSnapshot():
+    """
+    Saves the shared cache to a file and loads it after a restart.
+    
+    Snapshots contain the valid entries of
+    :attr:`Ipernity.shared_cache <flask_ipernity.Ipernity.shared_cache>` for
+    read methods called anonymously or with a service token. Other entries,
+    e.g. results stored by older versions or by custom API classes, are
+    neither saved nor loaded, so no user-specific results or tokens are
+    written to disk. Snapshots are gzipped JSON
+    lines: a header followed by one ``[key, entry]`` array per entry. Files
+    are replaced atomically, so a crash while saving doesn't destroy the last
+    snapshot.
+    
+    The snapshot is configured with :data:`IPERNITY_CACHE_SNAPSHOT` and
+    :data:`IPERNITY_CACHE_SNAPSHOT_INTERVAL`.
+    
+    Args:
+        app:    The Flask application.
+    """
+    
+    #: Version of the file format
+    version = 1
+    
+    def __init__(self, app: Flask):
+        self.app = app
+        self.path = app.config['IPERNITY_CACHE_SNAPSHOT']
+        self.interval = app.config['IPERNITY_CACHE_SNAPSHOT_INTERVAL']
+        self._stop = Event()
+        self._thread = None
+        self._start_lock = Lock()
+        self._pid = None
+    
+    
+    def save(self) -> int:
+        """
+        Writes the valid entries of the shared cache to the snapshot file.
+        
+        Must be called within an application context.
+        
+        Returns:
+            Number of entries written.
+        """
+        cache = ipernity.shared_cache
+        now = time()
+        tmp = f'{self.path}.{uuid4().hex}.tmp'
+        count = 0
+        try:
+            with gzip.open(tmp, 'wt', encoding = 'utf-8') as f:
+                f.write(json.dumps({'version': self.version, 'created': now}) + '\n')
+                for key, entry in cache.items():
+                    if entry[1] > now and _is_shared_key(key):
+                        f.write(json.dumps([key, entry]) + '\n')
+                        count += 1
+            os.replace(tmp, self.path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        log.debug('Saved %d cache entries to %s', count, self.path)
+        return count
+    
+    
+    def load(self) -> int:
+        """
+        Loads the entries from the snapshot file into the shared cache.
+        
+        Expired entries and entries that are already in the cache are
+        skipped. Must be called within an application context.
+        
+        Returns:
+            Number of entries loaded.
+        """
+        if not os.path.exists(self.path):
+            return 0
+        
+        cache = ipernity.shared_cache
+        now = time()
+        count = 0
+        with gzip.open(self.path, 'rt', encoding = 'utf-8') as f:
+            header = json.loads(f.readline() or '{}')
+            if header.get('version') != self.version:
+                log.warning('Ignoring cache snapshot %s with unknown format', self.path)
+                return 0
+            for line in f:
+                key, entry = json.loads(line)
+                if (
+                    entry[1] > now
+                    and _is_shared_key(key)
+                    and cache.get(key) is None
+                ):
+                    cache.set(key, tuple(entry))
+                    count += 1
+        log.debug('Loaded %d cache entries from %s', count, self.path)
+        return count
+    
+    
+    def start(self):
+        """
+        Loads the snapshot in a background thread and saves it periodically.
+        
+        The snapshot is also saved when the process exits. Does nothing if
+        the thread is already running in this process.
+        """
+        # start is called for each request, possibly in several threads
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            
+            log.debug('Starting cache snapshot thread')
+            if self._pid is None:
+                atexit.register(self._save_at_exit)
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = Thread(
+                target = self._run,
+                name = 'ipernity-cache-snapshot',
+                daemon = True
+            )
+            self._thread.start()
+    
+    
+    def stop(self):
+        """Stops the background thread."""
+        self._stop.set()
+    
+    
+    def _run(self):
+        with self.app.app_context():
+            try:
+                self.load()
+            except Exception:
+                log.exception('Error loading cache snapshot')
+        
+        while self.interval and not self._stop.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    self.save()
+                except Exception:
+                    log.exception('Error saving cache snapshot')
+    
+    
+    def _save_at_exit(self):
+        if self._pid != os.getpid():
+            return
+        with self.app.app_context():
+            try:
+                self.save()
+            except Exception:
+                log.exception('Error saving cache snapshot')
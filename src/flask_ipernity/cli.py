@@ -0,0 +1,300 @@
+"""
+This module provides the ``flask ipernity`` commands.
+"""
+
+from __future__ import annotations
+
+from logging import getLogger
+from typing import List
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from .ext import ipernity
+
+
+log = getLogger(__name__)
+
+
+ipernity_cli = AppGroup('ipernity', help = 'Flask-Ipernity commands.')
+
+cache_cli = AppGroup('cache', help = 'Manage the Ipernity cache.')
+ipernity_cli.add_command(cache_cli)
+
+index_cli = AppGroup('index', help = 'Manage the local metadata index.')
+ipernity_cli.add_command(index_cli)
+
+
+@cache_cli.command('stats')
+def stats():
+    """
+    Shows statistics of the cache backends, rate limiter and circuit breaker.
+    
+    Memory backends and metrics only show the data of the process running the
+    command.
+    """
+    from .cache import SessionCache
+    
+    if isinstance(ipernity.cache_backend, SessionCache):
+        user_stats = {'backend': 'session'}
+    else:
+        user_stats = ipernity.cache_backend.stats()
+    for name in _local_caches(user = True, shared = True):
+        click.echo(
+            f'Warning: the {name} is stored in each process, only the entries '
+            'of this command are shown',
+            err = True
+        )
+    sections = [
+        ('User cache', user_stats),
+        ('Shared cache', ipernity.shared_cache.stats()),
+        ('Metrics', ipernity.metrics.stats()),
+    ]
+    if ipernity.media_cache is not None:
+        sections.append(('Media cache', ipernity.media_cache.stats()))
+    if ipernity.limiter is not None:
+        sections.append(('Rate limiter', ipernity.limiter.stats()))
+    if ipernity.breaker is not None:
+        sections.append(('Circuit breaker', ipernity.breaker.stats()))
+    
+    for title, data in sections:
+        click.echo(f'{title}:')
+        for key, value in data.items():
+            click.echo(f'  {key}: {value}')
+
+
+@cache_cli.command('ttls')
+@click.option(
+    '--user', is_flag = True,
+    help = 'Show the cache for user-specific results instead of the shared cache.'
+)
+@click.option(
+    '--limit', default = 50, show_default = True,
+    help = 'Maximum number of entries to show.'
+)
+def ttls(user: bool, limit: int):
+    """
+    Shows the timeouts chosen for cached results.
+    
+    Lists the entries with the longest timeouts first. With
+    IPERNITY_CACHE_ADAPTIVE_MAX_AGE, these are the results that changed least
+    often.
+    """
+    from time import time
+    from .cache import SessionCache
+    
+    backend = ipernity.cache_backend if user else ipernity.shared_cache
+    if isinstance(backend, SessionCache):
+        raise click.ClickException('User cache is stored in the session')
+    try:
+        entries = list(backend.items())
+    except NotImplementedError as e:
+        raise click.ClickException(str(e))
+    
+    now = time()
+    rows = []
+    for key, entry in entries:
+        ttl = entry[2] if len(entry) >= 4 else None
+        rows.append((ttl, entry[1] - now, key))
+    rows.sort(key = lambda r: (r[0] or 0, r[1]), reverse = True)
+    adaptive = sum(1 for r in rows if r[0] is not None)
+    click.echo(f'{len(rows)} entries, {adaptive} with adaptive timeout')
+    click.echo(f'{"ttl":>8} {"remaining":>9}  key')
+    for ttl, remaining, key in rows[:limit]:
+        click.echo(f'{ttl if ttl is not None else "-":>8} {remaining:9.0f}  {key}')
+
+
+@cache_cli.command('purge')
+@click.option(
+    '--user/--no-user', default = True,
+    help = 'Purge the cache for user-specific results.'
+)
+@click.option(
+    '--shared/--no-shared', default = True,
+    help = 'Purge the cache for anonymous results.'
+)
+@click.option(
+    '--media/--no-media', default = True,
+    help = 'Purge the media files of the document proxy.'
+)
+def purge(user: bool, shared: bool, media: bool):
+    """
+    Removes all entries from the cache.
+    
+    Session caches can only be removed by the users' sessions. Caches that
+    are stored in each process, like the ``memory`` backend, are emptied by
+    restarting the application.
+    """
+    from .cache import SessionCache
+    
+    local = _local_caches(user, shared)
+    if user:
+        if isinstance(ipernity.cache_backend, SessionCache):
+            click.echo('User cache is stored in the session, skipping')
+        elif 'user cache' not in local:
+            ipernity.cache_backend.clear()
+            click.echo('User cache purged')
+    if shared and 'shared cache' not in local:
+        ipernity.shared_cache.clear()
+        click.echo('Shared cache purged')
+    if media and ipernity.media_cache is not None:
+        ipernity.media_cache.clear()
+        click.echo('Media cache purged')
+    if local:
+        raise click.ClickException(
+            f'The {" and ".join(local)} cannot be purged, they are stored in '
+            'each process. Restart the application instead.'
+        )
+
+
+def _local_caches(user: bool, shared: bool) -> List[str]:
+    """
+    Returns the names of the caches that are not shared by the processes.
+    
+    The commands run in a process of their own and cannot see or change these
+    caches. The session cache is not included.
+    """
+    from .cache import SessionCache
+    
+    names = []
+    backend = ipernity.cache_backend
+    if user and not isinstance(backend, SessionCache) and not backend.process_shared:
+        names.append('user cache')
+    if shared and not ipernity.shared_cache.process_shared:
+        names.append('shared cache')
+    return names
+
+
+@cache_cli.command('save')
+def save():
+    """
+    Saves the shared cache to IPERNITY_CACHE_SNAPSHOT.
+    """
+    if not current_app.config['IPERNITY_CACHE_SNAPSHOT']:
+        raise click.ClickException('IPERNITY_CACHE_SNAPSHOT is not set')
+    count = ipernity.snapshot.save()
+    click.echo(f'Saved {count} entries to {ipernity.snapshot.path}')
+
+
+@cache_cli.command('load')
+def load():
+    """
+    Loads the shared cache from IPERNITY_CACHE_SNAPSHOT.
+    """
+    if not current_app.config['IPERNITY_CACHE_SNAPSHOT']:
+        raise click.ClickException('IPERNITY_CACHE_SNAPSHOT is not set')
+    count = ipernity.snapshot.load()
+    click.echo(f'Loaded {count} entries from {ipernity.snapshot.path}')
+
+
+@cache_cli.command('bench')
+@click.option(
+    '--calls', 'calls_file', type = click.Path(exists = True, dir_okay = False),
+    help = 'File with recorded calls, one JSON object per line.'
+)
+@click.option(
+    '--repeat', default = 20, show_default = True,
+    help = 'Number of times the calls are replayed.'
+)
+@click.option(
+    '--threads', default = 1, show_default = True,
+    help = 'Number of concurrent threads.'
+)
+@click.option(
+    '--latency', default = 0.05, show_default = True,
+    help = 'Latency of the fake Ipernity server in seconds.'
+)
+def bench(calls_file: str|None, repeat: int, threads: int, latency: float):
+    """
+    Benchmarks cached and uncached calls against a local fake Ipernity.
+    
+    Replays a call mix against a local server emulating Ipernity and reports
+    throughput and latency percentiles with and without cache.
+    """
+    from .bench import default_calls, load_calls, run_benchmark
+    from .fakeserver import FakeIpernity
+    
+    calls = load_calls(calls_file) if calls_file else default_calls
+    click.echo(
+        f'Replaying {len(calls)} calls {repeat} times with {threads} threads, '
+        f'latency {latency * 1000:.0f} ms'
+    )
+    click.echo(
+        f'{"mode":10} {"calls":>7} {"upstream":>9} {"calls/s":>9} '
+        f'{"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8}'
+    )
+    with FakeIpernity(latency = latency) as server:
+        for mode, cached in (('uncached', False), ('cached', True)):
+            res = run_benchmark(
+                calls,
+                cached,
+                server,
+                repeat,
+                threads,
+                current_app.config['IPERNITY_CACHE_MAX_AGE']
+            )
+            click.echo(
+                f'{mode:10} {res["calls"]:7d} {res["upstream"]:9d} '
+                f'{res["throughput"]:9.1f} {res["p50"]:8.2f} {res["p90"]:8.2f} '
+                f'{res["p99"]:8.2f}'
+            )
+
+
+@cache_cli.command('warm')
+@click.option(
+    '--force', is_flag = True,
+    help = 'Refresh all results, even if they are still valid.'
+)
+def warm(force: bool):
+    """
+    Refreshes the results configured in IPERNITY_CACHE_WARM.
+    
+    Use this in a cron job to keep a shared cache warm.
+    """
+    errors = 0
+    for method_name, kwargs, status in ipernity.warmer.warm(force):
+        if status not in ('fresh', 'refreshed', 'backoff'):
+            errors += 1
+        click.echo(f'{method_name}({kwargs}): {status}')
+    if errors:
+        raise click.ClickException(f'{errors} calls failed')
+
+
+@index_cli.command('sync')
+@click.option(
+    '--full', is_flag = True,
+    help = 'List all documents and remove deleted ones.'
+)
+def index_sync(full: bool):
+    """
+    Updates IPERNITY_INDEX from Ipernity.
+    
+    Use this in a cron job if IPERNITY_INDEX_SYNC_INTERVAL is not set.
+    """
+    if not current_app.config['IPERNITY_INDEX']:
+        raise click.ClickException('IPERNITY_INDEX is not set')
+    counts = ipernity.index.sync(full)
+    click.echo(
+        f'{counts["docs"]} documents and {counts["albums"]} albums updated, '
+        f'{counts["deleted"]} deleted'
+    )
+
+
+@index_cli.command('stats')
+def index_stats():
+    """
+    Shows the number of indexed items and the last sync of each account.
+    """
+    from datetime import datetime
+    
+    if not current_app.config['IPERNITY_INDEX']:
+        raise click.ClickException('IPERNITY_INDEX is not set')
+    stats = ipernity.index.stats()
+    click.echo(f'Documents: {stats["docs"]}')
+    click.echo(f'Albums: {stats["albums"]}')
+    for account, last_sync in stats['accounts'].items():
+        synced = datetime.fromtimestamp(last_sync)
+        click.echo(f'Account {account}: synced {synced:%Y-%m-%d %H:%M:%S}')
+
+
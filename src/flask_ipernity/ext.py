@@ -4,15 +4,30 @@ This module defines the Flask extension.
 
 from __future__ import annotations
 
-from functools import wraps
+from functools import partial, wraps
+from itertools import cycle
 from logging import getLogger
-from typing import Any, Callable, Dict, Mapping, TYPE_CHECKING
+from threading import Lock
+from time import monotonic
+from typing import (
+    Any, Callable, Dict, Iterable, Iterator, List, Mapping, Tuple, TYPE_CHECKING
+)
 
-from flask import Flask, Response, redirect, current_app, g, request, session
-from ipernity import IpernityAPI
+from flask import (
+    Flask, Response, redirect, current_app, g, has_request_context, request,
+    session
+)
 from werkzeug.local import LocalProxy
 
-# if TYPE_CHECKING:
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+    from .api import FlaskIpernityAPI
+    from .cache import CacheBackend, CacheSnapshot, CacheWarmer
+    from .index import MetadataIndex
+    from .mediacache import MediaCache
+    from .metrics import Metrics
+    from .tracing import CallTracer
+    from .upstream import CircuitBreaker, UpstreamLimiter
 
 
 log = getLogger(__name__)
@@ -21,16 +36,59 @@ log = getLogger(__name__)
 default_flask_options = {
     'IPERNITY_API_KEY': None,
     'IPERNITY_API_SECRET': None,
+    'IPERNITY_API_URL': 'https://api.ipernity.com/api/',
+    'IPERNITY_BREAKER_HALF_OPEN_CALLS': 1,
+    'IPERNITY_BREAKER_RESET_TIMEOUT': 30,
+    'IPERNITY_BREAKER_SLOW_CALL': None,
+    'IPERNITY_BREAKER_THRESHOLD': None,
+    'IPERNITY_CACHE_ADAPTIVE_MAX_AGE': None,
+    'IPERNITY_CACHE_BACKEND': 'session',
+    'IPERNITY_CACHE_L1_INVALIDATE': False,
+    'IPERNITY_CACHE_L1_MAX_AGE': None,
+    'IPERNITY_CACHE_L1_MAX_ENTRIES': 1000,
     'IPERNITY_CACHE_REQUESTS': False,
+    'IPERNITY_CACHE_SNAPSHOT': None,
+    'IPERNITY_CACHE_SNAPSHOT_INTERVAL': 300,
     'IPERNITY_CACHE_MAX_AGE': 300,
+    'IPERNITY_CACHE_MAX_ENTRIES': 1000,
+    'IPERNITY_CACHE_MMAP_SLOTS': 1024,
+    'IPERNITY_CACHE_MMAP_SLOT_SIZE': 65536,
+    'IPERNITY_CACHE_NEGATIVE_CODES': [1, 2],
+    'IPERNITY_CACHE_NEGATIVE_MAX_AGE': 60,
+    'IPERNITY_CACHE_WARM': [],
+    'IPERNITY_CACHE_WARM_INTERVAL': 60,
+    'IPERNITY_CACHE_WARM_THREAD': False,
     'IPERNITY_CALLBACK': True,
     'IPERNITY_CALLBACK_URL_PREFIX': '/ipernity',
+    'IPERNITY_INDEX': None,
+    'IPERNITY_INDEX_ACCOUNTS': [],
+    'IPERNITY_INDEX_FULL_SYNC_INTERVAL': 86400,
+    'IPERNITY_INDEX_SYNC_INTERVAL': None,
     'IPERNITY_LOGIN': False,
+    'IPERNITY_LIMIT_TIMEOUT': 10,
     'IPERNITY_LOGIN_URL_PREFIX': '/ipernity',
+    'IPERNITY_MAX_CONCURRENCY': None,
+    'IPERNITY_MAX_WORKERS': 4,
+    'IPERNITY_MEDIA_CACHE_DIR': None,
+    'IPERNITY_MEDIA_CACHE_MAX_AGE': 86400,
+    'IPERNITY_MEDIA_CACHE_MAX_SIZE': None,
+    'IPERNITY_MEMOIZE': True,
+    'IPERNITY_METRICS': None,
     'IPERNITY_PERMISSIONS': {},
     'IPERNITY_PROXY_DOCS': True,
+    'IPERNITY_PROXY_SIGNED_MAX_AGE': 3600,
+    'IPERNITY_PROXY_TIMEOUT': 30,
     'IPERNITY_PROXY_URL_PREFIX': '/ipernity',
+    'IPERNITY_PROXY_ZIP_WORKERS': 4,
+    'IPERNITY_RATE_LIMIT': None,
+    'IPERNITY_RATE_LIMIT_BURST': None,
+    'IPERNITY_RATE_LIMIT_STORAGE': None,
+    'IPERNITY_SERVICE_TOKEN': None,
     'IPERNITY_SESSION_PREFIX': 'ipernity_',
+    'IPERNITY_SHARED_CACHE_BACKEND': 'memory',
+    'IPERNITY_TRACE': False,
+    'IPERNITY_TRACE_HEADER': True,
+    'IPERNITY_TRACE_OPENTELEMETRY': False,
 }
 
 
@@ -68,6 +126,7 @@ class Ipernity():
         """
         log.debug('Initializing Ipernity with app %s', app.name)
         app.extensions['ipernity'] = self
+        app.extensions['ipernity_state'] = _AppState()
         
         # Default configuration
         for option, value in default_flask_options.items():
@@ -98,6 +157,23 @@ class Ipernity():
             )
             init_login(app)
         
+        if app.config['IPERNITY_CACHE_WARM_THREAD']:
+            # Start the thread in the worker process, not before forking
+            app.before_request(self._start_warmer)
+        
+        if app.config['IPERNITY_CACHE_SNAPSHOT']:
+            app.before_request(self._start_snapshot)
+        
+        if app.config['IPERNITY_INDEX'] and app.config['IPERNITY_INDEX_SYNC_INTERVAL']:
+            app.before_request(self._start_index)
+        
+        if app.config['IPERNITY_TRACE']:
+            from .tracing import trace_response
+            app.after_request(trace_response)
+        
+        from .cli import ipernity_cli
+        app.cli.add_command(ipernity_cli)
+        
         # 
         app.context_processor(_context_processor)
     
@@ -147,6 +223,10 @@ class Ipernity():
             frob = request.args.get('frob')
         log.debug('Got frob %s', frob)
         
+        # Authenticate as the user, not with a service token
+        if self.api.service:
+            g.ipernity_api = self.make_api(None)
+        
         # Get token and save it to session and API
         self.session_set('token', self.api.auth.getToken(frob)['auth'])
     
@@ -156,44 +236,572 @@ class Ipernity():
         Logs out of Ipernity.
         
         Deletes all session variables starting with :data:`IPERNITY_SESSION_PREFIX`
-        and removes the API token.
+        and removes the API token. The user's cached results are invalidated.
+        Afterwards, :attr:`api` uses the service token, if configured.
         """
+        if not self.api.service:
+            self.api.invalidate_user()
         for key in list(session):
             if key.startswith(current_app.config['IPERNITY_SESSION_PREFIX']):
                 del session[key]
-        self.api.token = None
-
+        api = g.pop('ipernity_api', None)
+        if api is not None and not api.service:
+            api.token = None
+    
     
     @property
-    def api(self) -> IpernityAPI:
+    def api(self) -> FlaskIpernityAPI:
         """
         The current Ipernity API.
         
+        The API uses the user's token from the session. Without a user token,
+        e.g. for anonymous users or outside of requests, the API from
+        :meth:`make_service_api` is used.
+        
         Depending on :data:`IPERNITY_CACHE_REQUESTS`, the type is
-        :class:`~ipernity.api.IpernityAPI` or
+        :class:`~flask_ipernity.api.FlaskIpernityAPI` or
         :class:`~flask_ipernity.cache.CachedIpernityAPI`.
         """
         if 'ipernity_api' not in g:
-            log.debug('Creating IpernityAPI object')
-            kwargs = {
-                'api_key':      current_app.config['IPERNITY_APP_KEY'],
-                'api_secret':   current_app.config['IPERNITY_APP_SECRET'],
-                'token':        self.session_get('token'),
-                'auth':         'web',
-            }
-
-            if current_app.config['IPERNITY_CACHE_REQUESTS']:
-                from .cache import CachedIpernityAPI
-                g.ipernity_api = CachedIpernityAPI(
-                    current_app.config['IPERNITY_CACHE_MAX_AGE'],
-                    **kwargs
-                )
+            token = None
+            if has_request_context():
+                token = self.session_get('token')
+            if token is None:
+                g.ipernity_api = self.make_service_api()
             else:
-                g.ipernity_api = IpernityAPI(**kwargs)
+                g.ipernity_api = self.make_api(token)
         
         return g.ipernity_api
     
     
+    def make_api(
+        self,
+        token: str|Mapping|None = None,
+        cached: bool|None = None,
+        service: bool = False,
+        memoize: bool|None = None
+    ) -> FlaskIpernityAPI:
+        """
+        Creates a new API object.
+        
+        Unlike :attr:`api`, this does not need a request context and can be
+        used in background jobs. Inside a request, the calls are recorded by
+        :attr:`tracer`.
+        
+        Args:
+            token:      The API token, ``None`` for anonymous calls.
+            cached:     Cache the results. If ``None``,
+                        :data:`IPERNITY_CACHE_REQUESTS` is used.
+            service:    ``token`` is a service token. The results are cached
+                        in :attr:`shared_cache`.
+            memoize:    Remember the results of read methods in the API
+                        object. If ``None``, :data:`IPERNITY_MEMOIZE` is
+                        used. Pass ``False`` for objects that are used for
+                        a long time.
+        """
+        log.debug('Creating IpernityAPI object')
+        if memoize is None:
+            memoize = current_app.config['IPERNITY_MEMOIZE']
+        kwargs = {
+            'api_key':      current_app.config['IPERNITY_APP_KEY'],
+            'api_secret':   current_app.config['IPERNITY_APP_SECRET'],
+            'token':        token,
+            'auth':         'web',
+            'url':          current_app.config['IPERNITY_API_URL'],
+            'limiter':      self.limiter,
+            'breaker':      self.breaker,
+            'tracer':       self.tracer,
+            'metrics':      self.metrics,
+            'service':      service,
+            'memoize':      memoize,
+        }
+        
+        if cached is None:
+            cached = current_app.config['IPERNITY_CACHE_REQUESTS']
+        if cached:
+            from .cache import CachedIpernityAPI
+            return CachedIpernityAPI(
+                current_app.config['IPERNITY_CACHE_MAX_AGE'],
+                negative_timeout = current_app.config['IPERNITY_CACHE_NEGATIVE_MAX_AGE'],
+                negative_codes = current_app.config['IPERNITY_CACHE_NEGATIVE_CODES'],
+                max_timeout = current_app.config['IPERNITY_CACHE_ADAPTIVE_MAX_AGE'],
+                **kwargs
+            )
+        else:
+            from .api import FlaskIpernityAPI
+            return FlaskIpernityAPI(**kwargs)
+    
+    
+    def make_service_api(self, cached: bool|None = None) -> FlaskIpernityAPI:
+        """
+        Creates an API object for calls without a user.
+        
+        The API uses the next token from :data:`IPERNITY_SERVICE_TOKEN`. If no
+        service token is configured, the API is anonymous.
+        
+        Args:
+            cached:     See :meth:`make_api`.
+        """
+        token = self.next_service_token()
+        return self.make_api(token, cached, token is not None)
+    
+    
+    def next_service_token(self) -> str|Mapping|None:
+        """
+        Returns a service token from :data:`IPERNITY_SERVICE_TOKEN`.
+        
+        If several tokens are configured, they are used in turn.
+        
+        Returns:
+            The token, or ``None`` if no service token is configured.
+        """
+        state = _state()
+        with state.lock:
+            if state.service_tokens is None:
+                tokens = current_app.config['IPERNITY_SERVICE_TOKEN']
+                if tokens is None:
+                    return None
+                if isinstance(tokens, (str, Mapping)):
+                    tokens = [tokens]
+                state.service_tokens = cycle(tokens)
+            return next(state.service_tokens)
+    
+    
+    @property
+    def cache_backend(self) -> CacheBackend:
+        """
+        Cache for results of calls with a user token.
+        
+        The backend is created on first use from
+        :data:`IPERNITY_CACHE_BACKEND`.
+        """
+        state = _state()
+        with state.lock:
+            if state.cache_backend is None:
+                from .cache import make_backend
+                state.cache_backend = make_backend(
+                    current_app.config['IPERNITY_CACHE_BACKEND'],
+                    current_app.config
+                )
+        return state.cache_backend
+    
+    
+    @property
+    def shared_cache(self) -> CacheBackend:
+        """
+        Cache for results of anonymous calls.
+        
+        The backend is created on first use from
+        :data:`IPERNITY_SHARED_CACHE_BACKEND`.
+        """
+        state = _state()
+        with state.lock:
+            if state.shared_cache is None:
+                from .cache import make_backend, SessionCache
+                state.shared_cache = make_backend(
+                    current_app.config['IPERNITY_SHARED_CACHE_BACKEND'],
+                    current_app.config
+                )
+                if isinstance(state.shared_cache, SessionCache):
+                    state.shared_cache = None
+                    raise ValueError('Shared cache cannot be stored in the session')
+        return state.shared_cache
+    
+    
+    @property
+    def media_cache(self) -> MediaCache|None:
+        """
+        Media cache of the document proxy.
+        
+        Created on first use if :data:`IPERNITY_MEDIA_CACHE_DIR` is set.
+        Otherwise, this is ``None``.
+        """
+        config = current_app.config
+        if not config['IPERNITY_MEDIA_CACHE_DIR']:
+            return None
+        
+        state = _state()
+        with state.lock:
+            if state.media_cache is None:
+                from .mediacache import MediaCache
+                state.media_cache = MediaCache(
+                    config['IPERNITY_MEDIA_CACHE_DIR'],
+                    config['IPERNITY_MEDIA_CACHE_MAX_AGE'],
+                    config['IPERNITY_MEDIA_CACHE_MAX_SIZE']
+                )
+        return state.media_cache
+    
+    
+    @property
+    def warmer(self) -> CacheWarmer:
+        """
+        Cache warmer for the calls in :data:`IPERNITY_CACHE_WARM`.
+        """
+        state = _state()
+        with state.lock:
+            if state.warmer is None:
+                from .cache import CacheWarmer
+                state.warmer = CacheWarmer(current_app._get_current_object())
+        return state.warmer
+    
+    
+    def _start_warmer(self):
+        self.warmer.start()
+    
+    
+    @property
+    def snapshot(self) -> CacheSnapshot:
+        """
+        Snapshots of the shared cache in :data:`IPERNITY_CACHE_SNAPSHOT`.
+        """
+        state = _state()
+        with state.lock:
+            if state.snapshot is None:
+                from .cache import CacheSnapshot
+                state.snapshot = CacheSnapshot(current_app._get_current_object())
+        return state.snapshot
+    
+    
+    def _start_snapshot(self):
+        self.snapshot.start()
+    
+    
+    @property
+    def index(self) -> MetadataIndex:
+        """
+        Local index of the accounts in :data:`IPERNITY_INDEX_ACCOUNTS`.
+        
+        Use its query methods, e.g. :meth:`~.index.MetadataIndex.docs`, to
+        list documents without calling Ipernity.
+        """
+        state = _state()
+        with state.lock:
+            if state.index is None:
+                from .index import MetadataIndex
+                state.index = MetadataIndex(current_app._get_current_object())
+        return state.index
+    
+    
+    def _start_index(self):
+        self.index.start()
+    
+    
+    @property
+    def limiter(self) -> UpstreamLimiter|None:
+        """
+        Limiter for calls to Ipernity.
+        
+        The limiter is shared by all requests and created on first use from
+        :data:`IPERNITY_RATE_LIMIT`, :data:`IPERNITY_MAX_CONCURRENCY` and
+        related options. If neither is set, this is ``None``.
+        """
+        config = current_app.config
+        if not config['IPERNITY_RATE_LIMIT'] and not config['IPERNITY_MAX_CONCURRENCY']:
+            return None
+        
+        state = _state()
+        
+        with state.lock:
+            if state.limiter is None:
+                from .upstream import RedisTokenBucket, TokenBucket, UpstreamLimiter
+                
+                bucket = None
+                if config['IPERNITY_RATE_LIMIT']:
+                    if config['IPERNITY_RATE_LIMIT_STORAGE']:
+                        log.debug('Creating shared rate limiter')
+                        bucket = RedisTokenBucket(
+                            config['IPERNITY_RATE_LIMIT_STORAGE'],
+                            config['IPERNITY_RATE_LIMIT'],
+                            config['IPERNITY_RATE_LIMIT_BURST']
+                        )
+                    else:
+                        log.debug('Creating rate limiter')
+                        bucket = TokenBucket(
+                            config['IPERNITY_RATE_LIMIT'],
+                            config['IPERNITY_RATE_LIMIT_BURST']
+                        )
+                
+                state.limiter = UpstreamLimiter(
+                    bucket,
+                    config['IPERNITY_MAX_CONCURRENCY'],
+                    config['IPERNITY_LIMIT_TIMEOUT']
+                )
+        return state.limiter
+    
+    
+    @property
+    def breaker(self) -> CircuitBreaker|None:
+        """
+        Circuit breaker for calls to Ipernity.
+        
+        The breaker is shared by all requests and created on first use if
+        :data:`IPERNITY_BREAKER_THRESHOLD` is set. Otherwise, this is ``None``.
+        Use :meth:`~flask_ipernity.upstream.CircuitBreaker.stats` to observe
+        the breaker's state.
+        """
+        config = current_app.config
+        if not config['IPERNITY_BREAKER_THRESHOLD']:
+            return None
+        
+        state = _state()
+        
+        with state.lock:
+            if state.breaker is None:
+                log.debug('Creating circuit breaker')
+                from .upstream import CircuitBreaker
+                state.breaker = CircuitBreaker(
+                    config['IPERNITY_BREAKER_THRESHOLD'],
+                    config['IPERNITY_BREAKER_RESET_TIMEOUT'],
+                    config['IPERNITY_BREAKER_SLOW_CALL'],
+                    config['IPERNITY_BREAKER_HALF_OPEN_CALLS']
+                )
+        return state.breaker
+    
+    
+    @property
+    def metrics(self) -> Metrics:
+        """
+        Counters for cache hits and calls to Ipernity.
+        
+        This is :data:`IPERNITY_METRICS` if set, otherwise a
+        :class:`~flask_ipernity.metrics.Metrics` object created on first use.
+        """
+        state = _state()
+        with state.lock:
+            if state.metrics is None:
+                state.metrics = current_app.config['IPERNITY_METRICS']
+                if state.metrics is None:
+                    from .metrics import Metrics
+                    state.metrics = Metrics()
+        return state.metrics
+    
+    
+    @property
+    def tracer(self) -> CallTracer|None:
+        """
+        Records the API calls of the current request.
+        
+        This is ``None`` outside of requests or if :data:`IPERNITY_TRACE` is
+        not set.
+        """
+        if not has_request_context() or not current_app.config['IPERNITY_TRACE']:
+            return None
+        if 'ipernity_tracer' not in g:
+            from .tracing import CallTracer
+            g.ipernity_tracer = CallTracer()
+        return g.ipernity_tracer
+    
+    
+    @property
+    def executor(self) -> Executor:
+        """
+        Thread pool for concurrent API calls.
+        
+        The pool is shared by all requests and created on first use with
+        :data:`IPERNITY_MAX_WORKERS` threads.
+        """
+        state = _state()
+        with state.lock:
+            if state.executor is None:
+                log.debug('Creating thread pool')
+                from concurrent.futures import ThreadPoolExecutor
+                state.executor = ThreadPoolExecutor(
+                    max_workers = current_app.config['IPERNITY_MAX_WORKERS'],
+                    thread_name_prefix = 'ipernity'
+                )
+        return state.executor
+    
+    
+    def call_many(
+        self,
+        calls: Iterable[Tuple[str, Mapping[str, Any]]],
+        timeout: float|None = None
+    ) -> List[Any]:
+        """
+        Makes several API calls concurrently.
+        
+        The calls are made with the current request's token. Cached results
+        are taken from the cache in one round-trip (see
+        :meth:`~flask_ipernity.cache.CacheBackend.get_many`), the remaining
+        calls are run in
+        :attr:`executor`. If the circuit breaker is open, outdated results
+        are returned if available. Only the requests to Ipernity run in the worker
+        threads, the cache and Flask's :data:`~flask.g` and
+        :data:`~flask.session` are only accessed from the calling thread.
+        
+        Example:
+        
+        .. code-block:: python
+            
+            user, docs = ipernity.call_many([
+                ('user.get', {'user_id': user_id}),
+                ('doc.getList', {'user_id': user_id}),
+            ])
+        
+        Args:
+            calls:      Pairs of method name and arguments.
+            timeout:    Maximum time in seconds to wait for all results.
+        Returns:
+            List with the result of each call, or the exception it raised.
+        """
+        api = self.api
+        calls = [(method_name, dict(kwargs)) for method_name, kwargs in calls]
+        results = [None] * len(calls)
+        futures = {}
+        for i, (found, res) in enumerate(api.lookup_many(calls)):
+            if found:
+                results[i] = res
+            else:
+                method_name, kwargs = calls[i]
+                futures[i] = self.executor.submit(api.fetch, method_name, **kwargs)
+        
+        log.debug('Running %d of %d calls concurrently', len(futures), len(calls))
+        deadline = None if timeout is None else monotonic() + timeout
+        for i, future in futures.items():
+            method_name, kwargs = calls[i]
+            remaining = None if deadline is None else max(0, deadline - monotonic())
+            try:
+                results[i] = api.collect(
+                    method_name,
+                    kwargs,
+                    partial(future.result, remaining)
+                )
+            except Exception as e:
+                results[i] = e
+        
+        return results
+    
+    
+    def prefetch(
+        self,
+        calls: Iterable[Tuple[str, Mapping[str, Any]]],
+        timeout: float|None = None
+    ):
+        """
+        Loads the results of several API calls for the rest of the request.
+        
+        The results are loaded like in :meth:`call_many` and kept in
+        :attr:`api` (see :meth:`~flask_ipernity.api.FlaskIpernityAPI.remember`),
+        so later calls with the same arguments neither access the cache nor
+        Ipernity. Use this before rendering a template that makes many
+        calls, so that the template renders after one cache round-trip.
+        Errors returned by Ipernity are raised when the call is made. Other
+        errors, like timeouts or an open circuit breaker, are not kept, so
+        the call is made again.
+        
+        Example:
+        
+        .. code-block:: python
+            
+            ipernity.prefetch(('doc.get', {'doc_id': id}) for id in doc_ids)
+            return render_template('docs.html', doc_ids = doc_ids)
+        
+        Args:
+            calls:      Pairs of method name and arguments.
+            timeout:    Maximum time in seconds to wait for all results.
+        """
+        from ipernity import APIRequestError
+        from .api import is_read_method
+        
+        api = self.api
+        calls = [(method_name, dict(kwargs)) for method_name, kwargs in calls]
+        for (method_name, kwargs), res in zip(calls, self.call_many(calls, timeout)):
+            # Kept like the memoized results of FlaskIpernityAPI.collect
+            if not is_read_method(method_name):
+                continue
+            if isinstance(res, Exception) and (
+                not isinstance(res, APIRequestError) or res.status == 'httperror'
+            ):
+                continue
+            api.remember(method_name, kwargs, res)
+    
+    
+    def iter_pages(
+        self,
+        method_name: str,
+        prefetch: bool = False,
+        api: FlaskIpernityAPI|None = None,
+        **kwargs: Any
+    ) -> Iterator[Dict]:
+        """
+        Iterates over all items of a paged list method.
+        
+        Pages are requested when they are needed, so only one page at a time
+        is kept in memory. Each page is a separate API call and is cached
+        individually.
+        
+        Example:
+        
+        .. code-block:: python
+            
+            for doc in ipernity.iter_pages(
+                'album.docs.getList',
+                album_id = album_id,
+                per_page = 100
+            ):
+                ...
+        
+        Args:
+            method_name:    API method returning a paged list, e.g.
+                            :ip:`album.docs.getList` or :ip:`doc.search`.
+            prefetch:       Load the next page in :attr:`executor` while the
+                            current page is processed.
+            api:            API object making the calls, :attr:`api` if
+                            ``None``. Use :meth:`make_api` outside of
+                            requests.
+            kwargs:         API arguments. ``page`` is the first page to get.
+        Returns:
+            Iterator over the list items.
+        """
+        from .paging import iter_pages
+        return iter_pages(method_name, prefetch, api, **kwargs)
+    
+    
+    def list_response(
+        self,
+        method_name: str,
+        ndjson: bool = False,
+        prefetch: bool = True,
+        **kwargs: Any
+    ) -> Response:
+        """
+        Returns a streamed response with all items of a paged list method.
+        
+        The items are sent as a JSON array or as newline-delimited JSON while
+        the pages are loaded with :meth:`iter_pages`, so the response starts
+        after the first page is available and only one page at a time is kept
+        in memory. Errors on the first page abort the request like in the
+        document proxy: with ``404 Not Found`` if Ipernity doesn't find the
+        object, ``502 Bad Gateway`` for other API errors and
+        ``503 Service Unavailable`` if the circuit breaker is open or the
+        rate limit is exceeded. Errors on later pages abort the response.
+        
+        Example:
+        
+        .. code-block:: python
+            
+            @app.route('/albums/<album_id>/docs')
+            def album_docs(album_id):
+                return ipernity.list_response(
+                    'album.docs.getList',
+                    album_id = album_id,
+                    per_page = 100
+                )
+        
+        Args:
+            method_name:    API method returning a paged list.
+            ndjson:         Send newline-delimited JSON
+                            (``application/x-ndjson``) instead of a JSON
+                            array.
+            prefetch:       See :meth:`iter_pages`.
+            kwargs:         API arguments.
+        Returns:
+            The streamed response.
+        """
+        from .paging import list_response
+        return list_response(method_name, ndjson, prefetch, **kwargs)
+    
+    
     def session_get(self, key: str, default: Any = None) -> Any:
         """
         Returns a session variable.
@@ -214,12 +822,16 @@ class Ipernity():
         Sets a session variable.
         
         :data:`IPERNITY_SESSION_PREFIX` is automatically prepended to ``key``.
+        The session is only modified if the value changes.
         
         Args:
             key:    Name of the session variable.
             value:  New value for variable.
         """
-        session[current_app.config['IPERNITY_SESSION_PREFIX'] + key] = value
+        key = current_app.config['IPERNITY_SESSION_PREFIX'] + key
+        if key in session and session[key] == value:
+            return
+        session[key] = value
     
     
     def session_pop(self, key: str, default: Any = None) -> Any:
@@ -238,8 +850,13 @@ class Ipernity():
 
 
 def _context_processor() -> Dict:
+    from .images import img, srcset
+    from .proxy import signed_url
     return {
-        'ipernity': ipernity,
+        'ipernity':             ipernity,
+        'ipernity_img':         img,
+        'ipernity_signed_url':  signed_url,
+        'ipernity_srcset':      srcset,
     }
 
 
@@ -247,6 +864,33 @@ def _get_ipernity() -> Ipernity:
     return current_app.extensions['ipernity']
 
 
+class _AppState():
+    """
+    Objects created by Flask-Ipernity for one application.
+    
+    They are kept in ``app.extensions['ipernity_state']``, so that an
+    :class:`Ipernity` object can be initialized for several applications.
+    """
+    
+    def __init__(self):
+        self.breaker: CircuitBreaker|None = None
+        self.cache_backend: CacheBackend|None = None
+        self.executor: Executor|None = None
+        self.index: MetadataIndex|None = None
+        self.limiter: UpstreamLimiter|None = None
+        self.media_cache: MediaCache|None = None
+        self.metrics: Metrics|None = None
+        self.service_tokens: Iterator|None = None
+        self.shared_cache: CacheBackend|None = None
+        self.snapshot: CacheSnapshot|None = None
+        self.warmer: CacheWarmer|None = None
+        self.lock = Lock()
+
+
+def _state() -> _AppState:
+    return current_app.extensions['ipernity_state']
+
+
 # Proxy for the current :class:`Ipernity` instance.
 ipernity: Ipernity = LocalProxy(_get_ipernity)
 
@@ -269,7 +913,8 @@ def ipernity_auth_required(permissions: Mapping[str,str]|None = None) -> Callabl
             nonlocal permissions
             if permissions is None:
                 permissions = current_app.config['IPERNITY_PERMISSIONS']
-            if not ipernity.api.has_permissions(permissions):
+            api = ipernity.api
+            if api.service or not api.has_permissions(permissions):
                 return ipernity.authorize(permissions)
             return f(*args, **kwargs)
         
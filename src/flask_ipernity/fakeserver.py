@@ -0,0 +1,320 @@
+"""
+This module provides a local stand-in for the Ipernity API.
+
+:class:`FakeIpernity` runs an HTTP server in a background thread that answers
+API calls with generated data and serves generated media files. It is used
+for benchmarks and tests that should not depend on the real Ipernity service.
+"""
+
+from __future__ import annotations
+
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+from threading import Lock, Thread
+from time import sleep
+from typing import Any, Dict, Mapping
+from urllib.parse import parse_qsl, urlparse
+
+
+log = getLogger(__name__)
+
+
+class FakeIpernity():
+    """
+    Local HTTP server emulating the Ipernity API.
+    
+    Use it as a context manager or call :meth:`start` and :meth:`stop`.
+    Pass :attr:`url` as ``url`` to :class:`~ipernity.IpernityAPI`, or set it
+    as :data:`IPERNITY_API_URL`.
+    
+    List methods (e.g. ``doc.search`` or ``album.docs.getList``) return
+    paged results with ``total`` documents. ``doc_id=0`` or ``album_id=0``
+    returns Ipernity's "not found" error. :ip:`album.getList` returns
+    ``albums`` albums, each containing all documents. :ip:`doc.getMedias` returns the
+    URLs of media files served by the server under ``/media/``, like
+    Ipernity's CDN.
+    
+    Args:
+        latency:        Delay in seconds before each response.
+        total:          Number of documents in lists.
+        albums:         Number of albums returned by :ip:`album.getList`.
+        padding:        Size in bytes of the ``description`` of each
+                        document, to control the payload size.
+        media_size:     Size of the original media files in bytes. Thumbnails
+                        are scaled down according to their width.
+        host:           Address to listen on.
+        port:           Port to listen on, 0 means any free port.
+    """
+    
+    # Thumbnail labels and widths
+    thumbs = {
+        '75x': 75, '100': 100, '240': 240, '500': 500,
+        '560': 560, '640': 640, '800': 800, '1024': 1024, '1600': 1600,
+    }
+    original_width = 2048
+    
+    def __init__(
+        self,
+        latency: float = 0.0,
+        total: int = 100,
+        albums: int = 3,
+        padding: int = 0,
+        media_size: int = 1024 * 1024,
+        host: str = '127.0.0.1',
+        port: int = 0
+    ):
+        self.latency = latency
+        self.total = total
+        self.albums = albums
+        self.padding = padding
+        self.media_size = media_size
+        self.calls = 0
+        self.media_calls = 0
+        self._lock = Lock()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = None
+    
+    
+    def __enter__(self) -> FakeIpernity:
+        self.start()
+        return self
+    
+    
+    def __exit__(self, *args: Any):
+        self.stop()
+    
+    
+    @property
+    def base_url(self) -> str:
+        """The server's base URL."""
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/'
+    
+    
+    @property
+    def url(self) -> str:
+        """The API URL."""
+        return self.base_url + 'api/'
+    
+    
+    def start(self):
+        """Starts the server in a background thread."""
+        log.debug('Starting fake Ipernity server at %s', self.base_url)
+        self._thread = Thread(
+            target = self._server.serve_forever,
+            name = 'fake-ipernity',
+            daemon = True
+        )
+        self._thread.start()
+    
+    
+    def stop(self):
+        """Stops the server."""
+        self._server.shutdown()
+        self._server.server_close()
+    
+    
+    def respond(self, method_name: str, params: Mapping[str, str]) -> Dict:
+        """
+        Returns the result of an API call.
+        
+        Override this to customize the results.
+        """
+        for key in ('doc_id', 'album_id'):
+            if params.get(key) == '0':
+                return _error(1, 'Not found')
+        
+        if method_name in ('auth.getToken', 'auth.checkToken'):
+            return {'auth': {
+                'token':        params.get('auth_token', 'fake-token'),
+                'user':         self._user('1'),
+                'permissions':  {
+                    'doc': 'read', 'blog': 'none', 'network': 'none',
+                    'profile': 'none', 'post': 'none',
+                },
+            }}
+        if method_name == 'user.get':
+            return {'user': self._user(params.get('user_id', '1'))}
+        if method_name == 'doc.get':
+            return {'doc': self._doc(params['doc_id'])}
+        if method_name == 'doc.getMedias':
+            return self._medias(params['doc_id'])
+        if method_name in ('album.get', 'album.docs.getList'):
+            album = {'album_id': params['album_id'], 'title': 'Album'}
+            if method_name == 'album.docs.getList':
+                album['docs'] = self._docs(params)
+            return {'album': album}
+        if method_name == 'album.getList':
+            return {'albums': self._albums(params)}
+        if method_name.endswith(('.getList', '.search', '.getPopular', '.getRecent')):
+            return {'docs': self._docs(params)}
+        return {}
+    
+    
+    def _user(self, user_id: str) -> Dict:
+        return {
+            'user_id':  user_id,
+            'username': f'user{user_id}',
+            'realname': f'User {user_id}',
+        }
+    
+    
+    def _doc(self, doc_id: str) -> Dict:
+        return {
+            'doc_id':       doc_id,
+            'title':        f'Document {doc_id}',
+            'description':  'x' * self.padding,
+            'media':        'photo',
+            'owner':        self._user('1'),
+        }
+    
+    
+    def _docs(self, params: Mapping[str, str]) -> Dict:
+        page = int(params.get('page', 1))
+        per_page = int(params.get('per_page', 20))
+        pages = max(1, (self.total + per_page - 1) // per_page)
+        first = (page - 1) * per_page
+        last = min(self.total, first + per_page)
+        return {
+            'page':     str(page),
+            'pages':    str(pages),
+            'per_page': str(per_page),
+            'total':    str(self.total),
+            'doc':      [self._doc(str(i + 1)) for i in range(first, last)],
+        }
+    
+    
+    def _albums(self, params: Mapping[str, str]) -> Dict:
+        page = int(params.get('page', 1))
+        per_page = int(params.get('per_page', 20))
+        pages = max(1, (self.albums + per_page - 1) // per_page)
+        first = (page - 1) * per_page
+        last = min(self.albums, first + per_page)
+        return {
+            'page':     str(page),
+            'pages':    str(pages),
+            'per_page': str(per_page),
+            'total':    str(self.albums),
+            'album':    [
+                {
+                    'album_id': str(i + 1),
+                    'title':    f'Album {i + 1}',
+                    'count':    {'docs': str(self.total)},
+                }
+                for i in range(first, last)
+            ],
+        }
+    
+    
+    def _medias(self, doc_id: str) -> Dict:
+        height = self.original_width * 3 // 4
+        return {
+            'doc_id':   doc_id,
+            'thumbs':   {'thumb': [
+                {
+                    'label':    label,
+                    'w':        str(w),
+                    'h':        str(w * 3 // 4),
+                    'ext':      '.jpg',
+                    'url':      f'{self.base_url}media/{doc_id}/{label}.jpg',
+                }
+                for label, w in self.thumbs.items()
+            ]},
+            'original': {
+                'w':        str(self.original_width),
+                'h':        str(height),
+                'filename': f'IMG_{doc_id}.jpg',
+                'url':      f'{self.base_url}media/{doc_id}/original.jpg',
+            },
+        }
+    
+    
+    def media(self, doc_id: str, label: str) -> bytes|int|None:
+        """
+        Returns the content of a media file, or ``None`` if not found.
+        
+        Override this to customize the media files. An ``int`` is sent as
+        HTTP error status.
+        """
+        if label == 'original':
+            return b'\xff' * self.media_size
+        if label not in self.thumbs:
+            return None
+        scale = self.thumbs[label] / self.original_width
+        return b'\xff' * max(1, int(self.media_size * scale * scale))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    
+    protocol_version = 'HTTP/1.1'
+    
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.startswith('/media/'):
+            self._media(url.path)
+        else:
+            self._api(url.path, dict(parse_qsl(url.query)))
+    
+    
+    def do_POST(self):
+        length = int(self.headers.get('content-length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        self._api(urlparse(self.path).path, dict(parse_qsl(body)))
+    
+    
+    def _api(self, path: str, params: Dict[str, str]):
+        fake: FakeIpernity = self.server.fake
+        with fake._lock:
+            fake.calls += 1
+        if fake.latency:
+            sleep(fake.latency)
+        
+        parts = path.strip('/').split('/')
+        if len(parts) != 3 or parts[0] != 'api':
+            self.send_error(404)
+            return
+        
+        result = fake.respond(parts[1], params)
+        result.setdefault('api', {'status': 'ok', 'at': '0'})
+        self._send(200, 'application/json', json.dumps(result).encode('utf-8'))
+    
+    
+    def _media(self, path: str):
+        fake: FakeIpernity = self.server.fake
+        with fake._lock:
+            fake.media_calls += 1
+        if fake.latency:
+            sleep(fake.latency)
+        
+        parts = path.strip('/').split('/')
+        data = None
+        if len(parts) == 3:
+            data = fake.media(parts[1], parts[2].rsplit('.', 1)[0])
+        if data is None:
+            self.send_error(404)
+            return
+        if isinstance(data, int):
+            self.send_error(data)
+            return
+        self._send(200, 'image/jpeg', data)
+    
+    
+    def _send(self, status: int, content_type: str, data: bytes):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    
+    def log_message(self, format: str, *args: Any):
+        log.debug(format, *args)
+
+
+def _error(code: int, message: str) -> Dict:
+    return {'api': {'status': 'error', 'code': str(code), 'message': message}}
+
+
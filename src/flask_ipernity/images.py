@@ -0,0 +1,159 @@
+"""
+This module provides template helpers for responsive images.
+"""
+
+from __future__ import annotations
+
+from logging import getLogger
+from typing import Any, List, NamedTuple
+
+from flask import url_for
+from markupsafe import Markup
+
+from .ext import ipernity
+
+
+log = getLogger(__name__)
+
+
+class Thumb(NamedTuple):
+    """
+    A thumbnail size of a document.
+    """
+    
+    #: Label used by the document proxy, e.g. ``'500'``.
+    label: str
+    #: Width in pixels.
+    width: int
+    #: Height in pixels.
+    height: int
+
+
+def thumbs(doc_id: int|str) -> List[Thumb]:
+    """
+    Returns the thumbnails of a document, smallest first.
+    
+    The sizes are read with :ip:`doc.getMedias`, so they are cached like
+    other calls. Square thumbnails (labels ending with ``x``) are left out,
+    as they are cropped.
+    """
+    medias = ipernity.api.doc.getMedias(doc_id = doc_id)
+    result = [
+        Thumb(t['label'], int(t['w']), int(t['h']))
+        for t in medias.get('thumbs', {}).get('thumb', [])
+        if not t['label'].endswith('x')
+    ]
+    result.sort(key = lambda t: t.width)
+    return result
+
+
+def pick_thumb(available: List[Thumb], width: int) -> Thumb|None:
+    """
+    Returns the smallest thumbnail that is at least ``width`` pixels wide.
+    
+    If no thumbnail is wide enough, the largest one is returned, if there
+    are none, ``None``.
+    
+    Args:
+        available:  Thumbnails sorted by width, see :func:`thumbs`.
+        width:      Display width in pixels.
+    """
+    for thumb in available:
+        if thumb.width >= width:
+            return thumb
+    return available[-1] if available else None
+
+
+def srcset(doc_id: int|str, max_width: int|None = None, signed: bool = False) -> str:
+    """
+    Returns a ``srcset`` attribute value for a document.
+    
+    Lists the proxy URLs of the thumbnails with their widths. The browser
+    then loads the smallest one that fits the size given in the ``sizes``
+    attribute. Use it in templates as ``ipernity_srcset``.
+    
+    Args:
+        doc_id:     Ipernity document ID.
+        max_width:  Leave out thumbnails larger than the smallest one that is
+                    at least this wide.
+        signed:     Use signed URLs, see
+                    :func:`~flask_ipernity.proxy.signed_url`.
+    """
+    return _srcset(doc_id, thumbs(doc_id), max_width, signed)
+
+
+def img(
+    doc_id: int|str,
+    width: int,
+    sizes: str|None = None,
+    density: float = 2,
+    signed: bool = False,
+    **attrs: Any
+) -> Markup:
+    """
+    Returns an ``<img>`` tag for a document shown ``width`` pixels wide.
+    
+    ``src`` is the smallest thumbnail that is at least ``width`` pixels wide,
+    ``srcset`` lists the thumbnails up to ``density`` times that width for
+    high resolution screens. If the document has no thumbnails, ``src`` is
+    the original file. Use it in templates as ``ipernity_img``:
+    
+    .. code-block:: html+jinja
+        
+        {{ ipernity_img(doc.doc_id, 240, alt = doc.title, class = 'thumb') }}
+    
+    Args:
+        doc_id:     Ipernity document ID.
+        width:      Display width in pixels.
+        sizes:      Value of the ``sizes`` attribute, by default ``width``
+                    pixels.
+        density:    Largest pixel density to provide thumbnails for.
+        signed:     Use signed URLs, see
+                    :func:`~flask_ipernity.proxy.signed_url`.
+        attrs:      Other attributes of the tag. Underscores are replaced
+                    by dashes, trailing underscores are removed (e.g.
+                    ``class_`` in Python code).
+    """
+    available = thumbs(doc_id)
+    thumb = pick_thumb(available, width) or _original(doc_id)
+    attributes = {
+        'src':      _url(doc_id, thumb.label, signed),
+        'srcset':   _srcset(doc_id, available, int(width * density), signed) or None,
+        'sizes':    sizes or f'{width}px',
+        'width':    width,
+        'height':   round(width * thumb.height / thumb.width) if thumb.width else None,
+    }
+    for key, value in attrs.items():
+        attributes[key.rstrip('_').replace('_', '-')] = value
+    return Markup('<img {}>').format(Markup(' ').join(
+        Markup('{}="{}"').format(key, value)
+        for key, value in attributes.items()
+        if value is not None
+    ))
+
+
+def _srcset(
+    doc_id: int|str,
+    available: List[Thumb],
+    max_width: int|None,
+    signed: bool
+) -> str:
+    if max_width is not None and available:
+        largest = pick_thumb(available, max_width)
+        available = [t for t in available if t.width <= largest.width]
+    return ', '.join(
+        f'{_url(doc_id, t.label, signed)} {t.width}w'
+        for t in available
+    )
+
+
+def _original(doc_id: int|str) -> Thumb:
+    original = ipernity.api.doc.getMedias(doc_id = doc_id).get('original', {})
+    return Thumb('original', int(original.get('w', 0)), int(original.get('h', 0)))
+
+
+def _url(doc_id: int|str, label: str, signed: bool) -> str:
+    if signed:
+        from .proxy import signed_url
+        return signed_url(doc_id, label)
+    return url_for('ip_proxy.doc', doc_id = doc_id, label = label)
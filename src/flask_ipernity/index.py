@@ -0,0 +1,485 @@
+"""
+This module provides a local SQLite index of Ipernity metadata.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+from hashlib import blake2b
+from itertools import islice
+from logging import getLogger
+from threading import Event, Lock, Thread, local
+from time import time
+from typing import Any, Dict, Iterator, List, Mapping, Tuple, TYPE_CHECKING
+
+from .ext import ipernity
+from .paging import iter_pages
+
+if TYPE_CHECKING:
+    from flask import Flask
+    from .api import FlaskIpernityAPI
+
+
+log = getLogger(__name__)
+
+
+_schema = """
+CREATE TABLE IF NOT EXISTS docs (
+    doc_id      TEXT PRIMARY KEY,
+    account     TEXT NOT NULL,
+    title       TEXT,
+    description TEXT,
+    media       TEXT,
+    posted_at   INTEGER,
+    fingerprint TEXT NOT NULL,
+    data        TEXT NOT NULL,
+    synced_at   REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS docs_account ON docs (account, posted_at);
+CREATE TABLE IF NOT EXISTS albums (
+    album_id    TEXT PRIMARY KEY,
+    account     TEXT NOT NULL,
+    title       TEXT,
+    description TEXT,
+    fingerprint TEXT NOT NULL,
+    data        TEXT NOT NULL,
+    synced_at   REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS album_docs (
+    album_id    TEXT NOT NULL,
+    doc_id      TEXT NOT NULL,
+    position    INTEGER NOT NULL,
+    PRIMARY KEY (album_id, doc_id)
+);
+CREATE INDEX IF NOT EXISTS album_docs_doc ON album_docs (doc_id);
+CREATE TABLE IF NOT EXISTS accounts (
+    account     TEXT PRIMARY KEY,
+    full_sync   REAL,
+    last_sync   REAL
+);
+"""
+
+
+class MetadataIndex():
+    """
+    Mirrors the documents and albums of Ipernity accounts in SQLite.
+    
+    The accounts are configured with :data:`IPERNITY_INDEX_ACCOUNTS`. Their
+    documents are listed with :ip:`doc.getList`, their albums with
+    :ip:`album.getList` and :ip:`album.docs.getList`. The original items are
+    stored as JSON, so the query methods return the same dicts as the API.
+    
+    :meth:`sync` is incremental: as :ip:`doc.getList` lists the newest
+    documents first, it stops at the first page without changes. Albums are
+    listed completely, but their documents are only requested if an album
+    has changed. A full sync also removes documents that were deleted on
+    Ipernity. It is made every :data:`IPERNITY_INDEX_FULL_SYNC_INTERVAL`
+    seconds.
+    
+    Each thread uses its own connection. The database is opened in WAL mode,
+    so requests can read it while a sync is running. The background thread
+    started by :meth:`start` holds a lock on a ``.lock`` file next to the
+    database, so only one process of a host syncs at a time.
+    
+    Args:
+        app:    The Flask application.
+    """
+    
+    def __init__(self, app: Flask):
+        self.app = app
+        self.path = app.config['IPERNITY_INDEX']
+        self.accounts = list(app.config['IPERNITY_INDEX_ACCOUNTS'])
+        self.interval = app.config['IPERNITY_INDEX_SYNC_INTERVAL']
+        self.full_interval = app.config['IPERNITY_INDEX_FULL_SYNC_INTERVAL']
+        self.per_page = 100
+        self._local = local()
+        self._sync_lock = Lock()
+        self._stop = Event()
+        self._thread = None
+        self._start_lock = Lock()
+        self._pid = None
+        self._lock_fd = None
+    
+    
+    @property
+    def db(self) -> sqlite3.Connection:
+        """The database connection of the current thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout = 30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.executescript(_schema)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+    
+    
+    def sync(self, full: bool = False) -> Dict[str, int]:
+        """
+        Updates the index from Ipernity.
+        
+        Must be called within an application context. Concurrent calls in the
+        same process wait for each other.
+        
+        Args:
+            full:   List all documents and remove deleted ones. A full sync is
+                    also made for accounts that were never synced or whose
+                    last full sync is older than
+                    :data:`IPERNITY_INDEX_FULL_SYNC_INTERVAL`.
+        Returns:
+            Number of ``docs`` and ``albums`` added or changed, and number of
+            ``deleted`` documents and albums.
+        """
+        counts = {'docs': 0, 'albums': 0, 'deleted': 0}
+        with self._sync_lock:
+            for token in self.accounts:
+                # Not memoized, the results would be kept for the whole sync
+                api = ipernity.make_api(token, cached = False, memoize = False)
+                for key, value in self._sync_account(api, full).items():
+                    counts[key] += value
+        log.info('Index sync: %s', counts)
+        return counts
+    
+    
+    def _sync_account(self, api: FlaskIpernityAPI, full: bool) -> Dict[str, int]:
+        account = str(api.user_info['user_id'])
+        db = self.db
+        row = db.execute(
+            'SELECT full_sync FROM accounts WHERE account = ?', (account,)
+        ).fetchone()
+        now = time()
+        full = (
+            full or
+            row is None or
+            row['full_sync'] is None or
+            bool(self.full_interval) and now - row['full_sync'] >= self.full_interval
+        )
+        counts = {'docs': 0, 'albums': 0, 'deleted': 0}
+        
+        # Documents, one page at a time
+        seen = set()
+        docs = self._items(api, 'doc.getList', user_id = account, extra = 'dates')
+        while True:
+            items = list(islice(docs, self.per_page))
+            if not items:
+                break
+            changed = 0
+            with db:
+                for doc in items:
+                    seen.add(str(doc['doc_id']))
+                    changed += self._upsert_doc(account, doc, now)
+            counts['docs'] += changed
+            if not changed and not full:
+                break
+        if full:
+            with db:
+                stored = {
+                    r['doc_id'] for r in db.execute(
+                        'SELECT doc_id FROM docs WHERE account = ?', (account,)
+                    )
+                }
+                deleted = [(d,) for d in stored - seen]
+                db.executemany('DELETE FROM docs WHERE doc_id = ?', deleted)
+                db.executemany('DELETE FROM album_docs WHERE doc_id = ?', deleted)
+            counts['deleted'] += len(deleted)
+        
+        # Albums
+        seen = set()
+        for album in self._items(api, 'album.getList', user_id = account):
+            album_id = str(album['album_id'])
+            seen.add(album_id)
+            if self._upsert_album(account, album, now) or full:
+                counts['albums'] += 1
+                self._sync_album_docs(api, album_id)
+        with db:
+            stored = {
+                r['album_id'] for r in db.execute(
+                    'SELECT album_id FROM albums WHERE account = ?', (account,)
+                )
+            }
+            deleted = [(a,) for a in stored - seen]
+            db.executemany('DELETE FROM albums WHERE album_id = ?', deleted)
+            db.executemany('DELETE FROM album_docs WHERE album_id = ?', deleted)
+            counts['deleted'] += len(deleted)
+            
+            db.execute(
+                'INSERT INTO accounts (account, full_sync, last_sync) VALUES (?, ?, ?) '
+                'ON CONFLICT (account) DO UPDATE SET last_sync = excluded.last_sync, '
+                'full_sync = COALESCE(excluded.full_sync, accounts.full_sync)',
+                (account, now if full else None, now)
+            )
+        return counts
+    
+    
+    def _sync_album_docs(self, api: FlaskIpernityAPI, album_id: str):
+        doc_ids = [
+            str(doc['doc_id'])
+            for doc in self._items(api, 'album.docs.getList', album_id = album_id)
+        ]
+        with self.db as db:
+            db.execute('DELETE FROM album_docs WHERE album_id = ?', (album_id,))
+            db.executemany(
+                'INSERT OR IGNORE INTO album_docs (album_id, doc_id, position) '
+                'VALUES (?, ?, ?)',
+                [(album_id, doc_id, i) for i, doc_id in enumerate(doc_ids)]
+            )
+    
+    
+    def _items(
+        self,
+        api: FlaskIpernityAPI,
+        method_name: str,
+        **kwargs: Any
+    ) -> Iterator[Dict]:
+        return iter_pages(method_name, api = api, per_page = self.per_page, **kwargs)
+    
+    
+    def _upsert_doc(self, account: str, doc: Mapping[str, Any], now: float) -> bool:
+        data = json.dumps(doc, sort_keys = True)
+        fingerprint = _fingerprint(data)
+        doc_id = str(doc['doc_id'])
+        row = self.db.execute(
+            'SELECT fingerprint FROM docs WHERE doc_id = ?', (doc_id,)
+        ).fetchone()
+        if row is not None and row['fingerprint'] == fingerprint:
+            return False
+        posted_at = doc.get('dates', {}).get('posted_at')
+        self.db.execute(
+            'INSERT OR REPLACE INTO docs '
+            '(doc_id, account, title, description, media, posted_at, fingerprint, '
+            'data, synced_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                doc_id,
+                account,
+                doc.get('title'),
+                doc.get('description'),
+                doc.get('media'),
+                int(posted_at) if posted_at else None,
+                fingerprint,
+                data,
+                now,
+            )
+        )
+        return True
+    
+    
+    def _upsert_album(self, account: str, album: Mapping[str, Any], now: float) -> bool:
+        data = json.dumps(album, sort_keys = True)
+        fingerprint = _fingerprint(data)
+        album_id = str(album['album_id'])
+        with self.db as db:
+            row = db.execute(
+                'SELECT fingerprint FROM albums WHERE album_id = ?', (album_id,)
+            ).fetchone()
+            if row is not None and row['fingerprint'] == fingerprint:
+                return False
+            db.execute(
+                'INSERT OR REPLACE INTO albums '
+                '(album_id, account, title, description, fingerprint, data, synced_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (
+                    album_id,
+                    account,
+                    album.get('title'),
+                    album.get('description'),
+                    fingerprint,
+                    data,
+                    now,
+                )
+            )
+        return True
+    
+    
+    def docs(
+        self,
+        account: str|None = None,
+        album_id: str|None = None,
+        search: str|None = None,
+        media: str|None = None,
+        limit: int = 50,
+        offset: int = 0
+    ) -> List[Dict]:
+        """
+        Returns documents from the index.
+        
+        Documents are sorted by their position in the album if ``album_id``
+        is given, otherwise newest first.
+        
+        Args:
+            account:    User ID of the owner.
+            album_id:   Only documents in this album.
+            search:     Text contained in the title or description.
+            media:      Media type, e.g. ``'photo'``.
+            limit:      Maximum number of documents.
+            offset:     Number of documents to skip.
+        Returns:
+            The documents as returned by :ip:`doc.getList`.
+        """
+        sql, params = self._docs_query(account, album_id, search, media)
+        if album_id is not None:
+            sql += ' ORDER BY album_docs.position'
+        else:
+            sql += ' ORDER BY docs.posted_at DESC, CAST(docs.doc_id AS INTEGER) DESC'
+        sql += ' LIMIT ? OFFSET ?'
+        rows = self.db.execute('SELECT docs.data ' + sql, params + [limit, offset])
+        return [json.loads(r['data']) for r in rows]
+    
+    
+    def count_docs(
+        self,
+        account: str|None = None,
+        album_id: str|None = None,
+        search: str|None = None,
+        media: str|None = None
+    ) -> int:
+        """Returns the number of documents matching :meth:`docs`."""
+        sql, params = self._docs_query(account, album_id, search, media)
+        return self.db.execute('SELECT COUNT(*) ' + sql, params).fetchone()[0]
+    
+    
+    def doc(self, doc_id: str|int) -> Dict|None:
+        """Returns a document from the index, or ``None`` if not found."""
+        row = self.db.execute(
+            'SELECT data FROM docs WHERE doc_id = ?', (str(doc_id),)
+        ).fetchone()
+        return None if row is None else json.loads(row['data'])
+    
+    
+    def albums(self, account: str|None = None) -> List[Dict]:
+        """
+        Returns the albums in the index, sorted by title.
+        
+        Args:
+            account:    User ID of the owner.
+        Returns:
+            The albums as returned by :ip:`album.getList`.
+        """
+        sql = 'SELECT data FROM albums'
+        params = []
+        if account is not None:
+            sql += ' WHERE account = ?'
+            params.append(str(account))
+        rows = self.db.execute(sql + ' ORDER BY title', params)
+        return [json.loads(r['data']) for r in rows]
+    
+    
+    def stats(self) -> Dict[str, Any]:
+        """Returns the number of indexed items and the last sync times."""
+        db = self.db
+        return {
+            'docs':     db.execute('SELECT COUNT(*) FROM docs').fetchone()[0],
+            'albums':   db.execute('SELECT COUNT(*) FROM albums').fetchone()[0],
+            'accounts': {
+                r['account']: r['last_sync']
+                for r in db.execute('SELECT account, last_sync FROM accounts')
+            },
+        }
+    
+    
+    def _docs_query(
+        self,
+        account: str|None,
+        album_id: str|None,
+        search: str|None,
+        media: str|None
+    ) -> Tuple[str, List[Any]]:
+        sql = 'FROM docs'
+        where = []
+        params = []
+        if album_id is not None:
+            sql += ' JOIN album_docs ON album_docs.doc_id = docs.doc_id'
+            where.append('album_docs.album_id = ?')
+            params.append(str(album_id))
+        if account is not None:
+            where.append('docs.account = ?')
+            params.append(str(account))
+        if media is not None:
+            where.append('docs.media = ?')
+            params.append(media)
+        if search:
+            escaped = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            pattern = '%' + escaped + '%'
+            where.append(
+                "(docs.title LIKE ? ESCAPE '\\' OR docs.description LIKE ? ESCAPE '\\')"
+            )
+            params.extend([pattern, pattern])
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return sql, params
+    
+    
+    def start(self):
+        """
+        Starts a background thread that calls :meth:`sync` periodically.
+        
+        Does nothing if the thread is already running in this process. The
+        thread only syncs while it holds the lock file, so with several
+        worker processes, one of them syncs and another one takes over when
+        it exits.
+        """
+        # start is called for each request, possibly in several threads
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            
+            log.debug('Starting index sync')
+            if self._pid != os.getpid():
+                # A lock inherited from the parent process is not ours
+                self._lock_fd = None
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = Thread(
+                target = self._run,
+                name = 'ipernity-index-sync',
+                daemon = True
+            )
+            self._thread.start()
+    
+    
+    def stop(self):
+        """Stops the background thread."""
+        self._stop.set()
+    
+    
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                if self._lock():
+                    with self.app.app_context():
+                        try:
+                            self.sync()
+                        except Exception:
+                            log.exception('Error syncing index')
+                self._stop.wait(self.interval)
+        finally:
+            self._unlock()
+    
+    
+    def _lock(self) -> bool:
+        import fcntl
+        
+        if self._lock_fd is not None:
+            return True
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        log.debug('Index sync lock acquired')
+        self._lock_fd = fd
+        return True
+    
+    
+    def _unlock(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+
+def _fingerprint(data: str) -> str:
+    return blake2b(data.encode('utf-8'), digest_size = 8).hexdigest()
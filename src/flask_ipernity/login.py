@@ -84,7 +84,7 @@ def load_user(id_: str) -> User:
     Otherwise, returns None.
     """
     log.debug('Loading user %s', id_)
-    if not ipernity.api.token:
+    if not ipernity.api.token or ipernity.api.service:
         return None
     if not ipernity.api.user_info:
         log.error('No user info for API token, dumping token')
@@ -137,7 +137,7 @@ class User(UserMixin):
     
     @property
     def is_authenticated(self) -> bool:
-        if self._api.token is None:
+        if self._api.token is None or getattr(self._api, 'service', False):
             return False
         return True
     
@@ -0,0 +1,407 @@
+"""
+This module provides the media cache used by the document proxy.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+from hashlib import sha256
+from logging import getLogger
+from threading import Condition, Lock, Thread
+from time import time
+from typing import Any, Dict, Iterator, NamedTuple, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import requests
+
+
+log = getLogger(__name__)
+
+
+class CachedMedia(NamedTuple):
+    """
+    A complete media file in :class:`MediaCache`.
+    """
+    
+    #: Path of the file.
+    path: str
+    #: Content type returned by Ipernity.
+    content_type: str
+    #: Size in bytes.
+    size: int
+
+
+class MediaCache():
+    """
+    Downloads media files once for all clients and keeps them on disk.
+    
+    Concurrent requests for the same URL share one download from Ipernity:
+    the first request starts a :class:`Download` that writes the file in a
+    background thread, and all requests stream the file while it grows.
+    Complete files are kept in ``directory`` together with a ``.json``
+    sidecar file holding their content type and size, and are served from
+    disk until they are older than ``max_age``.
+    
+    Downloads are only shared within one process. A ``directory`` shared by
+    several processes still serves complete files to all of them.
+    
+    After a download, :meth:`sweep` removes expired files and keeps the
+    directory below ``max_size``. It runs at most every
+    :attr:`sweep_interval` seconds.
+    
+    Args:
+        directory:  Directory for the files.
+        max_age:    Time in seconds that complete files are served.
+        max_size:   Maximum size of the complete files in bytes, ``None``
+                    for no limit.
+    """
+    
+    #: Minimum time in seconds between two runs of :meth:`sweep`.
+    sweep_interval = 300
+    #: Time in seconds after which unfinished files that are no longer
+    #: written are removed, e.g. the ones left by a crashed process.
+    part_timeout = 3600
+    
+    def __init__(
+        self,
+        directory: str,
+        max_age: float = 86400,
+        max_size: int|None = None
+    ):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_size = max_size
+        self._downloads: Dict[str, Download] = {}
+        self._lock = Lock()
+        self._next_sweep = 0.0
+        os.makedirs(directory, exist_ok = True)
+    
+    
+    def get(self, url: str) -> CachedMedia|None:
+        """
+        Returns the complete file for ``url``, if it is in the cache.
+        
+        Expired files are removed.
+        """
+        path = self._path(url)
+        try:
+            with open(path + '.json', 'r', encoding = 'utf-8') as f:
+                meta = json.load(f)
+            size = os.path.getsize(path)
+        except (OSError, ValueError):
+            return None
+        if time() - meta['created'] > self.max_age or size != meta['size']:
+            log.debug('Removing expired media file %s', path)
+            self._remove(path)
+            return None
+        return CachedMedia(path, meta['content_type'], size)
+    
+    
+    def open(self, url: str) -> Tuple[MediaReader, bool]:
+        """
+        Returns a reader for the download of ``url``.
+        
+        If ``url`` is not being downloaded, a new download is registered and
+        the caller becomes its leader: it must request the file from Ipernity
+        and pass the response to :meth:`Download.start`, or pass the error to
+        :meth:`Download.fail`. Other requests for the same URL wait for the
+        leader and read the same file.
+        
+        Returns:
+            Tuple ``(reader, leader)``.
+        """
+        with self._lock:
+            download = self._downloads.get(url)
+            leader = download is None
+            if leader:
+                directory = os.path.dirname(self._path(url))
+                os.makedirs(directory, exist_ok = True)
+                fd, part = tempfile.mkstemp(
+                    prefix = 'ipernity-',
+                    suffix = '.part',
+                    dir = directory
+                )
+                download = Download(self, url, part, fd)
+                self._downloads[url] = download
+            else:
+                log.debug('Joining download of %s', url)
+            # Opened while the download is registered, so the file can be
+            # read even after it has been moved or removed.
+            return MediaReader(download), leader
+    
+    
+    def clear(self):
+        """Removes all complete files."""
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.part'):
+                    os.remove(os.path.join(root, name))
+    
+    
+    def sweep(self) -> int:
+        """
+        Removes files that are no longer needed.
+        
+        These are expired files, unfinished files that were not written for
+        :attr:`part_timeout` seconds and sidecar files without a media file.
+        If the remaining files are larger than ``max_size``, the oldest ones
+        are removed.
+        
+        Returns:
+            Number of removed media files.
+        """
+        now = time()
+        files = []
+        removed = 0
+        for root, dirs, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith('.part'):
+                    if now - st.st_mtime > self.part_timeout:
+                        log.debug('Removing unfinished media file %s', path)
+                        self._remove_file(path)
+                elif name.endswith('.json'):
+                    if not os.path.exists(path[:-5]):
+                        self._remove_file(path)
+                elif now - st.st_mtime > self.max_age:
+                    self._remove(path)
+                    removed += 1
+                else:
+                    files.append((st.st_mtime, st.st_size, path))
+        
+        if self.max_size is not None:
+            size = sum(f[1] for f in files)
+            files.sort()
+            while files and size > self.max_size:
+                mtime, file_size, path = files.pop(0)
+                self._remove(path)
+                size -= file_size
+                removed += 1
+        
+        if removed:
+            log.info('Removed %d files from the media cache', removed)
+        return removed
+    
+    
+    def stats(self) -> Dict[str, Any]:
+        """Returns the number and size of complete files and running downloads."""
+        files = size = 0
+        for root, dirs, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(('.json', '.part')):
+                    files += 1
+                    size += os.path.getsize(os.path.join(root, name))
+        with self._lock:
+            downloads = len(self._downloads)
+        return {
+            'directory':    self.directory,
+            'files':        files,
+            'size':         size,
+            'downloads':    downloads,
+        }
+    
+    
+    def _finish(self, download: Download, ok: bool):
+        with self._lock:
+            try:
+                if ok:
+                    path = self._path(download.url)
+                    os.replace(download.part, path)
+                    meta = {
+                        'url':          download.url,
+                        'content_type': download.content_type,
+                        'size':         download.size,
+                        'created':      time(),
+                    }
+                    with open(path + '.json.part', 'w', encoding = 'utf-8') as f:
+                        json.dump(meta, f)
+                    os.replace(path + '.json.part', path + '.json')
+                else:
+                    os.remove(download.part)
+            except OSError as e:
+                log.error('Error storing %s: %s', download.url, e)
+            finally:
+                del self._downloads[download.url]
+            
+            sweep = ok and time() >= self._next_sweep
+            if sweep:
+                self._next_sweep = time() + self.sweep_interval
+        if sweep:
+            try:
+                self.sweep()
+            except OSError as e:
+                log.error('Error cleaning up the media cache: %s', e)
+    
+    
+    def _path(self, url: str) -> str:
+        digest = sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+    
+    
+    def _remove(self, path: str):
+        for name in (path + '.json', path):
+            self._remove_file(name)
+    
+    
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class Download():
+    """
+    A media file being downloaded by :class:`MediaCache`.
+    
+    The file is written by a background thread, so the download continues
+    if the client that started it disconnects. Use :meth:`MediaCache.open` to
+    read it.
+    
+    Args:
+        cache:  The media cache.
+        url:    URL of the media file.
+        part:   Path of the file being written.
+        fd:     File descriptor of ``part``, open for writing.
+    """
+    
+    chunk_size = 64 * 1024
+    
+    def __init__(self, cache: MediaCache, url: str, part: str, fd: int):
+        self.cache = cache
+        self.url = url
+        self.part = part
+        #: Content type returned by Ipernity, set by :meth:`start`.
+        self.content_type: str|None = None
+        #: Number of bytes written so far.
+        self.size = 0
+        #: ``True`` when the download has finished or failed.
+        self.done = False
+        #: The exception that stopped the download.
+        self.error: BaseException|None = None
+        self._file = os.fdopen(fd, 'wb')
+        self._cond = Condition()
+    
+    
+    def start(self, response: requests.Response):
+        """Starts writing the response in a background thread."""
+        with self._cond:
+            self.content_type = response.headers.get(
+                'content-type',
+                'application/octet-stream'
+            )
+            self._cond.notify_all()
+        Thread(
+            target = self._run,
+            args = (response,),
+            name = 'ipernity-media-download',
+            daemon = True
+        ).start()
+    
+    
+    def fail(self, error: BaseException):
+        """
+        Ends a download that could not be started.
+        
+        Readers waiting for the download raise ``error``.
+        """
+        self._file.close()
+        self.cache._finish(self, False)
+        with self._cond:
+            self.error = error
+            self.done = True
+            self._cond.notify_all()
+    
+    
+    def _run(self, response: requests.Response):
+        log.debug('Downloading %s to %s', self.url, self.part)
+        error = None
+        try:
+            for chunk in response.iter_content(self.chunk_size):
+                self._file.write(chunk)
+                self._file.flush()
+                with self._cond:
+                    self.size += len(chunk)
+                    self._cond.notify_all()
+        except Exception as e:
+            log.error('Error downloading %s: %s', self.url, e)
+            error = e
+        finally:
+            response.close()
+            self._file.close()
+            self.cache._finish(self, error is None)
+            with self._cond:
+                self.error = error
+                self.done = True
+                self._cond.notify_all()
+
+
+class MediaReader():
+    """
+    Reads a :class:`Download` while it is written.
+    
+    Iterating over the reader returns the content and waits for new data
+    until the download is complete. If the download fails, the iterator
+    raises the error after the data that was downloaded.
+    
+    Args:
+        download:   The download to read.
+    """
+    
+    def __init__(self, download: Download):
+        self.download = download
+        self._file = open(download.part, 'rb')
+    
+    
+    def wait(self) -> str:
+        """
+        Waits until the download has started.
+        
+        Returns:
+            The content type.
+        Raises:
+            Exception:  The error passed to :meth:`Download.fail`.
+        """
+        d = self.download
+        with d._cond:
+            while d.content_type is None and not d.done:
+                d._cond.wait()
+            if d.content_type is None:
+                self.close()
+                raise d.error
+            return d.content_type
+    
+    
+    def __iter__(self) -> Iterator[bytes]:
+        d = self.download
+        pos = 0
+        try:
+            while True:
+                with d._cond:
+                    while pos >= d.size and not d.done:
+                        d._cond.wait()
+                    size = d.size
+                if pos < size:
+                    data = self._file.read(min(size - pos, d.chunk_size))
+                    if not data:
+                        raise OSError(f'{d.part} is shorter than expected')
+                    pos += len(data)
+                    yield data
+                elif d.error is not None:
+                    raise d.error
+                else:
+                    return
+        finally:
+            self.close()
+    
+    
+    def close(self):
+        """Closes the file."""
+        self._file.close()
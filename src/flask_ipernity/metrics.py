@@ -0,0 +1,69 @@
+"""
+This module provides counters for Flask-Ipernity's metrics.
+"""
+
+from __future__ import annotations
+
+from collections import Counter
+from logging import getLogger
+from threading import Lock
+from typing import Dict
+
+
+log = getLogger(__name__)
+
+
+class Metrics():
+    """
+    Counts events in the current process.
+    
+    The counters are kept in memory and shared by all threads. Subclass this
+    and override :meth:`incr` to send the events to a monitoring system like
+    StatsD or Prometheus, and set :data:`IPERNITY_METRICS` to an instance of
+    the subclass.
+    
+    Flask-Ipernity counts the following events:
+    
+    ``api_calls``
+        Results fetched from Ipernity and stored in the cache.
+    ``returns_from_cache``
+        Results returned from the cache.
+    ``ttl_extended``, ``ttl_reduced``
+        Adaptive timeouts that were extended because a result did not change,
+        or reduced because it changed (see
+        :data:`IPERNITY_CACHE_ADAPTIVE_MAX_AGE`).
+    """
+    
+    def __init__(self):
+        self._counters = Counter()
+        self._lock = Lock()
+    
+    
+    def incr(self, name: str, value: int = 1):
+        """
+        Increments a counter.
+        
+        Args:
+            name:   Name of the counter.
+            value:  Amount to add.
+        """
+        with self._lock:
+            self._counters[name] += value
+    
+    
+    def get(self, name: str) -> int:
+        """Returns the value of a counter."""
+        return self._counters[name]
+    
+    
+    def stats(self) -> Dict[str, int]:
+        """Returns the values of all counters."""
+        with self._lock:
+            return dict(self._counters)
+    
+    
+    def reset(self):
+        """Sets all counters to zero."""
+        with self._lock:
+            self._counters.clear()
+
@@ -0,0 +1,169 @@
+"""
+This module provides iteration over paged results.
+"""
+
+from __future__ import annotations
+
+from functools import partial
+from logging import getLogger
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Tuple, TYPE_CHECKING
+
+from flask import Response, abort, json, stream_with_context
+
+from .ext import ipernity
+
+if TYPE_CHECKING:
+    from .api import FlaskIpernityAPI
+
+
+log = getLogger(__name__)
+
+
+def page_items(result: Mapping[str, Any]) -> Tuple[List[Dict], int]:
+    """
+    Extracts the items from one page of a list method's result.
+    
+    Ipernity returns paged lists as a dict containing ``page``, ``pages`` etc.
+    and the list of items, e.g. ``{'docs': {'page': '1', 'pages': '3', ...,
+    'doc': [...]}}``. The dict may also be nested in another one like in the
+    result of :ip:`album.docs.getList`. If ``pages`` is missing, the number
+    of pages is calculated from ``total`` and ``per_page``.
+    
+    Args:
+        result: Result of the API call.
+    Returns:
+        Tuple of the items on the page and the number of pages.
+    """
+    todo = [v for k, v in result.items() if k != 'api' and isinstance(v, dict)]
+    while todo:
+        d = todo.pop(0)
+        if 'pages' in d:
+            pages = int(d['pages'])
+        elif 'total' in d and 'per_page' in d:
+            total, per_page = int(d['total']), int(d['per_page'])
+            pages = (total + per_page - 1) // per_page if per_page else 1
+        else:
+            todo.extend(v for v in d.values() if isinstance(v, dict))
+            continue
+        
+        items = []
+        for value in d.values():
+            if isinstance(value, list):
+                items = value
+            elif isinstance(value, dict):
+                # A single item may not be wrapped in a list
+                items = [value]
+        return items, pages
+    
+    raise ValueError('Result does not contain a paged list')
+
+
+def iter_pages(
+    method_name: str,
+    prefetch: bool = False,
+    api: FlaskIpernityAPI|None = None,
+    **kwargs: Any
+) -> Iterator[Dict]:
+    """
+    Iterates over all items of a paged list method.
+    
+    See :meth:`Ipernity.iter_pages <flask_ipernity.Ipernity.iter_pages>`.
+    """
+    if api is None:
+        api = ipernity.api
+    page = int(kwargs.pop('page', 1))
+    pages = page
+    pending: Callable[[], Dict]|None = None
+    
+    while page <= pages:
+        if pending is None:
+            res = api.call(method_name, page = page, **kwargs)
+        else:
+            res = pending()
+            pending = None
+        
+        items, pages = page_items(res)
+        log.debug('%s: got page %d of %d', method_name, page, pages)
+        page += 1
+        
+        if prefetch and page <= pages:
+            args = dict(kwargs, page = page)
+            try:
+                found, cached = api.lookup(method_name, args)
+                if found:
+                    pending = partial(_identity, cached)
+                else:
+                    log.debug('%s: prefetching page %d', method_name, page)
+                    future = ipernity.executor.submit(api.fetch, method_name, **args)
+                    pending = partial(api.collect, method_name, args, future.result)
+            except Exception as e:
+                # The items of this page are still returned, the next page is
+                # requested with a plain call which raises the error if needed
+                log.debug('%s: prefetching page %d failed: %s', method_name, page, e)
+        
+        yield from items
+
+
+def list_response(
+    method_name: str,
+    ndjson: bool = False,
+    prefetch: bool = True,
+    **kwargs: Any
+) -> Response:
+    """
+    Returns a streamed response with all items of a paged list method.
+    
+    See :meth:`Ipernity.list_response <flask_ipernity.Ipernity.list_response>`.
+    """
+    from ipernity import APIRequestError
+    from .upstream import CircuitOpen, RateLimitExceeded
+    
+    items = iter_pages(method_name, prefetch, **kwargs)
+    # Get the first page now, so that errors can still change the response
+    try:
+        first = next(items, None)
+    except APIRequestError as e:
+        if e.code == 1:
+            abort(404, e.message)
+        else:
+            abort(502, e.message)
+    except (CircuitOpen, RateLimitExceeded) as e:
+        abort(503, e.message)
+    
+    if ndjson:
+        start, sep, end = '', '\n', '\n'
+        mimetype = 'application/x-ndjson'
+    else:
+        start, sep, end = '[', ',', ']'
+        mimetype = 'application/json'
+    
+    def generate() -> Iterator[str]:
+        if first is None:
+            yield '[]' if not ndjson else ''
+            return
+        
+        buf = [start, json.dumps(first)]
+        size = 0
+        for item in items:
+            chunk = json.dumps(item)
+            buf.append(sep)
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= _chunk_size:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+        buf.append(end)
+        yield ''.join(buf)
+    
+    return Response(stream_with_context(generate()), mimetype = mimetype)
+
+
+# Minimum size of the chunks sent by list_response
+_chunk_size = 64 * 1024
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
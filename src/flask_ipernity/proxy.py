@@ -3,14 +3,24 @@
 from __future__ import annotations
 
 from logging import getLogger
-from typing import TYPE_CHECKING
+from time import localtime, time
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Tuple, TYPE_CHECKING
 
-import requests
-from flask import Blueprint, Response, abort, stream_with_context
-from ipernity import APIRequestError
+from flask import (
+    Blueprint, Response, abort, current_app, send_file, stream_with_context,
+    url_for
+)
+from werkzeug.exceptions import HTTPException
 
 from .ext import ipernity
 
+if TYPE_CHECKING:
+    from threading import Event
+    import requests
+    from flask import Flask
+    from itsdangerous import URLSafeSerializer
+    from .cache import CacheBackend
+
 
 log = getLogger(__name__)
 
@@ -21,7 +31,20 @@ proxy = Blueprint('ip_proxy', __name__)
 def doc(doc_id: str, label: str) -> Response:
     """
     Loads and serves documents from Ipernity.
+    
+    If caching is enabled, media files that Ipernity answered with
+    ``403 Forbidden`` or ``404 Not Found`` are remembered in the shared cache
+    for :data:`IPERNITY_CACHE_NEGATIVE_MAX_AGE` seconds.
+    
+    If :data:`IPERNITY_MEDIA_CACHE_DIR` is set, concurrent requests for the
+    same file share one download and complete files are served from disk
+    (see :class:`~flask_ipernity.mediacache.MediaCache`). Otherwise, the
+    file is streamed directly from Ipernity.
     """
+    # Imported here to keep the blueprint cheap to register
+    from ipernity import APIRequestError
+    from .upstream import CircuitOpen, RateLimitExceeded
+    
     log.debug('Proxying doc %s size %s', doc_id, label)
     try:
         d = ipernity.api.doc.getMedias(doc_id = doc_id)
@@ -30,26 +53,446 @@ def doc(doc_id: str, label: str) -> Response:
             abort(404, 'Document not found.')
         else:
             abort(502, e.message)
+    except (CircuitOpen, RateLimitExceeded) as e:
+        abort(503, e.message)
+    
+    media = _find_media(d, doc_id, label)
+    if media is None:
+        abort(404, 'Media not found.')
+    return _serve(*media)
+
+
+@proxy.route('/media/<token>')
+def signed(token: str) -> Response:
+    """
+    Serves a media file from a URL created by :func:`signed_url`.
+    
+    The token only contains the document ID, the label and the expiry time.
+    The file's address is kept in the shared cache by :func:`signed_url`, so
+    this view usually neither asks Ipernity for the document nor uses the
+    session. The response can be stored by shared caches and CDNs until the
+    token expires.
+    """
+    from itsdangerous import BadSignature
+    
+    try:
+        doc_id, label, expires = _serializer().loads(token)
+    except BadSignature:
+        abort(404, 'Media not found.')
+    max_age = int(expires - time())
+    if max_age <= 0:
+        abort(403, 'Link expired.')
+    
+    res = _serve(*_signed_media(doc_id, label, expires))
+    # send_file adds no-cache for files from the media cache
+    res.cache_control.no_cache = None
+    res.cache_control.public = True
+    res.cache_control.max_age = max_age
+    res.expires = expires
+    return res
+
+
+@proxy.route('/album/<album_id>.zip')
+def album(album_id: str) -> Response:
+    """
+    Serves the original files of an album as a ZIP archive.
+    
+    The archive is streamed while the files are loaded. Up to
+    :data:`IPERNITY_PROXY_ZIP_WORKERS` files are downloaded concurrently, each
+    one buffering at most a few chunks until it is written to the archive,
+    so the memory used does not depend on the size of the album. The files
+    are stored in the order of the album without compression.
+    
+    Documents without an accessible original are left out. As the response
+    has already started, an error while a file is written aborts it.
+    """
+    from ipernity import APIRequestError
+    from .upstream import CircuitOpen, RateLimitExceeded
+    
+    log.debug('Proxying album %s', album_id)
+    docs = ipernity.iter_pages(
+        'album.docs.getList',
+        prefetch = True,
+        album_id = album_id,
+        per_page = 100
+    )
+    # Check that the album can be read before the response starts
+    try:
+        first = next(docs, None)
+    except APIRequestError as e:
+        if e.code == 1:
+            abort(404, 'Album not found.')
+        else:
+            abort(502, e.message)
+    except (CircuitOpen, RateLimitExceeded) as e:
+        abort(503, e.message)
     
+    def album_docs() -> Iterator[Dict]:
+        if first is not None:
+            yield first
+            yield from docs
+    
+    workers = current_app.config['IPERNITY_PROXY_ZIP_WORKERS']
+    headers = [('content-disposition', f'attachment; filename = {album_id}.zip')]
+    return Response(
+        stream_with_context(_zip_stream(_originals(album_docs(), workers), workers)),
+        mimetype = 'application/zip',
+        headers = headers
+    )
+
+
+def signed_url(doc_id: int|str, label: str) -> str:
+    """
+    Returns a signed URL for a media file of a document.
+    
+    The URL is checked with the application's ``SECRET_KEY`` and is valid
+    for :data:`IPERNITY_PROXY_SIGNED_MAX_AGE` to twice that time. URLs
+    created within the same period are identical, so shared caches can serve
+    repeated requests. Anyone who has the URL can load the file until it
+    expires, even if the document is private, but the URL does not reveal
+    the file's address at Ipernity. Use it in templates as
+    ``ipernity_signed_url``:
+    
+    .. code-block:: html+jinja
+        
+        <img src="{{ ipernity_signed_url(4711, '500') }}">
+    
+    Args:
+        doc_id:     Ipernity document ID.
+        label:      Thumbnail label or ``'original'``.
+    Raises:
+        LookupError:        The document has no such media file.
+        APIRequestError:    :ip:`doc.getMedias` failed.
+    """
+    media = _find_media(ipernity.api.doc.getMedias(doc_id = doc_id), doc_id, label)
+    if media is None:
+        raise LookupError(f'Document {doc_id} has no media {label}')
+    max_age = current_app.config['IPERNITY_PROXY_SIGNED_MAX_AGE']
+    expires = (int(time()) // max_age + 2) * max_age
+    ipernity.shared_cache.set(_signed_key(doc_id, label), (list(media), expires))
+    token = _serializer().dumps([str(doc_id), label, expires])
+    return url_for('ip_proxy.signed', token = token)
+
+
+def _signed_key(doc_id: int|str, label: str) -> str:
+    return f'proxy:signed:{doc_id}:{label}'
+
+
+def _signed_media(doc_id: str, label: str, expires: int) -> Tuple[str, str]:
+    from ipernity import APIRequestError
+    from .upstream import CircuitOpen, RateLimitExceeded
+    
+    key = _signed_key(doc_id, label)
+    entry = ipernity.shared_cache.get(key)
+    if entry is not None:
+        return tuple(entry[0])
+    
+    # Not in the cache, e.g. with a cache that is not shared by all
+    # processes: ask Ipernity without the visitor's token
+    log.debug('Looking up signed media %s %s', doc_id, label)
+    try:
+        d = ipernity.make_service_api().doc.getMedias(doc_id = doc_id)
+    except APIRequestError as e:
+        if e.code == 1:
+            abort(404, 'Document not found.')
+        else:
+            abort(502, e.message)
+    except (CircuitOpen, RateLimitExceeded) as e:
+        abort(503, e.message)
+    media = _find_media(d, doc_id, label)
+    if media is None:
+        abort(404, 'Media not found.')
+    ipernity.shared_cache.set(key, (list(media), expires))
+    return media
+
+
+def _find_media(
+    d: Mapping[str, Any],
+    doc_id: int|str,
+    label: str
+) -> Tuple[str, str]|None:
     if (label == 'original'):
         if 'original' not in d:
-            abort(404, 'Media not found')
-        url = d['original']['url']
-        filename = d['original']['filename']
-    else:
-        for thumb in d['thumbs']['thumb']:
-            if thumb['label'] == label:
-                url = thumb['url']
-                filename = f"{doc_id}.{label}{thumb['ext']}"
-                break
+            return None
+        return d['original']['url'], d['original']['filename']
+    for thumb in d['thumbs']['thumb']:
+        if thumb['label'] == label:
+            return thumb['url'], f"{doc_id}.{label}{thumb['ext']}"
+    return None
+
+
+def _serve(url: str, filename: str) -> Response:
+    headers = [('content-disposition', f'inline; filename = {filename}')]
+    media = ipernity.media_cache
+    if media is None:
+        res = _fetch_media(url)
+        response = Response(
+            stream_with_context(res.iter_content(None)),
+            content_type = res.headers.get('content-type', 'application/octet-stream'),
+            headers = headers
+        )
+        response.call_on_close(res.close)
+        return response
+    
+    cached = media.get(url)
+    if cached is not None:
+        res = send_file(cached.path, cached.content_type, conditional = True)
+        res.headers.extend(headers)
+        return res
+    
+    reader, leader = media.open(url)
+    if leader:
+        try:
+            res = _fetch_media(url)
+        except BaseException as e:
+            reader.download.fail(e)
+            reader.close()
+            raise
+        reader.download.start(res)
+    try:
+        content_type = reader.wait()
+    except HTTPException as e:
+        # The leader's request failed
+        abort(e.code, e.description)
+    except Exception:
+        abort(502, 'Error getting media.')
+    
+    return Response(reader, content_type = content_type, headers = headers)
+
+
+def _originals(docs: Iterable[Dict], batch: int) -> Iterator[Tuple[str, str]]:
+    """Yields the URL and filename of each document's original."""
+    from itertools import islice
+    
+    docs = iter(docs)
+    while True:
+        ids = [d['doc_id'] for d in islice(docs, batch)]
+        if not ids:
+            return
+        results = ipernity.call_many([('doc.getMedias', {'doc_id': i}) for i in ids])
+        for doc_id, res in zip(ids, results):
+            media = None
+            if isinstance(res, Exception):
+                log.warning('Error getting medias of doc %s: %s', doc_id, res)
+            else:
+                media = _find_media(res, doc_id, 'original')
+            if media is not None:
+                yield media
+
+
+def _zip_stream(originals: Iterator[Tuple[str, str]], workers: int) -> Iterator[bytes]:
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    from threading import Event
+    from zipfile import ZipFile, ZipInfo
+    
+    app = current_app._get_current_object()
+    stop = Event()
+    executor = ThreadPoolExecutor(workers, thread_name_prefix = 'ipernity-zip')
+    pending = deque()
+    names = set()
+    out = _ZipOutput()
+    
+    def fill():
+        # Only ``workers`` downloads are started ahead of the one being written
+        while len(pending) < workers:
+            media = next(originals, None)
+            if media is None:
+                return
+            member = _ZipMember(stop)
+            executor.submit(member.download, app, media[0])
+            pending.append((media, member))
+    
+    try:
+        with ZipFile(out, 'w') as zf:
+            fill()
+            while pending:
+                (url, filename), member = pending.popleft()
+                fill()
+                try:
+                    member.wait()
+                except Exception as e:
+                    log.warning('Leaving %s out of the archive: %s', url, e)
+                    continue
+                
+                info = ZipInfo(_unique_name(names, filename), localtime()[:6])
+                # The size is not known in advance, and ZIP64 headers allow
+                # files larger than 2 GiB
+                with zf.open(info, 'w', force_zip64 = True) as f:
+                    for chunk in member:
+                        f.write(chunk)
+                        yield out.take()
+        yield out.take()
+    finally:
+        stop.set()
+        executor.shutdown(wait = False)
+
+
+def _unique_name(names: set, filename: str) -> str:
+    name = filename
+    n = 1
+    while name in names:
+        stem, dot, ext = filename.rpartition('.')
+        if not dot:
+            stem, ext = filename, ''
+        n += 1
+        name = f'{stem} ({n}){dot}{ext}'
+    names.add(name)
+    return name
+
+
+class _ZipOutput():
+    """Unseekable file collecting the output of ZipFile until it is sent."""
+    
+    def __init__(self):
+        self._chunks: List[bytes] = []
+    
+    
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    
+    def flush(self):
+        pass
+    
+    
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class _ZipMember():
+    """
+    A file for the album archive, downloaded in a worker thread.
+    
+    The chunks are passed through a bounded queue, so the download waits
+    while the archive is busy with other files.
+    """
+    
+    def __init__(self, stop: Event):
+        from queue import Queue
+        
+        self.stop = stop
+        self.queue: Queue = Queue(_zip_queue_size)
+    
+    
+    def download(self, app: Flask, url: str):
+        with app.app_context():
+            try:
+                res = _fetch_media(url)
+            except BaseException as e:
+                self._put(e)
+                return
+        try:
+            if not self._put(True):
+                return
+            for chunk in res.iter_content(_zip_chunk_size):
+                if not self._put(chunk):
+                    return
+            self._put(None)
+        except Exception as e:
+            log.error('Error getting %s: %s', url, e)
+            self._put(e)
+        finally:
+            res.close()
+    
+    
+    def wait(self):
+        """Waits for the response."""
+        item = self.queue.get()
+        if isinstance(item, BaseException):
+            raise item
+    
+    
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    
+    
+    def _put(self, item: Any) -> bool:
+        from queue import Full
+        
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout = 1)
+                return True
+            except Full:
+                pass
+        return False
+
+
+# Size of the chunks downloaded for album archives, and number of chunks
+# buffered by each download
+_zip_chunk_size = 64 * 1024
+_zip_queue_size = 16
+
+
+def _serializer() -> URLSafeSerializer:
+    from itsdangerous import URLSafeSerializer
+    return URLSafeSerializer(current_app.secret_key, salt = 'ipernity-proxy')
+
+
+def _fetch_media(url: str) -> requests.Response:
+    import requests
+    from .upstream import CircuitOpen
+    
+    negative = _negative_cache()
+    key = 'proxy:' + url
+    if negative is not None:
+        entry = negative.get(key)
+        if entry is not None and time() < entry[1]:
+            abort(entry[0])
+    
+    try:
+        if ipernity.breaker is None:
+            res = _get_media(url)
         else:
-            abort(404, 'Media not found.')
+            res = ipernity.breaker.call(_get_media, url)
+    except CircuitOpen as e:
+        abort(503, e.message)
+    except requests.RequestException as e:
+        log.error('Error getting %s: %s', url, e)
+        abort(502, 'Error getting media.')
+    
+    if res.status_code in (403, 404):
+        res.close()
+        if negative is not None:
+            max_age = current_app.config['IPERNITY_CACHE_NEGATIVE_MAX_AGE']
+            negative.set(key, (res.status_code, time() + max_age))
+        abort(res.status_code)
+    if not 200 <= res.status_code < 300:
+        # Other errors must not be served or stored as media
+        log.error('Error getting %s: HTTP status %d', url, res.status_code)
+        res.close()
+        abort(502, 'Error getting media.')
+    return res
 
-    res = requests.get(url, stream = True)
-    return Response(
-        stream_with_context(res.iter_content(None)),
-        content_type = res.headers['content-type'],
-        headers = [('content-disposition', f'inline; filename = {filename}')]
+
+def _get_media(url: str) -> requests.Response:
+    import requests
+    
+    res = requests.get(
+        url,
+        stream = True,
+        timeout = current_app.config['IPERNITY_PROXY_TIMEOUT']
     )
+    if res.status_code >= 500:
+        res.raise_for_status()
+    return res
 
 
+def _negative_cache() -> CacheBackend|None:
+    config = current_app.config
+    if (
+        not config['IPERNITY_CACHE_REQUESTS'] or
+        not config['IPERNITY_CACHE_NEGATIVE_MAX_AGE']
+    ):
+        return None
+    return ipernity.shared_cache
@@ -0,0 +1,211 @@
+"""
+This module provides tracing of the API calls made in a request.
+"""
+
+from __future__ import annotations
+
+import json
+from collections import Counter
+from logging import getLogger
+from threading import Lock
+from time import perf_counter, time
+from typing import Any, Dict, List, Mapping, NamedTuple, TYPE_CHECKING
+
+from blinker import Namespace
+from flask import current_app
+
+from .ext import ipernity
+
+if TYPE_CHECKING:
+    from flask import Response
+
+
+log = getLogger(__name__)
+
+
+_signals = Namespace()
+
+#: Signal sent at the end of each traced request, before the response is
+#: returned. Receivers get the application as sender and the keyword arguments
+#: ``tracer`` (the request's :class:`CallTracer`) and ``response``.
+request_traced = _signals.signal('ipernity-request-traced')
+
+
+class TracedCall(NamedTuple):
+    """
+    An API call recorded by :class:`CallTracer`.
+    """
+    
+    #: API method.
+    method: str
+    #: API arguments.
+    kwargs: Dict[str, Any]
+    #: ``'hit'`` if the result was found in the cache, ``'miss'`` if it was
+    #: fetched from Ipernity, ``'stale'`` if an outdated result was used
+    #: because Ipernity was unavailable and ``'error'`` if the call failed.
+    outcome: str
+    #: Start time as returned by :func:`time.time`.
+    start: float
+    #: Duration in seconds.
+    duration: float
+    #: Size of the JSON result in bytes, ``None`` if there was no result.
+    size: int|None
+    #: The exception raised by the call.
+    error: BaseException|None
+
+
+class CallTracer():
+    """
+    Collects the API calls made during one request.
+    
+    Records can be added from any thread, e.g. from calls running in
+    :attr:`Ipernity.executor <flask_ipernity.Ipernity.executor>`.
+    """
+    
+    def __init__(self):
+        self.records: List[TracedCall] = []
+        self._lock = Lock()
+    
+    
+    def record(
+        self,
+        method_name: str,
+        kwargs: Mapping[str, Any],
+        outcome: str,
+        start: float,
+        result: Dict|None = None,
+        error: BaseException|None = None
+    ) -> TracedCall:
+        """
+        Records an API call.
+        
+        Args:
+            method_name:    API method.
+            kwargs:         API arguments.
+            outcome:        See :attr:`TracedCall.outcome`.
+            start:          Start of the call as returned by
+                            :func:`time.perf_counter`.
+            result:         Result of the call.
+            error:          Exception raised by the call.
+        """
+        duration = perf_counter() - start
+        size = None
+        if result is not None:
+            size = len(json.dumps(result))
+        rec = TracedCall(
+            method_name,
+            dict(kwargs),
+            outcome,
+            time() - duration,
+            duration,
+            size,
+            error
+        )
+        log.debug('%s(%s): %s in %.1f ms', method_name, kwargs, outcome, duration * 1000)
+        with self._lock:
+            self.records.append(rec)
+        return rec
+    
+    
+    def summary(self) -> Dict[str, Any]:
+        """
+        Returns a summary of the recorded calls.
+        
+        Returns:
+            Dict with the number of ``calls``, the number of calls per
+            ``outcome`` and per ``method``, the sum of the calls'
+            ``duration`` in seconds and the ``size`` of all results in bytes.
+            Methods that are called many times may indicate that a template
+            makes one call per item of a list.
+        """
+        with self._lock:
+            records = list(self.records)
+        return {
+            'calls':    len(records),
+            'outcome':  dict(Counter(r.outcome for r in records)),
+            'method':   dict(Counter(r.method for r in records)),
+            'duration': sum(r.duration for r in records),
+            'size':     sum(r.size or 0 for r in records),
+        }
+    
+    
+    def server_timing(self, max_entries: int = 20) -> str:
+        """
+        Returns the value for a ``Server-Timing`` header.
+        
+        The first entry named ``ipernity`` contains the total duration and the
+        number of calls, followed by one entry for each of the first
+        ``max_entries`` calls.
+        """
+        with self._lock:
+            records = list(self.records)
+        hits = sum(1 for r in records if r.outcome == 'hit')
+        entries = [
+            f'ipernity;dur={sum(r.duration for r in records) * 1000:.1f};'
+            f'desc="{len(records)} calls, {hits} from cache"'
+        ]
+        for i, r in enumerate(records[:max_entries]):
+            entries.append(
+                f'ipernity-{i};dur={r.duration * 1000:.1f};'
+                f'desc="{r.method} {r.outcome}"'
+            )
+        return ', '.join(entries)
+
+
+def trace_response(response: Response) -> Response:
+    """
+    Reports the API calls of the current request.
+    
+    Adds the ``Server-Timing`` header, sends :data:`request_traced` and
+    exports the calls to OpenTelemetry, depending on the configuration. This
+    is registered as :meth:`~flask.Flask.after_request` function if
+    :data:`IPERNITY_TRACE` is set.
+    """
+    tracer = ipernity.tracer
+    if tracer is None or not tracer.records:
+        return response
+    
+    config = current_app.config
+    if config['IPERNITY_TRACE_HEADER']:
+        response.headers.add('Server-Timing', tracer.server_timing())
+    if config['IPERNITY_TRACE_OPENTELEMETRY']:
+        export_spans(tracer)
+    request_traced.send(
+        current_app._get_current_object(),
+        tracer = tracer,
+        response = response
+    )
+    return response
+
+
+def export_spans(tracer: CallTracer):
+    """
+    Creates an OpenTelemetry span for each recorded call.
+    
+    The spans are children of the current span, e.g. the request's span
+    created by the OpenTelemetry Flask instrumentation. They are exported by
+    the exporters configured in the application's tracer provider. Requires
+    the `opentelemetry-api`_ package.
+    """
+    from opentelemetry import trace
+    from opentelemetry.trace import Status, StatusCode
+    
+    otel = trace.get_tracer(__name__)
+    for r in list(tracer.records):
+        attributes = {
+            'ipernity.method':  r.method,
+            'ipernity.cache':   r.outcome,
+        }
+        if r.size is not None:
+            attributes['ipernity.size'] = r.size
+        span = otel.start_span(
+            f'ipernity {r.method}',
+            kind = trace.SpanKind.CLIENT,
+            start_time = int(r.start * 1e9),
+            attributes = attributes
+        )
+        if r.error is not None:
+            span.record_exception(r.error)
+            span.set_status(Status(StatusCode.ERROR, str(r.error)))
+        span.end(end_time = int((r.start + r.duration) * 1e9))
+
@@ -0,0 +1,400 @@
+"""
+This module protects Ipernity from too many requests.
+"""
+
+from __future__ import annotations
+
+from logging import getLogger
+from threading import BoundedSemaphore, Lock
+from time import monotonic, sleep, time
+from typing import Any, Callable, Dict
+
+import requests
+from ipernity import APIRequestError, IpernityError
+
+
+log = getLogger(__name__)
+
+
+class RateLimitExceeded(IpernityError):
+    """
+    A call to Ipernity had to wait longer than allowed for the rate limiter.
+    """
+    def __init__(self, message: str = 'Ipernity rate limit exceeded'):
+        self.message = message
+        super().__init__(message)
+
+
+class CircuitOpen(IpernityError):
+    """
+    A call to Ipernity was not made because the circuit breaker is open.
+    """
+    def __init__(self, message: str = 'Ipernity is currently unavailable'):
+        self.message = message
+        super().__init__(message)
+
+
+class TokenBucket():
+    """
+    Token bucket rate limiter for the threads of one process.
+    
+    Args:
+        rate:   Number of calls per second.
+        burst:  Maximum number of calls that can be made at once.
+    """
+    
+    def __init__(self, rate: float, burst: int|None = None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = monotonic()
+        self._lock = Lock()
+    
+    
+    def acquire(self, timeout: float|None = None) -> float:
+        """
+        Takes a token from the bucket, waiting if necessary.
+        
+        Args:
+            timeout:    Maximum time to wait in seconds.
+        Returns:
+            The time waited.
+        Raises:
+            RateLimitExceeded:  No token was available in time.
+        """
+        start = monotonic()
+        while True:
+            wait = self._take()
+            if wait <= 0:
+                return monotonic() - start
+            if timeout is not None:
+                remaining = start + timeout - monotonic()
+                if wait > remaining:
+                    raise RateLimitExceeded()
+            sleep(wait)
+    
+    
+    def _take(self) -> float:
+        """Takes a token if available, otherwise returns the time to wait."""
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(
+                self.burst,
+                self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+
+class RedisTokenBucket(TokenBucket):
+    """
+    Token bucket rate limiter shared by several processes via `Redis`_.
+    
+    Args:
+        url:    Redis URL, e.g. ``redis://localhost:6379/0``.
+        rate:   Number of calls per second.
+        burst:  Maximum number of calls that can be made at once.
+        key:    Redis key for the bucket.
+    """
+    
+    _script = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local t = redis.call('TIME')
+        local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+        local data = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(data[1]) or burst
+        local updated = tonumber(data[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(wait)
+    """
+    
+    def __init__(
+        self,
+        url: str,
+        rate: float,
+        burst: int|None = None,
+        key: str = 'flask_ipernity:rate_limit'
+    ):
+        import redis
+        super().__init__(rate, burst)
+        self.key = key
+        self._redis = redis.Redis.from_url(url)
+        self._take_script = self._redis.register_script(self._script)
+    
+    
+    def _take(self) -> float:
+        return float(self._take_script(keys = [self.key], args = [self.rate, self.burst]))
+
+
+class UpstreamLimiter():
+    """
+    Limits the rate and concurrency of calls to Ipernity.
+    
+    Use an instance as context manager around each call. The limiter is
+    thread-safe and should be shared by all threads of a process.
+    
+    Args:
+        bucket:             Rate limiter, ``None`` means no rate limit.
+        max_concurrency:    Maximum number of concurrent calls, ``None`` means
+                            no limit.
+        timeout:            Maximum time in seconds that a call waits for
+                            the rate limiter and the concurrency limit.
+    """
+    
+    def __init__(
+        self,
+        bucket: TokenBucket|None = None,
+        max_concurrency: int|None = None,
+        timeout: float|None = None
+    ):
+        self.bucket = bucket
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        if max_concurrency:
+            self._semaphore = BoundedSemaphore(max_concurrency)
+        else:
+            self._semaphore = None
+        self._lock = Lock()
+        self._stats = {
+            'calls':        0,
+            'delayed':      0,
+            'rejected':     0,
+            'wait_time':    0.0,
+            'active':       0,
+            'max_active':   0,
+        }
+    
+    
+    def __enter__(self) -> UpstreamLimiter:
+        start = monotonic()
+        try:
+            if self.bucket is not None:
+                self.bucket.acquire(self.timeout)
+            if self._semaphore is not None:
+                if self.timeout is None:
+                    remaining = None
+                else:
+                    remaining = max(0, start + self.timeout - monotonic())
+                if not self._semaphore.acquire(timeout = remaining):
+                    raise RateLimitExceeded('Too many concurrent Ipernity calls')
+        except RateLimitExceeded:
+            log.warning('Rejecting Ipernity call after %.3fs', monotonic() - start)
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise
+        
+        wait = monotonic() - start
+        with self._lock:
+            self._stats['calls'] += 1
+            self._stats['wait_time'] += wait
+            if wait > 0.001:
+                self._stats['delayed'] += 1
+            self._stats['active'] += 1
+            self._stats['max_active'] = max(
+                self._stats['max_active'],
+                self._stats['active']
+            )
+        return self
+    
+    
+    def __exit__(self, *args: Any):
+        with self._lock:
+            self._stats['active'] -= 1
+        if self._semaphore is not None:
+            self._semaphore.release()
+    
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the limiter's metrics.
+        
+        The dict contains the number of ``calls`` that were made, the number
+        of calls that were ``delayed`` or ``rejected``, the total
+        ``wait_time``, and the number of ``active`` calls and its maximum
+        ``max_active``.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+
+class CircuitBreaker():
+    """
+    Circuit breaker for calls to Ipernity.
+    
+    The breaker is *closed* while Ipernity works. After ``threshold``
+    consecutive failed or slow calls, it *opens* and all calls fail
+    immediately with :exc:`CircuitOpen`. After ``reset_timeout`` seconds, the
+    breaker is *half-open* and lets ``half_open_calls`` probe calls through.
+    If they succeed, the breaker closes again, otherwise it opens again.
+    
+    HTTP errors with status 5xx and connection problems count as failures.
+    Errors returned by Ipernity (e.g. document not found) do not.
+    
+    The breaker is thread-safe and should be shared by all threads of a
+    process.
+    
+    Args:
+        threshold:          Number of consecutive failures that open the
+                            breaker.
+        reset_timeout:      Time in seconds before probing an open breaker.
+        slow_call:          Calls taking longer than this (in seconds) count
+                            as failures. ``None`` means no limit.
+        half_open_calls:    Number of concurrent probe calls when half-open.
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    
+    def __init__(
+        self,
+        threshold: int = 5,
+        reset_timeout: float = 30,
+        slow_call: float|None = None,
+        half_open_calls: int = 1
+    ):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call = slow_call
+        self.half_open_calls = half_open_calls
+        self._lock = Lock()
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._failures = 0
+        self._probes = 0
+        self._stats = {
+            'calls':            0,
+            'failures':         0,
+            'slow_calls':       0,
+            'rejected':         0,
+            'opened':           0,
+            'last_failure':     None,
+        }
+    
+    
+    @property
+    def state(self) -> str:
+        """The current state, one of ``closed``, ``open`` or ``half-open``."""
+        with self._lock:
+            if (
+                self._state == self.OPEN and
+                monotonic() >= self._opened_at + self.reset_timeout
+            ):
+                return self.HALF_OPEN
+            return self._state
+    
+    
+    def call(self, func: Callable, *args: Any, **kwargs: Any) -> Any:
+        """
+        Calls ``func`` if the breaker allows it.
+        
+        Raises:
+            CircuitOpen:    The breaker is open.
+        """
+        probe = self._before_call()
+        start = monotonic()
+        try:
+            res = func(*args, **kwargs)
+        except RateLimitExceeded:
+            # Ipernity was not called, so we learned nothing
+            self._after_call(probe, None)
+            raise
+        except Exception as e:
+            self._after_call(probe, self.is_failure(e), e)
+            raise
+        
+        duration = monotonic() - start
+        if self.slow_call is not None and duration > self.slow_call:
+            log.warning('Slow Ipernity call (%.3fs)', duration)
+            with self._lock:
+                self._stats['slow_calls'] += 1
+            self._after_call(probe, True)
+        else:
+            self._after_call(probe, False)
+        return res
+    
+    
+    @staticmethod
+    def is_failure(exc: Exception) -> bool:
+        """Checks if an exception indicates a problem with Ipernity."""
+        if isinstance(exc, APIRequestError):
+            return exc.status == 'httperror' and exc.code >= 500
+        if isinstance(exc, requests.HTTPError):
+            return exc.response is not None and exc.response.status_code >= 500
+        return isinstance(exc, requests.RequestException)
+    
+    
+    def _before_call(self) -> bool:
+        """Checks if a call is allowed and returns if it is a probe."""
+        with self._lock:
+            if self._state == self.OPEN:
+                if monotonic() < self._opened_at + self.reset_timeout:
+                    self._stats['rejected'] += 1
+                    raise CircuitOpen()
+                log.info('Circuit breaker half-open')
+                self._state = self.HALF_OPEN
+                self._probes = 0
+            if self._state == self.HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    self._stats['rejected'] += 1
+                    raise CircuitOpen()
+                self._probes += 1
+                self._stats['calls'] += 1
+                return True
+            self._stats['calls'] += 1
+            return False
+    
+    
+    def _after_call(self, probe: bool, failed: bool|None, exc: Exception|None = None):
+        with self._lock:
+            if probe and self._state == self.HALF_OPEN:
+                self._probes -= 1
+            if failed is None:
+                return
+            
+            if not failed:
+                if self._state != self.CLOSED:
+                    log.info('Circuit breaker closed')
+                self._state = self.CLOSED
+                self._failures = 0
+                return
+            
+            self._failures += 1
+            self._stats['failures'] += 1
+            self._stats['last_failure'] = time()
+            if exc is not None:
+                log.warning('Ipernity call failed: %s', exc)
+            if self._state == self.HALF_OPEN or self._failures >= self.threshold:
+                if self._state != self.OPEN:
+                    log.error('Circuit breaker open after %d failures', self._failures)
+                    self._stats['opened'] += 1
+                self._state = self.OPEN
+                self._opened_at = monotonic()
+    
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the breaker's metrics.
+        
+        The dict contains the current ``state``, the number of ``calls`` that
+        were made, of ``failures`` and ``slow_calls``, of calls ``rejected``
+        by the breaker, how often the breaker was ``opened``, and the time of
+        the ``last_failure``.
+        """
+        state = self.state
+        with self._lock:
+            return dict(self._stats, state = state)
+
+
@@ -5,13 +5,14 @@ import os
 from html.parser import HTMLParser
 from logging import getLogger
 from urllib.parse import parse_qs, urlparse
-from typing import Dict, Mapping, TYPE_CHECKING
+from typing import Any, Callable, Dict, Iterator, Mapping, TYPE_CHECKING
 
 import pytest
 import requests
 import yaml
 from flask import Flask, jsonify, session
 from flask_ipernity import Ipernity, ipernity
+from flask_ipernity.fakeserver import FakeIpernity
 
 if TYPE_CHECKING:
     from flask.testing import FlaskClient
@@ -46,6 +47,69 @@ def base_app(test_config: Mapping) -> Flask:
     return a
 
 
+@pytest.fixture
+def fake(request) -> Iterator[FakeIpernity]:
+    """
+    Local server emulating Ipernity.
+    
+    Pass arguments of :class:`FakeIpernity` with indirect parametrization,
+    e.g. ``@pytest.mark.parametrize('fake', [{'total': 250}], indirect = True)``.
+    """
+    with FakeIpernity(**getattr(request, 'param', {})) as server:
+        yield server
+
+
+@pytest.fixture
+def make_fake_app(fake: FakeIpernity) -> Callable[..., Flask]:
+    """
+    Returns a function creating apps that call :func:`fake`.
+    
+    The function takes configuration values as keyword arguments. The fake
+    server is available as ``app.fake``.
+    """
+    def make(**config: Any) -> Flask:
+        a = Flask(__name__)
+        a.config.update(
+            SECRET_KEY = 'secret',
+            IPERNITY_APP_KEY = 'key',
+            IPERNITY_APP_SECRET = 'secret',
+            IPERNITY_API_URL = fake.url,
+        )
+        a.config.update(config)
+        a.fake = fake
+        Ipernity(a)
+        return a
+    
+    return make
+
+
+@pytest.fixture
+def fake_app(make_fake_app: Callable[..., Flask], request) -> Flask:
+    """
+    App calling :func:`fake`.
+    
+    Pass configuration values with indirect parametrization.
+    """
+    return make_fake_app(**getattr(request, 'param', {}))
+
+
+@pytest.fixture
+def redis_url(monkeypatch: pytest.MonkeyPatch) -> str:
+    """
+    Redis URL served by `fakeredis`.
+    
+    All Redis clients created during the test share one fake server.
+    """
+    redis = pytest.importorskip('redis')
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        redis.Redis, 'from_url',
+        staticmethod(lambda url, **kwargs: fakeredis.FakeRedis(server = server))
+    )
+    return 'redis://localhost:6379/0'
+
+
 @pytest.fixture
 def browser(test_config: Mapping) -> IpernitySession:
     br = IpernitySession()
@@ -2,12 +2,20 @@
 Tests cache functionality
 """
 
-from time import sleep
+import gzip
+import json
+import multiprocessing
+from threading import Barrier, Thread
+from time import sleep, time
 
-from flask import jsonify
+from flask import Flask, jsonify
+from ipernity import APIRequestError
 import pytest
 
 from flask_ipernity import Ipernity, ipernity
+from flask_ipernity.cache import (
+    MemoryCache, MmapCache, RedisCache, RedisInvalidation, TieredCache, make_backend
+)
 
 
 @pytest.fixture
@@ -20,7 +28,7 @@ def cached_app(base_app):
     @app.route('/cache')
     def cache():
         return jsonify({
-            key: ipernity.session_get(key, 0)
+            key: ipernity.metrics.get(key)
             for key in ['api_calls', 'returns_from_cache']
         })
     
@@ -58,3 +66,431 @@ def test_cache_expire(cached_app):
     assert res.json['returns_from_cache'] == cached_calls
 
 
+def test_cache_warm(cached_app):
+    cached_app.config['IPERNITY_CACHE_WARM'] = [('explore.docs.getPopular', {})]
+    runner = cached_app.test_cli_runner()
+    res = runner.invoke(args = ['ipernity', 'cache', 'warm'])
+    assert res.exit_code == 0
+    assert 'refreshed' in res.output
+    res = runner.invoke(args = ['ipernity', 'cache', 'warm'])
+    assert 'fresh' in res.output
+    
+    client = cached_app.test_client()
+    res = client.get('/cache')
+    api_calls = res.json['api_calls']
+    cached_calls = res.json['returns_from_cache']
+    client.get('/explore')
+    res = client.get('/cache')
+    assert res.json['api_calls'] == api_calls
+    assert res.json['returns_from_cache'] == cached_calls + 1
+
+
+def test_memory_cache():
+    cache = MemoryCache(2)
+    cache.set('a', ('A', 0))
+    cache.set('b', ('B', 0))
+    assert cache.get('a') == ('A', 0)
+    cache.set('c', ('C', 0))
+    # b is the least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == ('A', 0)
+    assert cache.get('c') == ('C', 0)
+    assert cache.stats()['entries'] == 2
+
+
+def test_tiered_cache():
+    l2 = MemoryCache()
+    cache = TieredCache(MemoryCache(), l2, 0.5)
+    l2.set('a', ('A', 0))
+    assert cache.get('a') == ('A', 0)
+    assert cache.get('a') == ('A', 0)
+    assert cache.get_many(['a', 'b']) == [('A', 0), None]
+    # Changes in l2 are seen after the l1 timeout
+    l2.set('a', ('B', 0))
+    assert cache.get('a') == ('A', 0)
+    sleep(0.5)
+    assert cache.get('a') == ('B', 0)
+    
+    stats = cache.stats()
+    assert stats['l1_hits'] == 3
+    assert stats['l2_hits'] == 2
+    assert stats['misses'] == 1
+    assert stats['l1_hit_ratio'] == 0.5
+
+
+def test_redis_cache(redis_url):
+    cache = RedisCache(redis_url, keep = 60)
+    now = time()
+    cache.set('a', ('A', now))
+    cache.set('b', ('B', now))
+    assert cache.get('a') == ('A', now)
+    assert cache.get('c') is None
+    assert cache.get_many([]) == []
+    assert cache.get_many(['a', 'c', 'b']) == [('A', now), None, ('B', now)]
+    assert sorted(cache.items()) == [('a', ('A', now)), ('b', ('B', now))]
+    assert cache.stats() == {'entries': 2, 'hits': 3, 'misses': 2}
+    
+    # Entries are kept for ``keep`` seconds after they expired
+    assert 0 < cache._redis.ttl(cache.prefix + 'a') <= 60
+    
+    cache.delete('a')
+    assert cache.get('a') is None
+    cache.clear()
+    assert cache.stats()['entries'] == 0
+
+
+def _wait_subscribed(invalidation: RedisInvalidation, count: int):
+    for _ in range(50):
+        [(_, subscribed)] = invalidation._redis.pubsub_numsub(invalidation.channel)
+        if subscribed >= count:
+            break
+        sleep(0.02)
+    # The listeners clear the l1 caches after subscribing
+    sleep(0.05)
+
+
+def test_tiered_redis_cache(redis_url):
+    config = {
+        'IPERNITY_CACHE_L1_MAX_AGE':        60,
+        'IPERNITY_CACHE_L1_MAX_ENTRIES':    100,
+        'IPERNITY_CACHE_L1_INVALIDATE':     True,
+    }
+    # Two processes sharing the Redis cache
+    caches = [make_backend(redis_url, config) for _ in range(2)]
+    for cache in caches:
+        assert isinstance(cache, TieredCache)
+        assert isinstance(cache.l2, RedisCache)
+        assert isinstance(cache.invalidation, RedisInvalidation)
+        cache.get('x')
+    _wait_subscribed(caches[0].invalidation, 2)
+    
+    now = time()
+    caches[0].set('a', ('A', now))
+    assert caches[1].get('a') == ('A', now)
+    assert caches[1].get_many(['a', 'b']) == [('A', now), None]
+    stats = caches[1].stats()
+    assert stats['l1_hits'] == 1
+    assert stats['l2_hits'] == 1
+    assert stats['misses'] == 2
+    assert stats['l2_entries'] == 1
+    
+    # Changes are removed from the l1 cache of the other process
+    caches[0].set('a', ('B', now))
+    for _ in range(50):
+        if caches[1].get('a') == ('B', now):
+            break
+        sleep(0.02)
+    assert caches[1].get('a') == ('B', now)
+    
+    caches[0].clear()
+    for _ in range(50):
+        if caches[1].get('a') is None:
+            break
+        sleep(0.02)
+    assert caches[1].get('a') is None
+
+
+def test_redis_invalidation(redis_url):
+    sender = RedisInvalidation(redis_url, 'test')
+    receiver = RedisInvalidation(redis_url, 'test')
+    keys = []
+    sender.listen(lambda key: None)
+    receiver.listen(keys.append)
+    # The listener is started only once per process
+    thread = receiver._thread
+    receiver.listen(keys.append)
+    assert receiver._thread is thread
+    
+    # Subscribing reports that all keys changed
+    _wait_subscribed(receiver, 2)
+    assert keys == [None]
+    
+    sender.publish('a')
+    sender.publish(None)
+    receiver.publish('b')
+    for _ in range(50):
+        if len(keys) >= 3:
+            break
+        sleep(0.02)
+    sleep(0.05)
+    # Own messages are ignored
+    assert keys == [None, 'a', None]
+
+
+@pytest.fixture
+def fake_app(make_fake_app):
+    app = make_fake_app(IPERNITY_CACHE_REQUESTS = True)
+    
+    @app.route('/doc/<doc_id>')
+    def doc(doc_id):
+        return jsonify(ipernity.api.doc.get(doc_id = doc_id))
+    
+    return app
+
+
+def test_multiple_apps(fake):
+    ext = Ipernity()
+    apps = [Flask(__name__), Flask(__name__)]
+    objects = []
+    for app in apps:
+        app.config.update(
+            IPERNITY_API_URL = fake.url,
+            IPERNITY_BREAKER_THRESHOLD = 3,
+            IPERNITY_RATE_LIMIT = 10,
+        )
+        ext.init_app(app)
+        with app.app_context():
+            objects.append((
+                ipernity.shared_cache,
+                ipernity.executor,
+                ipernity.limiter,
+                ipernity.breaker,
+                ipernity.warmer,
+            ))
+    
+    # Each application has its own objects
+    for a, b in zip(*objects):
+        assert a is not b
+    with apps[0].app_context():
+        assert ipernity.shared_cache is objects[0][0]
+        assert ipernity.warmer.app is apps[0]
+
+
+@pytest.mark.parametrize('name', ['warmer', 'snapshot'])
+def test_start_once(make_fake_app, monkeypatch, tmp_path, name):
+    created = []
+    
+    class SlowThread(Thread):
+        def __init__(self, **kwargs):
+            sleep(0.05)
+            super().__init__(**kwargs)
+            created.append(self)
+    
+    monkeypatch.setattr('flask_ipernity.cache.Thread', SlowThread)
+    app = make_fake_app(IPERNITY_CACHE_SNAPSHOT = str(tmp_path / 'snapshot'))
+    with app.app_context():
+        obj = getattr(ipernity, name)
+    barrier = Barrier(4)
+    errors = []
+    
+    def start():
+        barrier.wait()
+        try:
+            obj.start()
+        except Exception as e:
+            errors.append(e)
+    
+    threads = [Thread(target = start) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    obj.stop()
+    # Requests starting the thread at the same time create only one
+    assert not errors
+    assert len(created) == 1
+
+
+def test_no_session_write(fake_app):
+    client = fake_app.test_client()
+    for i in range(2):
+        res = client.get('/doc/1')
+        assert res.status_code == 200
+        assert 'Set-Cookie' not in res.headers
+    assert fake_app.fake.calls == 1
+    with fake_app.app_context():
+        assert ipernity.metrics.get('api_calls') == 1
+        assert ipernity.metrics.get('returns_from_cache') == 1
+
+
+def test_no_auth_cache(fake_app):
+    with fake_app.test_request_context():
+        ipernity.set_token('frob')
+        assert ipernity.api.token == 'fake-token'
+        assert list(ipernity.shared_cache.items()) == []
+        
+        # Write methods are always sent to Ipernity
+        calls = fake_app.fake.calls
+        for i in range(2):
+            ipernity.api.doc.set(doc_id = 1, title = 'New')
+        assert fake_app.fake.calls == calls + 2
+        key = ipernity.api.cache_key('doc.set', {'doc_id': 1, 'title': 'New'})
+        assert ipernity.cache_backend.get(key) is None
+
+
+def test_negative_cache(fake_app):
+    with fake_app.test_request_context():
+        for i in range(2):
+            with pytest.raises(APIRequestError) as e:
+                ipernity.api.doc.get(doc_id = 0)
+            assert e.value.code == 1
+        assert fake_app.fake.calls == 1
+        
+        results = ipernity.call_many([('doc.get', {'doc_id': 0})])
+        assert isinstance(results[0], APIRequestError)
+        assert fake_app.fake.calls == 1
+
+
+def test_negative_cache_proxy(fake_app):
+    fake_app.fake.media = lambda doc_id, label: None
+    client = fake_app.test_client()
+    for i in range(2):
+        assert client.get('/ipernity/doc/1/500').status_code == 404
+    assert fake_app.fake.media_calls == 1
+    for i in range(2):
+        assert client.get('/ipernity/doc/0/500').status_code == 404
+    assert fake_app.fake.calls == 2
+
+
+def test_prefetch(fake_app):
+    with fake_app.test_request_context():
+        ipernity.api.doc.get(doc_id = 1)
+    
+    with fake_app.test_request_context():
+        calls = fake_app.fake.calls
+        hits = ipernity.shared_cache.stats()['hits']
+        ipernity.prefetch([('doc.get', {'doc_id': i}) for i in range(3)])
+        assert fake_app.fake.calls == calls + 2
+        assert ipernity.shared_cache.stats()['hits'] == hits + 1
+        
+        lookups = ipernity.shared_cache.stats()
+        assert ipernity.api.doc.get(doc_id = 1)['doc']['doc_id'] == '1'
+        assert ipernity.api.doc.get(doc_id = 2)['doc']['doc_id'] == '2'
+        with pytest.raises(APIRequestError):
+            ipernity.api.doc.get(doc_id = 0)
+        assert ipernity.shared_cache.stats() == lookups
+        assert fake_app.fake.calls == calls + 2
+
+
+@pytest.mark.parametrize('fake', [{'latency': 0.2}], indirect = True)
+def test_prefetch_timeout(fake_app):
+    with fake_app.test_request_context():
+        ipernity.prefetch([('doc.get', {'doc_id': 1})], timeout = 0.05)
+        # The timeout is not kept, the call is made again
+        assert ipernity.api.doc.get(doc_id = 1)['doc']['doc_id'] == '1'
+
+
+def test_snapshot(fake_app, tmp_path):
+    fake_app.config['IPERNITY_CACHE_SNAPSHOT'] = str(tmp_path / 'snapshot.gz')
+    with fake_app.test_request_context():
+        ipernity.api.doc.get(doc_id = 1)
+        ipernity.shared_cache.set('expired', ('X', 1))
+        assert ipernity.snapshot.save() == 1
+    
+    # A restarted application loads the snapshot
+    app = Flask(__name__)
+    app.config.update(fake_app.config)
+    Ipernity(app)
+    with app.test_request_context():
+        assert ipernity.snapshot.load() == 1
+        assert ipernity.shared_cache.get('expired') is None
+        calls = fake_app.fake.calls
+        assert ipernity.api.doc.get(doc_id = 1)['doc']['doc_id'] == '1'
+        assert fake_app.fake.calls == calls
+        # Entries already in the cache are kept
+        assert ipernity.snapshot.load() == 0
+
+
+def test_snapshot_no_tokens(fake_app, tmp_path):
+    path = tmp_path / 'snapshot.gz'
+    fake_app.config['IPERNITY_CACHE_SNAPSHOT'] = str(path)
+    with fake_app.test_request_context():
+        ipernity.api.doc.get(doc_id = 1)
+        # As stored by earlier versions
+        ipernity.shared_cache.set(
+            "auth.getTokenNone[('frob', 'old')]",
+            ({'auth': {'token': 'old-token'}}, time() + 60)
+        )
+        ipernity.set_token('frob')
+        ipernity.api.doc.get(doc_id = 2)
+        assert ipernity.snapshot.save() == 1
+    
+    with gzip.open(path, 'rt') as f:
+        keys = [json.loads(line)[0] for line in f.readlines()[1:]]
+    assert keys == ["doc.getNone[('doc_id', 1)]"]
+
+
+def test_mmap_cache(tmp_path):
+    path = str(tmp_path / 'cache')
+    cache = MmapCache(path, slots = 4, slot_size = 256, ways = 2)
+    cache.set('a', ({'doc': 'A'}, 10))
+    assert cache.get('a') == ({'doc': 'A'}, 10)
+    assert cache.get('b') is None
+    # Too large for a slot
+    cache.set('b', ('B' * 300, 10))
+    assert cache.get('b') is None
+    
+    # Other processes see the same entries
+    ctx = multiprocessing.get_context('fork')
+    process = ctx.Process(target = _mmap_set, args = (path, 'c', ('C', 10)))
+    process.start()
+    process.join()
+    assert cache.get('c') == ('C', 10)
+    
+    # Full buckets drop the least recently used entry
+    for i in range(10):
+        cache.set(str(i), (i, 10))
+    stats = cache.stats()
+    assert stats['entries'] == 4
+    assert stats['too_large'] == 1
+    cache.clear()
+    assert cache.stats()['entries'] == 0
+
+
+def _mmap_set(path, key, entry):
+    MmapCache(path, slots = 4, slot_size = 256, ways = 2).set(key, entry)
+
+
+def test_user_identity(fake_app):
+    fake_app.config['IPERNITY_CACHE_BACKEND'] = 'memory'
+    user = {'user': {'user_id': '1'}, 'permissions': {'doc': 'read'}}
+    with fake_app.test_request_context():
+        ipernity.make_api(dict(user, token = 'token1')).doc.get(doc_id = 1)
+        calls = fake_app.fake.calls
+        
+        # A new token of the same user uses the same entries
+        ipernity.session_set('token', dict(user, token = 'token2'))
+        ipernity.api.doc.get(doc_id = 1)
+        assert fake_app.fake.calls == calls
+        
+        # Other permissions don't
+        other = dict(user, token = 'token3', permissions = {'doc': 'write'})
+        ipernity.make_api(other).doc.get(doc_id = 1)
+        assert fake_app.fake.calls == calls + 1
+        
+        ipernity.logout()
+    
+    with fake_app.test_request_context():
+        ipernity.make_api(dict(user, token = 'token4')).doc.get(doc_id = 1)
+        assert fake_app.fake.calls == calls + 2
+
+
+def test_adaptive_ttl(fake_app):
+    fake_app.config.update(
+        IPERNITY_CACHE_MAX_AGE = 10,
+        IPERNITY_CACHE_ADAPTIVE_MAX_AGE = 30,
+    )
+    with fake_app.test_request_context():
+        api = ipernity.make_api(None)
+        cache = ipernity.shared_cache
+        key = api.cache_key('doc.get', {'doc_id': 1})
+        timeouts = []
+        for padding in (0, 0, 0, 0, 5):
+            fake_app.fake.padding = padding
+            assert api.lookup('doc.get', {'doc_id': 1}) == (False, None)
+            api.store('doc.get', {'doc_id': 1}, api.fetch('doc.get', doc_id = 1))
+            entry = cache.get(key)
+            timeouts.append(entry[2])
+            # Let the entry expire
+            cache.set(key, (entry[0], 0) + entry[2:])
+        assert timeouts == [10, 20, 30, 30, 15]
+        # The previous entry is the one found by lookup
+        stats = cache.stats()
+        assert stats['hits'] + stats['misses'] == 10
+        assert ipernity.metrics.get('ttl_extended') == 3
+        assert ipernity.metrics.get('ttl_reduced') == 1
+    
+    res = fake_app.test_cli_runner().invoke(args = ['ipernity', 'cache', 'ttls'])
+    assert res.exit_code == 0
+    assert '1 entries, 1 with adaptive timeout' in res.output
+    assert '      15 ' in res.output
@@ -0,0 +1,69 @@
+"""
+Tests concurrent API calls
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import TimeoutError
+from logging import getLogger
+from time import monotonic
+from typing import Callable, TYPE_CHECKING
+
+from flask import jsonify
+from ipernity import APIRequestError
+import pytest
+
+from flask_ipernity import Ipernity, ipernity
+
+if TYPE_CHECKING:
+    from flask import Flask
+
+
+log = getLogger(__name__)
+
+
+@pytest.fixture(params = [False, True])
+def app(base_app: Flask, request) -> Flask:
+    a = base_app
+    a.config['IPERNITY_CACHE_REQUESTS'] = request.param
+    Ipernity(a)
+    
+    @a.route('/many')
+    def many():
+        results = ipernity.call_many([
+            ('doc.get', {'doc_id': 52222822}),
+            ('explore.docs.getPopular', {}),
+            ('doc.get', {'doc_id': 0}),
+        ])
+        return jsonify([
+            type(res).__name__ if isinstance(res, Exception) else res
+            for res in results
+        ])
+    
+    return a
+
+
+def test_call_many(app):
+    client = app.test_client()
+    for _ in range(2):
+        res = client.get('/many')
+        doc, popular, missing = res.json
+        assert doc['doc']['doc_id'] == '52222822'
+        assert 'docs' in popular
+        assert missing == APIRequestError.__name__
+
+
+@pytest.mark.parametrize('fake', [{'latency': 0.4}], indirect = True)
+def test_call_many_timeout(make_fake_app: Callable[..., Flask]):
+    app = make_fake_app(IPERNITY_MAX_WORKERS = 4)
+    with app.test_request_context():
+        start = monotonic()
+        results = ipernity.call_many(
+            [('doc.get', {'doc_id': i}) for i in range(1, 9)],
+            timeout = 0.5
+        )
+        # The timeout applies to all calls together
+        assert monotonic() - start < 0.7
+        timeouts = [isinstance(res, TimeoutError) for res in results]
+        assert timeouts == [False] * 4 + [True] * 4
+
@@ -0,0 +1,93 @@
+"""
+Tests the flask ipernity commands
+"""
+
+from __future__ import annotations
+
+from logging import getLogger
+from typing import TYPE_CHECKING
+
+from flask import Flask
+import pytest
+
+from flask_ipernity import Ipernity, ipernity
+
+if TYPE_CHECKING:
+    from flask.testing import FlaskCliRunner
+
+
+log = getLogger(__name__)
+
+
+@pytest.fixture
+def app() -> Flask:
+    a = Flask(__name__)
+    a.config.update(
+        IPERNITY_APP_KEY = 'key',
+        IPERNITY_APP_SECRET = 'secret',
+        IPERNITY_CACHE_REQUESTS = True,
+        IPERNITY_CACHE_BACKEND = 'memory',
+    )
+    Ipernity(a)
+    return a
+
+
+@pytest.fixture
+def runner(app: Flask) -> FlaskCliRunner:
+    return app.test_cli_runner()
+
+
+def test_stats_purge(app, runner, tmp_path):
+    app.config['IPERNITY_SHARED_CACHE_BACKEND'] = f'mmap:{tmp_path / "cache"}'
+    with app.app_context():
+        ipernity.shared_cache.set('key', ('value', 0))
+    res = runner.invoke(args = ['ipernity', 'cache', 'stats'])
+    assert res.exit_code == 0
+    assert 'entries: 1' in res.output
+    assert 'Warning: the user cache' in res.output
+    assert 'shared cache is stored' not in res.output
+    res = runner.invoke(args = ['ipernity', 'cache', 'purge', '--no-user'])
+    assert res.exit_code == 0, res.output
+    assert 'Shared cache purged' in res.output
+    with app.app_context():
+        assert ipernity.shared_cache.stats()['entries'] == 0
+
+
+def test_purge_memory(app, runner):
+    with app.app_context():
+        ipernity.shared_cache.set('key', ('value', 0))
+    res = runner.invoke(args = ['ipernity', 'cache', 'stats'])
+    assert res.exit_code == 0
+    assert 'Shared cache:\n  entries: 1' in res.output
+    assert 'Warning: the shared cache is stored in each process' in res.output
+    res = runner.invoke(args = ['ipernity', 'cache', 'purge'])
+    assert res.exit_code != 0
+    assert 'cache purged' not in res.output
+    assert 'user cache and shared cache cannot be purged' in res.output
+    with app.app_context():
+        assert ipernity.shared_cache.stats()['entries'] == 1
+
+
+def test_bench(runner):
+    res = runner.invoke(args = [
+        'ipernity', 'cache', 'bench', '--repeat', '2', '--latency', '0'
+    ])
+    assert res.exit_code == 0
+    lines = res.output.splitlines()
+    uncached = lines[-2].split()
+    cached = lines[-1].split()
+    assert uncached[0] == 'uncached'
+    assert cached[0] == 'cached'
+    # Cached calls only go upstream once per distinct call
+    assert int(cached[2]) < int(uncached[2])
+
+
+
+def test_bench_no_calls(runner, tmp_path):
+    calls = tmp_path / 'calls.jsonl'
+    calls.write_text('')
+    res = runner.invoke(args = [
+        'ipernity', 'cache', 'bench', '--calls', str(calls), '--latency', '0'
+    ])
+    assert res.exit_code == 0, res.output
+    assert res.output.splitlines()[-1].split()[:3] == ['cached', '0', '0']
@@ -0,0 +1,63 @@
+"""
+Tests the responsive image helpers
+"""
+
+from __future__ import annotations
+
+from logging import getLogger
+
+from flask import render_template_string
+
+from flask_ipernity.images import Thumb, img, pick_thumb, srcset, thumbs
+
+
+log = getLogger(__name__)
+
+
+def test_pick_thumb():
+    available = [Thumb('100', 100, 75), Thumb('240', 240, 180), Thumb('500', 500, 375)]
+    assert pick_thumb(available, 50).label == '100'
+    assert pick_thumb(available, 240).label == '240'
+    assert pick_thumb(available, 241).label == '500'
+    assert pick_thumb(available, 2000).label == '500'
+    assert pick_thumb([], 240) is None
+
+
+def test_img(fake_app):
+    with fake_app.test_request_context():
+        labels = [t.label for t in thumbs(1)]
+        assert labels[0] == '100'
+        assert '75x' not in labels
+        
+        assert srcset(1, 300) == ', '.join([
+            '/ipernity/doc/1/100 100w',
+            '/ipernity/doc/1/240 240w',
+            '/ipernity/doc/1/500 500w',
+        ])
+        
+        tag = img(1, 200, alt = 'A "doc"', class_ = 'thumb')
+        assert tag.startswith('<img src="/ipernity/doc/1/240" ')
+        assert '/ipernity/doc/1/500 500w"' in tag
+        assert '560w' not in tag
+        assert 'sizes="200px" width="200" height="150"' in tag
+        assert 'alt="A &#34;doc&#34;" class="thumb"' in tag
+        
+        rendered = render_template_string('{{ ipernity_img(1, 600, class="big") }}')
+        assert rendered.startswith('<img src="/ipernity/doc/1/640" ')
+        assert 'class="big"' in rendered
+
+
+def test_img_no_thumbs(fake_app):
+    fake_app.fake.thumbs = {'75x': 75}
+    with fake_app.test_request_context():
+        assert thumbs(1) == []
+        assert srcset(1, 300) == ''
+        
+        # Falls back to the original
+        tag = img(1, 200)
+        assert tag.startswith('<img src="/ipernity/doc/1/original" ')
+        assert 'srcset' not in tag
+        assert 'width="200" height="150"' in tag
+        
+        rendered = render_template_string('{{ ipernity_img(1, 600) }}')
+        assert rendered.startswith('<img src="/ipernity/doc/1/original" ')
@@ -0,0 +1,43 @@
+"""
+Tests that optional subsystems are only imported when they are used
+"""
+
+from __future__ import annotations
+
+import subprocess
+import sys
+from logging import getLogger
+
+
+log = getLogger(__name__)
+
+
+code = """
+import sys
+from flask import Flask
+from flask_ipernity import Ipernity
+
+app = Flask(__name__)
+app.config.update(SECRET_KEY = 'secret', IPERNITY_APP_KEY = 'key')
+Ipernity(app)
+with app.test_request_context():
+    app.preprocess_request()
+print(' '.join(sorted(sys.modules)))
+"""
+
+
+def test_lazy_imports():
+    res = subprocess.run(
+        [sys.executable, '-c', code],
+        capture_output = True,
+        check = True,
+        text = True
+    )
+    modules = res.stdout.split()
+    assert 'flask_ipernity.ext' in modules
+    for module in (
+        'requests', 'ipernity', 'flask_login', 'concurrent.futures',
+        'flask_ipernity.cache', 'flask_ipernity.upstream',
+    ):
+        assert module not in modules
+
@@ -0,0 +1,142 @@
+"""
+Tests the local metadata index
+"""
+
+from __future__ import annotations
+
+from logging import getLogger
+from threading import Barrier, Thread
+from time import sleep
+from typing import Callable
+
+from flask import Flask
+import pytest
+
+from flask_ipernity import Ipernity, ipernity
+from flask_ipernity.index import MetadataIndex
+
+
+log = getLogger(__name__)
+
+
+pytestmark = pytest.mark.parametrize('fake', [{'total': 250}], indirect = True)
+
+
+@pytest.fixture
+def app(make_fake_app: Callable[..., Flask], tmp_path) -> Flask:
+    return make_fake_app(
+        IPERNITY_INDEX = str(tmp_path / 'index.sqlite'),
+        IPERNITY_INDEX_ACCOUNTS = ['token'],
+    )
+
+
+def test_index_sync(app, fake):
+    with app.app_context():
+        index = ipernity.index
+        
+        # The first sync is a full sync
+        assert index.sync() == {'docs': 250, 'albums': 3, 'deleted': 0}
+        assert index.stats()['docs'] == 250
+        assert index.stats()['albums'] == 3
+        
+        # Nothing changed: one page of documents and the albums
+        calls = fake.calls
+        assert index.sync() == {'docs': 0, 'albums': 0, 'deleted': 0}
+        assert fake.calls - calls == 3
+        
+        # Changed documents are updated, albums are unchanged
+        fake.padding = 10
+        assert index.sync() == {'docs': 250, 'albums': 0, 'deleted': 0}
+        assert index.doc(1)['description'] == 'x' * 10
+        
+        # Deleted documents are only removed by a full sync
+        fake.total = 200
+        assert index.sync() == {'docs': 0, 'albums': 3, 'deleted': 0}
+        assert index.sync(full = True) == {'docs': 0, 'albums': 3, 'deleted': 50}
+        assert index.count_docs() == 200
+        assert index.doc(201) is None
+        
+        # Full syncs are repeated after IPERNITY_INDEX_FULL_SYNC_INTERVAL
+        fake.total = 150
+        assert index.sync()['deleted'] == 0
+        index.db.execute('UPDATE accounts SET full_sync = full_sync - 86400')
+        index.db.commit()
+        assert index.sync()['deleted'] == 50
+        assert index.count_docs() == 150
+
+
+def test_index_no_memoize(app, monkeypatch):
+    apis = []
+    make_api = Ipernity.make_api
+    
+    def record(self, *args, **kwargs):
+        apis.append(make_api(self, *args, **kwargs))
+        return apis[-1]
+    
+    monkeypatch.setattr(Ipernity, 'make_api', record)
+    with app.app_context():
+        ipernity.index.sync()
+    assert apis
+    assert not any(api.memoize or api._remembered for api in apis)
+
+
+def test_index_sync_lock(app):
+    with app.app_context():
+        indexes = [MetadataIndex(app) for _ in range(2)]
+        # Only one of them runs the background sync
+        assert indexes[0]._lock()
+        assert indexes[0]._lock()
+        assert not indexes[1]._lock()
+        # The other one takes over
+        indexes[0]._unlock()
+        assert indexes[1]._lock()
+        indexes[1]._unlock()
+
+
+def test_index_start(app, monkeypatch):
+    created = []
+    
+    class SlowThread(Thread):
+        def __init__(self, **kwargs):
+            sleep(0.05)
+            super().__init__(**kwargs)
+            created.append(self)
+    
+    monkeypatch.setattr('flask_ipernity.index.Thread', SlowThread)
+    with app.app_context():
+        index = ipernity.index
+    barrier = Barrier(4)
+    errors = []
+    
+    def start():
+        barrier.wait()
+        try:
+            index.start()
+        except Exception as e:
+            errors.append(e)
+    
+    threads = [Thread(target = start) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    index.stop()
+    # Requests starting the sync at the same time create only one thread
+    assert not errors
+    assert len(created) == 1
+
+
+def test_index_query(app):
+    with app.app_context():
+        index = ipernity.index
+        index.sync()
+        
+        assert [d['doc_id'] for d in index.docs(limit = 3)] == ['250', '249', '248']
+        album = index.docs(album_id = 2, limit = 3)
+        assert [d['doc_id'] for d in album] == ['1', '2', '3']
+        assert index.count_docs(account = '1', album_id = 2) == 250
+        assert index.count_docs(account = '2') == 0
+        assert index.count_docs(search = 'Document 12') == 11
+        assert index.count_docs(search = '%') == 0
+        assert index.count_docs(media = 'photo') == 250
+        assert [a['title'] for a in index.albums()] == ['Album 1', 'Album 2', 'Album 3']
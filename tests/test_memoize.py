@@ -0,0 +1,64 @@
+"""
+Tests request-scoped memoization of API calls
+"""
+
+from __future__ import annotations
+
+from logging import getLogger
+
+from ipernity import APIRequestError
+import pytest
+
+from flask_ipernity import ipernity
+from flask_ipernity.api import is_read_method
+
+
+log = getLogger(__name__)
+
+
+def test_is_read_method():
+    assert is_read_method('doc.get')
+    assert is_read_method('album.docs.getList')
+    assert not is_read_method('doc.set')
+    assert not is_read_method('auth.getToken')
+    assert not is_read_method('upload.checkTickets')
+    assert not is_read_method('unknown.method')
+
+
+def test_memoize(fake_app, fake):
+    with fake_app.test_request_context():
+        calls = fake.calls
+        for i in range(3):
+            assert ipernity.api.doc.get(doc_id = 1)['doc']['doc_id'] == '1'
+        for i in range(2):
+            with pytest.raises(APIRequestError):
+                ipernity.api.doc.get(doc_id = 0)
+        assert fake.calls == calls + 2
+        
+        # Writes forget the results
+        ipernity.api.doc.set(doc_id = 1, title = 'New')
+        ipernity.api.doc.get(doc_id = 1)
+        assert fake.calls == calls + 4
+    
+    # Results are not kept across requests
+    with fake_app.test_request_context():
+        ipernity.api.doc.get(doc_id = 1)
+        assert fake.calls == calls + 5
+
+
+@pytest.mark.parametrize('fake_app', [{'IPERNITY_MEMOIZE': False}], indirect = True)
+def test_memoize_disabled(fake_app, fake):
+    with fake_app.test_request_context():
+        calls = fake.calls
+        ipernity.api.doc.get(doc_id = 1)
+        ipernity.api.doc.get(doc_id = 1)
+        assert fake.calls == calls + 2
+
+
+def test_memoize_make_api(fake_app, fake):
+    with fake_app.app_context():
+        api = ipernity.make_api(None, cached = False, memoize = False)
+        calls = fake.calls
+        api.doc.get(doc_id = 1)
+        api.doc.get(doc_id = 1)
+        assert fake.calls == calls + 2
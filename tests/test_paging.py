@@ -0,0 +1,155 @@
+"""
+Tests iteration over paged results
+"""
+
+from __future__ import annotations
+
+import json
+from logging import getLogger
+
+from flask import request
+import pytest
+
+from flask_ipernity import ipernity
+from flask_ipernity.cache import MemoryCache
+from flask_ipernity.paging import page_items
+
+
+log = getLogger(__name__)
+
+
+def test_page_items():
+    items, pages = page_items({
+        'docs': {
+            'page': '1', 'pages': '3', 'per_page': '2', 'total': '5',
+            'doc': [{'doc_id': '1'}, {'doc_id': '2'}],
+        },
+        'api': {'status': 'ok'},
+    })
+    assert pages == 3
+    assert [d['doc_id'] for d in items] == ['1', '2']
+
+
+def test_page_items_nested():
+    items, pages = page_items({
+        'album': {
+            'album_id': '4711',
+            'docs': {
+                'page': '2', 'pages': '2', 'per_page': '100', 'total': '101',
+                'doc': {'doc_id': '3'},
+            },
+        },
+        'api': {'status': 'ok'},
+    })
+    assert pages == 2
+    assert items == [{'doc_id': '3'}]
+
+
+def test_page_items_total():
+    items, pages = page_items({
+        'albums': {
+            'per_page': '2', 'total': '5',
+            'album': [{'album_id': '1'}, {'album_id': '2'}],
+        },
+        'api': {'status': 'ok'},
+    })
+    assert pages == 3
+    assert len(items) == 2
+
+
+def test_page_items_no_list():
+    with pytest.raises(ValueError):
+        page_items({'user': {'user_id': '1'}, 'api': {'status': 'ok'}})
+
+
+@pytest.mark.parametrize('fake', [{'total': 45}], indirect = True)
+@pytest.mark.parametrize('prefetch', [False, True])
+def test_iter_pages(make_fake_app, fake, prefetch):
+    app = make_fake_app(IPERNITY_CACHE_REQUESTS = True)
+    for calls in (3, 0):
+        start = fake.calls
+        with app.test_request_context():
+            docs = list(ipernity.iter_pages(
+                'album.docs.getList',
+                prefetch = prefetch,
+                album_id = 1,
+                per_page = 20
+            ))
+        assert [d['doc_id'] for d in docs] == [str(i) for i in range(1, 46)]
+        # Cached pages are not requested again
+        assert fake.calls == start + calls
+
+
+@pytest.mark.parametrize('fake', [{'total': 45}], indirect = True)
+def test_iter_pages_prefetch_error(make_fake_app, fake):
+    class FailingCache(MemoryCache):
+        gets = 0
+        
+        def get(self, key):
+            self.gets += 1
+            if self.gets == 2:
+                raise ConnectionError('Cache unavailable')
+            return super().get(key)
+    
+    app = make_fake_app(
+        IPERNITY_CACHE_REQUESTS = True,
+        IPERNITY_SHARED_CACHE_BACKEND = FailingCache(),
+    )
+    with app.test_request_context():
+        docs = list(ipernity.iter_pages(
+            'album.docs.getList',
+            prefetch = True,
+            album_id = 1,
+            per_page = 20
+        ))
+    # The lookup of the second page failed, it was requested without prefetching
+    assert [d['doc_id'] for d in docs] == [str(i) for i in range(1, 46)]
+    assert fake.calls == 3
+
+
+@pytest.fixture
+def list_app(make_fake_app):
+    app = make_fake_app()
+    
+    @app.route('/albums/<album_id>/docs')
+    def album_docs(album_id):
+        return ipernity.list_response(
+            'album.docs.getList',
+            ndjson = 'ndjson' in request.args,
+            album_id = album_id,
+            per_page = 20
+        )
+    
+    return app
+
+
+@pytest.mark.parametrize('fake', [{'total': 45}], indirect = True)
+def test_list_response(list_app):
+    client = list_app.test_client()
+    res = client.get('/albums/1/docs')
+    assert res.status_code == 200
+    assert res.is_streamed
+    assert res.content_type == 'application/json'
+    assert [d['doc_id'] for d in res.json] == [str(i) for i in range(1, 46)]
+    
+    res = client.get('/albums/1/docs?ndjson')
+    assert res.content_type == 'application/x-ndjson'
+    docs = [json.loads(line) for line in res.get_data(as_text = True).splitlines()]
+    assert [d['doc_id'] for d in docs] == [str(i) for i in range(1, 46)]
+
+
+@pytest.mark.parametrize('fake', [{'total': 0}], indirect = True)
+def test_list_response_empty(list_app):
+    client = list_app.test_client()
+    assert client.get('/albums/1/docs').json == []
+    assert client.get('/albums/1/docs?ndjson').data == b''
+
+
+def test_list_response_error(list_app):
+    client = list_app.test_client()
+    assert client.get('/albums/0/docs').status_code == 404
+    list_app.fake.respond = lambda method_name, params: {
+        'api': {'status': 'error', 'code': '100', 'message': 'Failed'}
+    }
+    assert client.get('/albums/1/docs').status_code == 502
+
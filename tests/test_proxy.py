@@ -2,14 +2,21 @@
 
 from __future__ import annotations
 
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from logging import getLogger
-from typing import Any, TYPE_CHECKING
+from time import sleep, time
+from typing import Any, Callable, TYPE_CHECKING
+from zipfile import ZipFile
 
-from flask_ipernity import Ipernity
+from flask import Flask
+from flask_ipernity import Ipernity, ipernity
+from flask_ipernity.proxy import signed_url
 import pytest
 
 if TYPE_CHECKING:
-    from flask import Flask
     from flask.testing import FlaskClient
 
 
@@ -37,3 +44,184 @@ def test_proxy_image(client):
     assert len(imgdata) == 1604
 
 
+@pytest.fixture
+def fake_app(make_fake_app: Callable[..., Flask], tmp_path) -> Flask:
+    return make_fake_app(IPERNITY_MEDIA_CACHE_DIR = str(tmp_path / 'media'))
+
+
+@pytest.mark.parametrize(
+    'fake', [{'latency': 0.3, 'media_size': 4 * 1024 * 1024}], indirect = True
+)
+def test_proxy_single_flight(fake_app):
+    def get(i):
+        res = fake_app.test_client().get('/ipernity/doc/1/original')
+        return res.status_code, res.content_type, len(res.data)
+    
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(get, range(8)))
+    assert results == [(200, 'image/jpeg', 4 * 1024 * 1024)] * 8
+    assert fake_app.fake.media_calls == 1
+    
+    # Served from the media cache
+    res = fake_app.test_client().get('/ipernity/doc/1/original')
+    assert len(res.data) == 4 * 1024 * 1024
+    assert fake_app.fake.media_calls == 1
+    
+    # Errors are passed to all waiting requests
+    fake_app.fake.media = lambda doc_id, label: None
+    with ThreadPoolExecutor(4) as pool:
+        statuses = list(pool.map(
+            lambda i: fake_app.test_client().get('/ipernity/doc/2/500').status_code,
+            range(4)
+        ))
+    assert statuses == [404] * 4
+
+
+@pytest.mark.parametrize('status', [410, 302, 400])
+def test_proxy_upstream_status(fake_app, status):
+    media = fake_app.fake.media
+    fake_app.fake.media = lambda doc_id, label: status
+    client = fake_app.test_client()
+    for _ in range(2):
+        assert client.get('/ipernity/doc/1/original').status_code == 502
+    # Nothing was stored in the media cache
+    assert fake_app.fake.media_calls == 2
+    with fake_app.app_context():
+        assert ipernity.media_cache.stats()['files'] == 0
+    
+    fake_app.fake.media = media
+    res = client.get('/ipernity/doc/1/original')
+    assert res.status_code == 200
+    assert len(res.data) == fake_app.fake.media_size
+
+
+def test_proxy_stream(make_fake_app, monkeypatch):
+    def mkstemp(*args, **kwargs):
+        raise AssertionError('Media spooled to a temporary file')
+    
+    monkeypatch.setattr('tempfile.mkstemp', mkstemp)
+    app = make_fake_app()
+    with app.app_context():
+        assert ipernity.media_cache is None
+    
+    client = app.test_client()
+    for _ in range(2):
+        res = client.get('/ipernity/doc/1/original')
+        assert res.status_code == 200
+        assert res.content_type == 'image/jpeg'
+        assert res.is_streamed
+        assert res.data == app.fake.media('1', 'original')
+    # Without a media cache, every request is a download
+    assert app.fake.media_calls == 2
+    
+    app.fake.media = lambda doc_id, label: None
+    assert client.get('/ipernity/doc/1/original').status_code == 404
+
+
+def test_media_cache_sweep(tmp_path):
+    from flask_ipernity.mediacache import MediaCache
+    
+    media = MediaCache(str(tmp_path), max_age = 100, max_size = 25)
+    now = time()
+    paths = []
+    for i, age in enumerate([200, 30, 20, 10]):
+        path = media._path(f'https://cdn/{i}')
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        for name in (path, path + '.json'):
+            with open(name, 'wb') as f:
+                f.write(b'x' * 10)
+            os.utime(name, (now - age, now - age))
+        paths.append(path)
+    # Left by a crashed process, and still being written
+    parts = [str(tmp_path / 'old.part'), str(tmp_path / 'new.part')]
+    for part in parts:
+        open(part, 'wb').close()
+    os.utime(parts[0], (now - 7200, now - 7200))
+    orphan = media._path('https://cdn/orphan') + '.json'
+    os.makedirs(os.path.dirname(orphan), exist_ok = True)
+    open(orphan, 'wb').close()
+    
+    # The expired file and the oldest one beyond the size limit
+    assert media.sweep() == 2
+    assert [os.path.exists(p) for p in paths] == [False, False, True, True]
+    assert [os.path.exists(p + '.json') for p in paths] == [False, False, True, True]
+    assert [os.path.exists(p) for p in parts] == [False, True]
+    assert not os.path.exists(orphan)
+    assert media.stats()['size'] == 20
+
+
+def test_proxy_signed(fake_app):
+    fake_app.config['IPERNITY_PROXY_SIGNED_MAX_AGE'] = 60
+    with fake_app.test_request_context():
+        url = signed_url(1, '240')
+        assert url.startswith('/ipernity/media/')
+        assert signed_url(1, '240') == url
+        with pytest.raises(LookupError):
+            signed_url(1, 'unknown')
+    
+    calls = fake_app.fake.calls
+    # Streamed from Ipernity, then served from the media cache
+    for i in range(2):
+        if i:
+            with fake_app.app_context():
+                for _ in range(50):
+                    if ipernity.media_cache.stats()['files']:
+                        break
+                    sleep(0.02)
+                assert ipernity.media_cache.stats()['files'] == 1
+        res = fake_app.test_client().get(url)
+        assert res.status_code == 200
+        assert res.content_type == 'image/jpeg'
+        assert res.cache_control.public
+        assert not res.cache_control.no_cache
+        assert 'no-cache' not in res.headers['Cache-Control']
+        assert 60 <= res.cache_control.max_age <= 120
+        assert 'Set-Cookie' not in res.headers
+    assert fake_app.fake.calls == calls
+    assert fake_app.fake.media_calls == 1
+    
+    assert fake_app.test_client().get(url + 'x').status_code == 404
+
+
+def test_proxy_signed_token(fake_app):
+    from itsdangerous import URLSafeSerializer
+    
+    with fake_app.test_request_context():
+        url = signed_url(1, '240')
+    token = url.rsplit('/', 1)[1]
+    payload = URLSafeSerializer('x').loads_unsafe(token)[1]
+    # The token does not reveal the file's address
+    assert payload[:2] == ['1', '240']
+    assert fake_app.fake.url not in json.dumps(payload)
+    
+    # Without the shared cache entry, the address is asked from Ipernity
+    with fake_app.app_context():
+        ipernity.shared_cache.clear()
+    calls = fake_app.fake.calls
+    res = fake_app.test_client().get(url)
+    assert res.status_code == 200
+    assert res.content_type == 'image/jpeg'
+    assert 'Set-Cookie' not in res.headers
+    assert fake_app.fake.calls == calls + 1
+
+
+def test_proxy_album(fake_app):
+    fake = fake_app.fake
+    fake.total = 6
+    fake.media_size = 256 * 1024
+    media = fake.media
+    fake.media = lambda doc_id, label: None if doc_id == '3' else media(doc_id, label)
+    
+    res = fake_app.test_client().get('/ipernity/album/1.zip')
+    assert res.status_code == 200
+    assert res.content_type == 'application/zip'
+    assert res.is_streamed
+    with ZipFile(BytesIO(res.data)) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == [f'IMG_{i}.jpg' for i in (1, 2, 4, 5, 6)]
+        assert [i.file_size for i in zf.infolist()] == [256 * 1024] * 5
+        # Written with ZIP64 headers, as the sizes are not known in advance
+        assert all(i.extract_version >= 45 for i in zf.infolist())
+    
+    assert fake_app.test_client().get('/ipernity/album/0.zip').status_code == 404
+
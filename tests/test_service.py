@@ -0,0 +1,62 @@
+"""
+Tests service tokens
+"""
+
+from __future__ import annotations
+
+from logging import getLogger
+from typing import Callable
+
+from flask import Flask, jsonify
+import pytest
+
+from flask_ipernity import ipernity, ipernity_auth_required
+
+
+log = getLogger(__name__)
+
+
+@pytest.fixture
+def app(make_fake_app: Callable[..., Flask]) -> Flask:
+    a = make_fake_app(
+        IPERNITY_CACHE_REQUESTS = True,
+        IPERNITY_SERVICE_TOKEN = ['token1', 'token2'],
+    )
+    
+    @a.route('/doc')
+    def doc():
+        return jsonify({
+            'token':    ipernity.api.token,
+            'doc':      ipernity.api.doc.get(doc_id = 1),
+        })
+    
+    @a.route('/private')
+    @ipernity_auth_required()
+    def private():
+        return 'private'
+    
+    return a
+
+
+def test_service_token(app, fake):
+    calls = fake.calls
+    client = app.test_client()
+    tokens = [client.get('/doc').json['token'] for i in range(3)]
+    assert tokens == ['token1', 'token2', 'token1']
+    # Results are shared by all service tokens
+    assert fake.calls == calls + 1
+    
+    with app.app_context():
+        assert ipernity.api.service
+        assert ipernity.shared_cache.stats()['entries'] == 1
+
+
+def test_service_not_authenticated(app):
+    res = app.test_client().get('/private')
+    assert res.status_code == 302
+    
+    with app.test_request_context():
+        ipernity.session_set('token', {'token': 'user', 'user': {'user_id': '1'}})
+        assert ipernity.api.token == 'user'
+        assert not ipernity.api.service
+
@@ -0,0 +1,57 @@
+"""
+Tests tracing of API calls
+"""
+
+from __future__ import annotations
+
+from logging import getLogger
+from typing import Callable
+
+from flask import Flask, jsonify
+import pytest
+
+from flask_ipernity import ipernity
+from flask_ipernity.tracing import request_traced
+
+
+log = getLogger(__name__)
+
+
+@pytest.fixture
+def app(make_fake_app: Callable[..., Flask]) -> Flask:
+    a = make_fake_app(IPERNITY_CACHE_REQUESTS = True, IPERNITY_TRACE = True)
+    
+    @a.route('/docs')
+    def docs():
+        ipernity.api.doc.get(doc_id = 1)
+        ipernity.api.doc.get(doc_id = 1)
+        ipernity.call_many([('doc.get', {'doc_id': 2}), ('doc.get', {'doc_id': 0})])
+        return jsonify(ipernity.tracer.summary())
+    
+    return a
+
+
+def test_trace(app):
+    traced = []
+    
+    def receive(sender, tracer, response):
+        traced.append(tracer)
+    
+    with request_traced.connected_to(receive, app):
+        res = app.test_client().get('/docs')
+    
+    assert res.status_code == 200
+    assert res.json['calls'] == 4
+    assert res.json['outcome'] == {'miss': 2, 'hit': 1, 'error': 1}
+    assert res.json['method'] == {'doc.get': 4}
+    
+    timing = res.headers['Server-Timing']
+    assert timing.startswith('ipernity;dur=')
+    assert 'desc="4 calls, 1 from cache"' in timing
+    assert 'ipernity-3;' in timing
+    
+    assert len(traced) == 1
+    assert traced[0].records[0].method == 'doc.get'
+    assert traced[0].records[0].size > 0
+    assert traced[0].records[0].kwargs == {'doc_id': 1}
+
@@ -0,0 +1,109 @@
+"""
+Tests rate limiting of upstream calls
+"""
+
+from __future__ import annotations
+
+from logging import getLogger
+from threading import Thread
+from time import monotonic, sleep
+
+import pytest
+from ipernity import APIRequestError
+
+from flask_ipernity.upstream import (
+    CircuitBreaker, CircuitOpen, RateLimitExceeded, RedisTokenBucket, TokenBucket,
+    UpstreamLimiter
+)
+
+
+log = getLogger(__name__)
+
+
+def test_token_bucket():
+    bucket = TokenBucket(20, 2)
+    start = monotonic()
+    for _ in range(4):
+        bucket.acquire()
+    # Two calls from the burst, two more at 20/s
+    assert 0.08 < monotonic() - start < 0.5
+    with pytest.raises(RateLimitExceeded):
+        bucket.acquire(0)
+
+
+def test_redis_token_bucket(redis_url):
+    # Two processes sharing the bucket
+    buckets = [RedisTokenBucket(redis_url, 20, 2) for _ in range(2)]
+    start = monotonic()
+    for i in range(4):
+        buckets[i % 2].acquire()
+    # Two calls from the burst, two more at 20/s
+    assert 0.08 < monotonic() - start < 0.5
+    with pytest.raises(RateLimitExceeded):
+        buckets[0].acquire(0)
+    with pytest.raises(RateLimitExceeded):
+        buckets[1].acquire(0)
+
+
+def test_concurrency_limit():
+    limiter = UpstreamLimiter(max_concurrency = 2, timeout = 0.05)
+    
+    def call():
+        with limiter:
+            sleep(0.2)
+    
+    threads = [Thread(target = call) for _ in range(2)]
+    for t in threads:
+        t.start()
+    sleep(0.05)
+    with pytest.raises(RateLimitExceeded):
+        with limiter:
+            pass
+    for t in threads:
+        t.join()
+    
+    with limiter:
+        pass
+    stats = limiter.stats()
+    assert stats['calls'] == 3
+    assert stats['rejected'] == 1
+    assert stats['max_active'] == 2
+    assert stats['active'] == 0
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(threshold = 2, reset_timeout = 0.1)
+    
+    def fail():
+        raise APIRequestError('httperror', 503, 'Service Unavailable')
+    
+    def not_found():
+        raise APIRequestError('error', 1, 'Document not found')
+    
+    # Ipernity errors do not count as failures
+    for _ in range(3):
+        with pytest.raises(APIRequestError):
+            breaker.call(not_found)
+    assert breaker.state == CircuitBreaker.CLOSED
+    
+    for _ in range(2):
+        with pytest.raises(APIRequestError):
+            breaker.call(fail)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.call(lambda: 'ok')
+    
+    # Failed probe opens the breaker again
+    sleep(0.1)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(APIRequestError):
+        breaker.call(fail)
+    assert breaker.state == CircuitBreaker.OPEN
+    
+    sleep(0.1)
+    assert breaker.call(lambda: 'ok') == 'ok'
+    stats = breaker.stats()
+    assert stats['state'] == CircuitBreaker.CLOSED
+    assert stats['opened'] == 2
+    assert stats['rejected'] == 1
+